@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# benchmarks.dvh_parsing.py
+"""
+Compare per-DVH parsing of dvh_string and dvh_curve values (as in DVH prior
+to 0.9.8) with db.dvh_store.get_normalized_dvh_ragged, as used by
+models.dvh.DVH.parse_dvhs
+
+Usage (with dvha installed): python benchmarks/dvh_parsing.py [--counts N ...]
+"""
+# Copyright (c) 2016-2019 Dan Cutright
+# This file is part of DVH Analytics, released under a BSD license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/cutright/DVH-Analytics
+
+import argparse
+from time import perf_counter
+import tracemalloc
+import numpy as np
+from dvha.db.dvh_curve import encode_dvh_curve, get_dvh_counts
+from dvha.db.dvh_store import get_normalized_dvh, get_normalized_dvh_ragged
+from dvha.models.compact_dvh import CompactDVHs
+
+
+def get_dvh_strings(count, max_dose=7500, seed=0):
+    """Generate cumulative DVHs formatted as DVHs.dvh_string values
+
+    Parameters
+    ----------
+    count : int
+        number of DVHs
+    max_dose : int, optional
+        maximum DVH length (cGy)
+    seed : int, optional
+        seed of the random number generator
+
+    Returns
+    -------
+    list
+        comma-separated volumes with 1 cGy bins
+    """
+    rng = np.random.default_rng(seed)
+    dvh_strings = []
+    for length in rng.integers(max_dose // 10, max_dose, count):
+        dvh = np.sort(rng.random(length))[::-1] * rng.uniform(1, 500)
+        dvh_strings.append(",".join("%0.3f" % v for v in dvh))
+    return dvh_strings
+
+
+def parse_per_dvh(dvh_strings, bin_width):
+    """The pre-0.9.8 parsing of dvh_string values in DVH.__init__"""
+    dvh_split = []
+    for dvh_string in dvh_strings:
+        dvh = np.array(dvh_string.split(",")[::bin_width], dtype=float)
+        dvh_max = np.max(dvh)
+        if dvh_max > 0:
+            dvh = np.divide(dvh, dvh_max)
+        dvh_split.append(dvh)
+
+    bin_count = max([len(dvh) for dvh in dvh_split])
+    dvhs = np.zeros([bin_count, len(dvh_strings)])
+    for i, dvh in enumerate(dvh_split):
+        dvhs[:, i] = np.concatenate((dvh, np.zeros(bin_count - len(dvh))))
+    return dvhs
+
+
+def parse_curves_per_dvh(dvh_curves, bin_width):
+    """Per-DVH parsing of dvh_curve values, prior to the bulk parser"""
+    dvh_split = [
+        get_normalized_dvh(get_dvh_counts(dvh_curve), bin_width)
+        for dvh_curve in dvh_curves
+    ]
+    bin_count = max([len(dvh) for dvh in dvh_split])
+    dvhs = np.zeros([bin_count, len(dvh_curves)])
+    for i, dvh in enumerate(dvh_split):
+        dvhs[: len(dvh), i] = dvh
+    return dvhs
+
+
+def parse_bulk(dvh_curves, dvh_strings, bin_width):
+    """The parsing of DVH.parse_dvhs, into CompactDVHs"""
+    return CompactDVHs(
+        *get_normalized_dvh_ragged(dvh_curves, dvh_strings, bin_width)
+    )
+
+
+def time_call(func, *args, repeat=3):
+    """Get the best time of several calls, the peak memory allocated by a
+    call, and its result"""
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func(*args)
+        times.append(perf_counter() - start)
+    del result
+    tracemalloc.start()
+    result = func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak / 2 ** 20, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--counts", type=int, nargs="+", default=[1000, 10000, 50000]
+    )
+    parser.add_argument("--bin-width", type=int, default=5)
+    parser.add_argument("--max-dose", type=int, default=3000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    row = "%-11s %7s %10s %10s %9s %12s %12s"
+    print(
+        row
+        % (
+            "Format",
+            "DVHs",
+            "per DVH",
+            "bulk",
+            "speed-up",
+            "per DVH peak",
+            "bulk peak",
+        )
+    )
+    for count in args.counts:
+        dvh_strings = get_dvh_strings(count, max_dose=args.max_dose)
+        dvh_curves = [encode_dvh_curve(s.split(",")) for s in dvh_strings]
+        formats = {
+            "dvh_string": (parse_per_dvh, dvh_strings, [None] * count),
+            "dvh_curve": (parse_curves_per_dvh, dvh_curves, dvh_curves),
+        }
+        for name, (per_dvh, values, curves) in formats.items():
+            per_dvh_time, per_dvh_peak, expected = time_call(
+                per_dvh, values, args.bin_width, repeat=args.repeat
+            )
+            bulk_time, bulk_peak, result = time_call(
+                parse_bulk,
+                curves,
+                dvh_strings,
+                args.bin_width,
+                repeat=args.repeat,
+            )
+
+            max_error = np.max(np.abs(expected - np.asarray(result)))
+            assert max_error < 1e-6, "results differ by %s" % max_error
+            print(
+                row
+                % (
+                    name,
+                    count,
+                    "%0.3f s" % per_dvh_time,
+                    "%0.3f s" % bulk_time,
+                    "%0.1fx" % (per_dvh_time / bulk_time),
+                    "%0.0f MB" % per_dvh_peak,
+                    "%0.0f MB" % bulk_peak,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# db.bulk_copy.py
+"""Stream the contents of one DVHA database into another"""
+# Copyright (c) 2016-2019 Dan Cutright
+# This file is part of DVH Analytics, released under a BSD license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/cutright/DVH-Analytics
+
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from wx import CallAfter
+from dvha.db.sql_connector import DVH_SQL
+
+
+class ProgressThrottle:
+    """Limit how often a progress callback is called. The callback is
+    sent to the GUI thread with wx.CallAfter if an app is running
+
+    Parameters
+    ----------
+    callback : callable, optional
+        function accepting table (str), current row (int), and
+        total_row_count (int)
+    interval : float, optional
+        minimum time (seconds) between callbacks
+    """
+
+    def __init__(self, callback, interval=0.25):
+        self.callback = callback
+        self.interval = interval
+        self.last_call = None
+
+    def __call__(self, table, counter, total_row_count, force=False):
+        if self.callback is None:
+            return
+        now = monotonic()
+        if (
+            force
+            or self.last_call is None
+            or now - self.last_call >= self.interval
+        ):
+            self.last_call = now
+            try:
+                CallAfter(self.callback, table, counter, total_row_count)
+            except AssertionError:
+                self.callback(table, counter, total_row_count)
+
+
+class BulkCopy:
+    """Copy DVHA tables from one database to another, reading with
+    DVH_SQL.query_iter and writing with executemany / execute_values in batched
+    transactions
+
+    Parameters
+    ----------
+    cnx_src : DVH_SQL, ColumnarDB
+        the source DVHA DB connection, or a db.columnar.ColumnarDB
+    cnx_dst : DVH_SQL
+        the destination DVHA DB connection
+    callback : callable, optional
+        optional function to be called as rows are copied. Should accept
+        table (str), current row (int), total_row_count (int) as parameters
+    force : bool, optional
+        ignore duplicate StudyInstanceUIDs if False
+    create_new_uids : bool, optional
+        If true, dbname of cnx_src will be appended to study_instance_uid
+        and mrn
+    append_to_uid : str, optional
+        If create_new_uids is true, append this to mrn and
+        study_instance_uids instead of dbname
+    batch_size : int, optional
+        number of rows read and written at a time
+    batches_per_commit : int, optional
+        number of batches written per transaction
+    workers : int, optional
+        number of tables copied in parallel, each with its own connections.
+        Ignored if the destination is sqlite, which only allows one writer
+    uids : list, optional
+        only copy the rows of these study instance uids (DVH_SQL sources
+        only), see db.delta_sync
+    """
+
+    def __init__(
+        self,
+        cnx_src,
+        cnx_dst,
+        callback=None,
+        force=False,
+        create_new_uids=False,
+        append_to_uid=None,
+        batch_size=2000,
+        batches_per_commit=10,
+        workers=1,
+        uids=None,
+    ):
+        self.cnx_src = cnx_src
+        self.cnx_dst = cnx_dst
+        self.callback = callback
+        self.force = force
+        self.create_new_uids = create_new_uids
+        self.append_to_uid = append_to_uid
+        self.batch_size = batch_size
+        self.batches_per_commit = batches_per_commit
+        self.workers = 1 if cnx_dst.db_type == "sqlite" else max(1, workers)
+        self.uids = None if uids is None else sorted(set(uids))
+
+        self.new_uids = {}
+        self.dst_uids = set()
+        if self.create_new_uids:
+            for table in cnx_dst.existing_tables:
+                self.dst_uids.update(
+                    cnx_dst.get_unique_values(table, "study_instance_uid")
+                )
+
+    def run(self, tables=None):
+        """Copy tables from the source to the destination database
+
+        Parameters
+        ----------
+        tables : list, optional
+            SQL tables to copy, defaults to all DVHA tables of the source
+        """
+        tables = self.cnx_src.tables if tables is None else tables
+
+        if self.workers == 1:
+            for table in tables:
+                self.copy_table(table, self.cnx_src, self.cnx_dst)
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [
+                    executor.submit(self.copy_table_with_new_cnx, table)
+                    for table in tables
+                ]
+                for future in futures:
+                    future.result()  # re-raise any worker exception
+
+    def copy_table_with_new_cnx(self, table):
+        """Copy a table using connections dedicated to the calling thread
+
+        Parameters
+        ----------
+        table : str
+            SQL table
+        """
+        src, dst = self.cnx_src, self.cnx_dst
+        with DVH_SQL(dst.config, db_type=dst.db_type) as cnx_dst:
+            if not isinstance(src, DVH_SQL):
+                # e.g., a read-only db.columnar.ColumnarDB
+                self.copy_table(table, src, cnx_dst)
+                return
+            with DVH_SQL(src.config, db_type=src.db_type) as cnx_src:
+                self.copy_table(table, cnx_src, cnx_dst)
+
+    def copy_table(self, table, cnx_src, cnx_dst):
+        """Copy a table with batched reads and writes
+
+        Parameters
+        ----------
+        table : str
+            SQL table
+        cnx_src : DVH_SQL
+            the source DVHA DB connection
+        cnx_dst : DVH_SQL
+            the destination DVHA DB connection
+        """
+        dst_columns = set(cnx_dst.get_column_names(table))
+        columns = [
+            c for c in cnx_src.get_column_names(table) if c in dst_columns
+        ]
+        if "study_instance_uid" not in columns:
+            return  # e.g., DVH_Contours of a database older than 0.9.8
+        uid_index = columns.index("study_instance_uid")
+        mrn_index = columns.index("mrn")
+
+        skipped_uids = set()
+        if not self.force:
+            skipped_uids = set(
+                cnx_dst.get_unique_values(table, "study_instance_uid")
+            )
+
+        conditions = self.get_uid_conditions()
+        progress = ProgressThrottle(self.callback)
+        total_row_count = sum(
+            cnx_src.get_row_count(table, condition) for condition in conditions
+        )
+        counter = 0
+
+        batch_count = 0
+        for rows in self.iter_rows(table, columns, cnx_src, conditions):
+            counter += len(rows)
+
+            params = []
+            for row in rows:
+                if row[uid_index] in skipped_uids:
+                    continue
+                row = [process_value(v) for v in row]
+                if self.create_new_uids:
+                    row[uid_index], row[mrn_index] = self.get_new_uid_and_mrn(
+                        cnx_src, row[uid_index], row[mrn_index]
+                    )
+                params.append(tuple(row))
+
+            if params:
+                cnx_dst.insert_values(table, columns, params, commit=False)
+                batch_count += 1
+                if batch_count % self.batches_per_commit == 0:
+                    cnx_dst.cnx.commit()
+
+            progress(table, counter, total_row_count)
+
+        cnx_dst.cnx.commit()
+        if counter:
+            progress(table, counter, total_row_count, force=True)
+
+    def get_uid_conditions(self, uids_per_condition=500):
+        """Get the conditions selecting the rows to be copied
+
+        Parameters
+        ----------
+        uids_per_condition : int, optional
+            maximum number of uids in each condition
+
+        Returns
+        -------
+        list
+            conditions in SQL syntax, [None] if all rows are copied
+        """
+        if self.uids is None:
+            return [None]
+        return [
+            "study_instance_uid IN ('%s')"
+            % "','".join(self.uids[i : i + uids_per_condition])
+            for i in range(0, len(self.uids), uids_per_condition)
+        ]
+
+    def iter_rows(self, table, columns, cnx_src, conditions):
+        """Read the rows of a table meeting any of the conditions in batches
+
+        Parameters
+        ----------
+        table : str
+            SQL table
+        columns : list
+            SQL columns to be read
+        cnx_src : DVH_SQL
+            the source DVHA DB connection
+        conditions : list
+            conditions from get_uid_conditions
+
+        Yields
+        -------
+        list
+            row tuples
+        """
+        for condition in conditions:
+            yield from cnx_src.query_iter(
+                table,
+                ",".join(columns),
+                *([] if condition is None else [condition]),
+                batch_size=self.batch_size,
+            )
+
+    def get_new_uid_and_mrn(self, cnx_src, uid, mrn):
+        """Get the study_instance_uid and mrn to use in the destination if
+        create_new_uids is True. The suffix is determined once per uid so
+        that all tables are consistent
+
+        Parameters
+        ----------
+        cnx_src : DVH_SQL
+            the source DVHA DB connection
+        uid : str
+            study_instance_uid in the source database
+        mrn : str
+            mrn in the source database
+
+        Returns
+        -------
+        tuple
+            new study_instance_uid, new mrn
+        """
+        if uid not in self.new_uids:
+            db_name = cnx_src.db_name
+            if not db_name:
+                db_name = cnx_src.config["host"]
+            append_with_me = self.append_to_uid
+            if not append_with_me:
+                append_with_me = db_name
+            suffix = append_with_me
+            uid_counter = 2
+            while f"{uid}_{suffix}" in self.dst_uids:
+                suffix = f"{append_with_me}_{uid_counter}"
+                uid_counter += 1
+            self.new_uids[uid] = suffix
+        suffix = self.new_uids[uid]
+        return f"{uid}_{suffix}", f"{mrn}_{suffix}"
+
+
+def process_value(value):
+    """Convert a queried value into an insert parameter. Values are passed as
+    strings (and cast by the database), except NULL and binary data. The
+    string 'None' is treated as NULL, consistent with DVH_SQL.insert_row
+
+    Parameters
+    ----------
+    value : any
+        value from a cursor row
+
+    Returns
+    -------
+    str, bytes, None
+        parameter for DVH_SQL.insert_values
+    """
+    if isinstance(value, bytes):
+        return value
+    if value is None or str(value) == "None":
+        return None
+    return str(value)
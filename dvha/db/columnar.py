@@ -0,0 +1,696 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# db.columnar.py
+"""Chunked, columnar (NPZ or Parquet) export and import of a DVHA database"""
+# Copyright (c) 2016-2019 Dan Cutright
+# This file is part of DVH Analytics, released under a BSD license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/cutright/DVH-Analytics
+
+import json
+import numpy as np
+from os import mkdir
+from os.path import basename, isdir, join, normpath
+import re
+from dvha.db.bulk_copy import BulkCopy, ProgressThrottle
+from dvha.db.dvh_curve import (
+    DVH_CURVE_COLUMN,
+    DVH_CURVE_DTYPE,
+    decode_dvh_curve,
+    encode_dvh_curve,
+    is_dvh_curve,
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa, pq = None, None
+
+
+MANIFEST_FILE_NAME = "manifest.json"
+COLUMNAR_VERSION = 1
+FILE_FORMATS = ["npz", "parquet"]
+
+# Column kinds
+NUMERIC, TEXT, CURVE, BINARY = "numeric", "text", "curve", "binary"
+NUMERIC_SQL_TYPES = {"real", "double precision", "numeric"}
+BINARY_SQL_TYPES = {"blob", "bytea"}
+
+# Conditions supported by ColumnarDB (see BulkCopy.get_uid_conditions)
+UID_CONDITION = re.compile(
+    r"^\s*study_instance_uid\s*(?:=\s*('(?:[^']|'')*')|IN\s*\((.*)\))\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+QUOTED_VALUE = re.compile(r"'((?:[^']|'')*)'")
+
+
+def get_column_kind(column, sql_type):
+    """Determine how a column is stored in a columnar export
+
+    Parameters
+    ----------
+    column : str
+        SQL column
+    sql_type : str
+        SQL data type, as returned by DVH_SQL.get_column_types
+
+    Returns
+    -------
+    str
+        'numeric' (float64, NaN for NULL), 'curve' (2D float32 array),
+        'binary' (bytes, e.g., DVH_Contours.contours), or 'text' (utf-8
+        strings)
+    """
+    if column == DVH_CURVE_COLUMN:
+        return CURVE
+    sql_type = sql_type.lower()
+    if "int" in sql_type or sql_type in NUMERIC_SQL_TYPES:
+        return NUMERIC
+    if sql_type in BINARY_SQL_TYPES:
+        return BINARY
+    return TEXT
+
+
+def export_columnar(
+    cnx, dir_path, file_format="npz", chunk_size=5000, callback=None
+):
+    """Write each table of a DVHA database into chunked columnar files. DVH
+    curves are written as 2D float32 arrays (one row per DVH, zero padded)
+
+    Parameters
+    ----------
+    cnx : DVH_SQL
+        the source DVHA DB connection
+    dir_path : str
+        directory for the export, created if it does not exist
+    file_format : str, optional
+        either 'npz' (compressed numpy) or 'parquet' (requires pyarrow)
+    chunk_size : int, optional
+        maximum number of rows per file
+    callback : callable, optional
+        optional function to be called as rows are exported. Should accept
+        table (str), current row (int), total_row_count (int) as parameters
+    """
+    if file_format not in FILE_FORMATS:
+        raise ValueError("file_format must be one of %s" % FILE_FORMATS)
+    if file_format == "parquet" and pa is None:
+        raise ImportError("Parquet export requires pyarrow")
+
+    if not isdir(dir_path):
+        mkdir(dir_path)
+
+    manifest = {
+        "version": COLUMNAR_VERSION,
+        "format": file_format,
+        "tables": {},
+    }
+    progress = ProgressThrottle(callback)
+    for table in cnx.tables:
+        column_types = cnx.get_column_types(table)
+        columns = sorted(column_types)
+        kinds = {c: get_column_kind(c, column_types[c]) for c in columns}
+        total_row_count = cnx.get_row_count(table)
+
+        chunks, row_count = [], 0
+        for batch in cnx.query_iter(
+            table, ",".join(columns), batch_size=chunk_size
+        ):
+            file_name = "%s_%05d.%s" % (table, len(chunks), file_format)
+            data = dict(zip(columns, zip(*batch)))
+            if file_format == "npz":
+                write_npz_chunk(join(dir_path, file_name), data, kinds)
+            else:
+                write_parquet_chunk(join(dir_path, file_name), data, kinds)
+            chunks.append(file_name)
+            row_count += len(batch)
+            progress(table, row_count, total_row_count)
+
+        manifest["tables"][table] = {
+            "columns": kinds,
+            "sql_types": column_types,
+            "row_count": row_count,
+            "chunks": chunks,
+        }
+
+    with open(join(dir_path, MANIFEST_FILE_NAME), "w") as fp:
+        json.dump(manifest, fp, indent=2)
+
+
+def import_columnar(dir_path, cnx_dst, **kwargs):
+    """Import a columnar export into a DVHA database
+
+    Parameters
+    ----------
+    dir_path : str
+        directory of a columnar export
+    cnx_dst : DVH_SQL
+        the destination DVHA DB connection
+    kwargs :
+        keyword arguments passed to BulkCopy (e.g., callback, force,
+        create_new_uids)
+    """
+    BulkCopy(ColumnarDB(dir_path), cnx_dst, **kwargs).run()
+
+
+def write_npz_chunk(file_path, data, kinds):
+    """Write one chunk of a table into a compressed .npz file. Text and
+    binary columns are stored as concatenated (utf-8) bytes with offsets, so
+    that very long values (e.g., roi_coord_string) do not inflate fixed-width
+    arrays
+
+    Parameters
+    ----------
+    file_path : str
+        path of the new .npz file
+    data : dict
+        column values (sequence) by column name
+    kinds : dict
+        column kind by column name, see get_column_kind
+    """
+    arrays = {}
+    for column, values in data.items():
+        if kinds[column] == NUMERIC:
+            arrays[column] = np.array(
+                [np.nan if v is None else float(v) for v in values],
+                dtype=np.float64,
+            )
+        elif kinds[column] == CURVE:
+            matrix, lengths = pack_curves(values)
+            arrays[column] = matrix
+            arrays[column + "__length"] = lengths
+        else:
+            encoded = [encode_value(v, kinds[column]) for v in values]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(v) for v in encoded])
+            arrays[column] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+            arrays[column + "__offsets"] = offsets
+            arrays[column + "__null"] = np.array([v is None for v in values])
+    np.savez_compressed(file_path, **arrays)
+
+
+def encode_value(value, kind):
+    """Convert a text or binary value into bytes for write_npz_chunk
+
+    Parameters
+    ----------
+    value : any
+        value from a cursor row
+    kind : str
+        column kind, see get_column_kind
+
+    Returns
+    -------
+    bytes
+        utf-8 encoded text, or the binary value (empty for NULL)
+    """
+    if value is None:
+        return b""
+    if kind == BINARY:
+        return bytes(value)
+    return str(value).encode()
+
+
+def read_npz_chunk(file_path, kinds, columns=None):
+    """Read a chunk written by write_npz_chunk
+
+    Parameters
+    ----------
+    file_path : str
+        path of the .npz file
+    kinds : dict
+        column kind by column name, see get_column_kind
+    columns : list, optional
+        only read these columns
+
+    Returns
+    -------
+    dict
+        numeric columns as float64 arrays, text and binary columns as lists,
+        and curve columns as a tuple of a 2D float32 array and row lengths
+    """
+    columns = list(kinds) if columns is None else columns
+    data = {}
+    with np.load(file_path) as npz:
+        for column in columns:
+            if kinds[column] == NUMERIC:
+                data[column] = npz[column]
+            elif kinds[column] == CURVE:
+                data[column] = (npz[column], npz[column + "__length"])
+            else:
+                raw = npz[column].tobytes()
+                offsets = npz[column + "__offsets"]
+                is_null = npz[column + "__null"]
+                values = [
+                    None if is_null[i] else raw[offsets[i]:offsets[i + 1]]
+                    for i in range(len(is_null))
+                ]
+                if kinds[column] == TEXT:
+                    values = [v if v is None else v.decode() for v in values]
+                data[column] = values
+    return data
+
+
+def write_parquet_chunk(file_path, data, kinds):
+    """Write one chunk of a table into a Parquet file, DVH curves are stored
+    as list<float32>
+
+    Parameters
+    ----------
+    file_path : str
+        path of the new .parquet file
+    data : dict
+        column values (sequence) by column name
+    kinds : dict
+        column kind by column name, see get_column_kind
+    """
+    arrays = {}
+    for column, values in data.items():
+        if kinds[column] == NUMERIC:
+            arrays[column] = pa.array(
+                [None if v is None else float(v) for v in values],
+                type=pa.float64(),
+            )
+        elif kinds[column] == CURVE:
+            arrays[column] = pa.array(
+                [
+                    decode_dvh_curve(v) if is_dvh_curve(v) else None
+                    for v in values
+                ],
+                type=pa.list_(pa.float32()),
+            )
+        elif kinds[column] == BINARY:
+            arrays[column] = pa.array(
+                [None if v is None else bytes(v) for v in values],
+                type=pa.binary(),
+            )
+        else:
+            arrays[column] = pa.array(
+                [None if v is None else str(v) for v in values],
+                type=pa.string(),
+            )
+    pq.write_table(pa.table(arrays), file_path)
+
+
+def read_parquet_chunk(file_path, kinds, columns=None):
+    """Read a chunk written by write_parquet_chunk
+
+    Parameters
+    ----------
+    file_path : str
+        path of the .parquet file
+    kinds : dict
+        column kind by column name, see get_column_kind
+    columns : list, optional
+        only read these columns
+
+    Returns
+    -------
+    dict
+        same format as read_npz_chunk
+    """
+    if pq is None:
+        raise ImportError("Parquet import requires pyarrow")
+    columns = list(kinds) if columns is None else columns
+    table = pq.read_table(file_path, columns=columns)
+    data = {}
+    for column in columns:
+        values = table.column(column)
+        if kinds[column] == NUMERIC:
+            data[column] = values.to_numpy(zero_copy_only=False).astype(
+                np.float64
+            )
+        elif kinds[column] == CURVE:
+            data[column] = pack_curves(values.to_pylist())
+        else:
+            data[column] = values.to_pylist()
+    return data
+
+
+def pack_curves(curves):
+    """Pack DVH curves into a zero padded 2D array
+
+    Parameters
+    ----------
+    curves : sequence
+        dvh_curve values (bytes, memoryview, or array-like), or None
+
+    Returns
+    -------
+    tuple
+        2D float32 array (row per curve), and the int32 length of each
+        curve (-1 for NULL)
+    """
+    curves = [to_curve(c) for c in curves]
+    lengths = np.array(
+        [-1 if c is None else len(c) for c in curves], dtype=np.int32
+    )
+    matrix = np.zeros((len(curves), max(1, lengths.max(initial=0))),
+                      dtype=DVH_CURVE_DTYPE)
+    for i, curve in enumerate(curves):
+        if curve is not None:
+            matrix[i, : len(curve)] = curve
+    return matrix, lengths
+
+
+def to_curve(value):
+    """Convert a dvh_curve value into a float32 array
+
+    Parameters
+    ----------
+    value : bytes, memoryview, array-like, None
+        a dvh_curve value
+
+    Returns
+    -------
+    np.ndarray, None
+        DVH curve, None if ``value`` is NULL or empty
+    """
+    if is_dvh_curve(value):
+        return decode_dvh_curve(value)
+    if value is None or isinstance(value, (bytes, bytearray, memoryview)):
+        return None
+    return np.asarray(value, dtype=DVH_CURVE_DTYPE)
+
+
+def unpack_curves(matrix, lengths):
+    """Convert a packed 2D array back into a list of DVH curves
+
+    Parameters
+    ----------
+    matrix : np.ndarray
+        2D array from pack_curves
+    lengths : np.ndarray
+        curve lengths from pack_curves
+
+    Returns
+    -------
+    list
+        np.ndarray per row, or None for NULL
+    """
+    return [
+        None if length < 0 else matrix[i, :length]
+        for i, length in enumerate(lengths)
+    ]
+
+
+def select_chunk_rows(chunk, indices):
+    """Select rows of a chunk returned by ColumnarDB.iter_chunks
+
+    Parameters
+    ----------
+    chunk : dict
+        chunk data by column, see read_npz_chunk
+    indices : list
+        indices of the rows to keep
+
+    Returns
+    -------
+    dict
+        chunk data by column, with only the rows at ``indices``
+    """
+    selected = {}
+    for column, values in chunk.items():
+        if isinstance(values, tuple):  # curves: 2D array, row lengths
+            selected[column] = tuple(array[indices] for array in values)
+        elif isinstance(values, np.ndarray):
+            selected[column] = values[indices]
+        else:
+            selected[column] = [values[i] for i in indices]
+    return selected
+
+
+class ColumnarDB:
+    """Read-only access to a columnar export. Provides the subset of the
+    DVH_SQL API used by BulkCopy, so a columnar export can be the source of
+    DVH_SQL.import_db and merge_db
+
+    Parameters
+    ----------
+    dir_path : str
+        directory of a columnar export
+    """
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.db_type = "columnar"
+        self.config = {"host": dir_path}
+        self.db_name = basename(normpath(dir_path))
+
+        with open(join(dir_path, MANIFEST_FILE_NAME), "r") as fp:
+            self.manifest = json.load(fp)
+        if self.manifest["format"] not in FILE_FORMATS:
+            raise ValueError(
+                "Unsupported columnar format: %s" % self.manifest["format"]
+            )
+        self.tables = list(self.manifest["tables"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ctx_type, ctx_value, ctx_traceback):
+        self.close()
+
+    def close(self):
+        """Nothing to close, provided for parity with DVH_SQL"""
+        pass
+
+    def get_column_names(self, table_name):
+        """Get all of the column names for a specified table
+
+        Parameters
+        ----------
+        table_name : str
+            SQL table
+
+        Returns
+        -------
+        list
+            All columns names in ``table_name``
+        """
+        return sorted(self.manifest["tables"][table_name]["columns"])
+
+    def get_column_types(self, table_name):
+        """Get the SQL data type of each column in a specified table
+
+        Parameters
+        ----------
+        table_name : str
+            SQL table
+
+        Returns
+        -------
+        dict
+            SQL data types of ``table_name`` stored by column name
+        """
+        return dict(self.manifest["tables"][table_name]["sql_types"])
+
+    def get_row_count(self, table, condition=None):
+        """Get the number of rows in a table
+
+        Parameters
+        ----------
+        table : str
+            SQL table
+        condition : str, optional
+            study_instance_uid condition, see get_condition_uids
+
+        Returns
+        -------
+        int
+            Number of rows in ``table`` meeting ``condition``
+        """
+        uids = self.get_condition_uids(condition)
+        if uids is None:
+            return self.manifest["tables"][table]["row_count"]
+        return sum(
+            sum(uid in uids for uid in chunk["study_instance_uid"])
+            for chunk in self.iter_chunks(table, ["study_instance_uid"])
+        )
+
+    @staticmethod
+    def get_condition_uids(condition):
+        """Get the study instance uids selected by a condition. Only
+        "study_instance_uid = '...'" and "study_instance_uid IN ('...', ...)"
+        are supported (i.e., the conditions of BulkCopy), rows are filtered
+        in python
+
+        Parameters
+        ----------
+        condition : str, None
+            a condition in SQL syntax
+
+        Returns
+        -------
+        set, None
+            study instance uids, None if ``condition`` is empty
+        """
+        if not condition:
+            return None
+        match = UID_CONDITION.match(condition)
+        if match is None:
+            raise ValueError(
+                "ColumnarDB only supports study_instance_uid conditions, "
+                "not: %s" % condition
+            )
+        values = match.group(1) or match.group(2)
+        return {v.replace("''", "'") for v in QUOTED_VALUE.findall(values)}
+
+    def iter_chunks(self, table, columns=None):
+        """Read a table one chunk at a time
+
+        Parameters
+        ----------
+        table : str
+            SQL table
+        columns : list, optional
+            only read these columns
+
+        Yields
+        -------
+        dict
+            numeric columns as float64 arrays, text and binary columns as
+            lists, and curve columns as a tuple of a 2D float32 array and row
+            lengths
+        """
+        table_info = self.manifest["tables"][table]
+        reader = [read_npz_chunk, read_parquet_chunk][
+            self.manifest["format"] == "parquet"
+        ]
+        for file_name in table_info["chunks"]:
+            yield reader(
+                join(self.dir_path, file_name), table_info["columns"], columns
+            )
+
+    def query_iter(
+        self, table_name, return_col_str, *condition_str, batch_size=None,
+        **kwargs
+    ):
+        """Yield the rows of a table, one chunk at a time, in the format of
+        DVH_SQL.query_iter. Only plain column lists are supported
+
+        Parameters
+        ----------
+        table_name : str
+            SQL table
+        return_col_str : str
+            a csv of columns to be returned
+        condition_str : str, optional
+            study_instance_uid condition, see get_condition_uids
+        batch_size : None
+            ignored, batches are the chunks of the export
+
+        Yields
+        -------
+        list
+            row tuples, NULL numeric values are None and DVH curves are
+            bytes
+        """
+        uids = self.get_condition_uids(
+            condition_str[0] if condition_str else None
+        )
+        columns = [c.strip() for c in return_col_str.split(",")]
+        kinds = self.manifest["tables"][table_name]["columns"]
+        sql_types = self.manifest["tables"][table_name]["sql_types"]
+        read_columns = columns
+        if uids is not None and "study_instance_uid" not in columns:
+            read_columns = columns + ["study_instance_uid"]
+        for chunk in self.iter_chunks(table_name, read_columns):
+            if uids is not None:
+                chunk = select_chunk_rows(
+                    chunk,
+                    [
+                        i
+                        for i, uid in enumerate(chunk["study_instance_uid"])
+                        if uid in uids
+                    ],
+                )
+                if not chunk["study_instance_uid"]:
+                    continue
+            values = []
+            for column in columns:
+                if kinds[column] == NUMERIC:
+                    # integers are stored as float64, restore the type so
+                    # the value can be cast into an integer column
+                    cast = int if "int" in sql_types[column].lower() else float
+                    values.append(
+                        [
+                            None if np.isnan(v) else cast(v)
+                            for v in chunk[column].tolist()
+                        ]
+                    )
+                elif kinds[column] == CURVE:
+                    values.append(
+                        [
+                            None if c is None else encode_dvh_curve(c)
+                            for c in unpack_curves(*chunk[column])
+                        ]
+                    )
+                else:
+                    values.append(chunk[column])
+            yield list(zip(*values))
+
+    def to_pandas(self, table, columns=None):
+        """Load a table into a pandas DataFrame. DVH curves are stored as
+        float32 arrays (or None)
+
+        Parameters
+        ----------
+        table : str
+            SQL table
+        columns : list, optional
+            only load these columns
+
+        Returns
+        -------
+        pandas.DataFrame
+            The table data
+        """
+        import pandas as pd
+
+        kinds = self.manifest["tables"][table]["columns"]
+        columns = sorted(kinds) if columns is None else columns
+        frames = []
+        for chunk in self.iter_chunks(table, columns):
+            for column in columns:
+                if kinds[column] == CURVE:
+                    chunk[column] = unpack_curves(*chunk[column])
+            frames.append(pd.DataFrame(chunk, columns=columns))
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def get_dvh_matrix(self, condition_column=None, values=None):
+        """Get every DVH as a 2D float32 array (one row per DVH, zero padded)
+
+        Parameters
+        ----------
+        condition_column : str, optional
+            only include rows where this DVHs column is in ``values``
+        values : list, optional
+            values of ``condition_column`` to include
+
+        Returns
+        -------
+        tuple
+            2D float32 array, and a list of (study_instance_uid, roi_name)
+            for each row
+        """
+        columns = ["study_instance_uid", "roi_name", DVH_CURVE_COLUMN]
+        if condition_column and condition_column not in columns:
+            columns.append(condition_column)
+        values = None if values is None else set(values)
+
+        curves, keys = [], []
+        for chunk in self.iter_chunks("DVHs", columns):
+            chunk_curves = unpack_curves(*chunk[DVH_CURVE_COLUMN])
+            for i, curve in enumerate(chunk_curves):
+                if values is not None and \
+                        chunk[condition_column][i] not in values:
+                    continue
+                keys.append(
+                    (chunk["study_instance_uid"][i], chunk["roi_name"][i])
+                )
+                curves.append(curve)
+        return pack_curves(curves)[0], keys
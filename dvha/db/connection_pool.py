@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# db.connection_pool.py
+"""A process-wide pool of reusable SQL database connections"""
+# Copyright (c) 2016-2019 Dan Cutright
+# This file is part of DVH Analytics, released under a BSD license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/cutright/DVH-Analytics
+
+import psycopg2
+import sqlite3
+from os.path import dirname, join
+from threading import Lock
+from dvha.options import get_stored_sql_settings
+from dvha.paths import DATA_DIR
+from dvha.tools.errors import push_to_log
+
+
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 / sqlite3 connections. Connections are
+    stored by database type and configuration, a connection is only used by
+    one DVH_SQL object at a time between ``checkout`` and ``checkin``. Table
+    schemas are also cached by configuration, since they rarely change.
+
+    Parameters
+    ----------
+    max_idle : int, optional
+        The maximum number of idle connections kept per configuration
+    """
+
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self.enabled = True
+
+        self._lock = Lock()
+        self._idle = {}  # connections available for checkout, by key
+        self._checked_out = {}  # key of each checked out connection, by id
+        self._schema = {}  # column types by table, by key
+
+    @staticmethod
+    def get_key(db_type, config):
+        """Get the pool key for a connection configuration
+
+        Parameters
+        ----------
+        db_type : str
+            either 'pgsql' or 'sqlite'
+        config : dict
+            SQL login credentials
+
+        Returns
+        -------
+        tuple
+            hashable representation of ``db_type`` and ``config``
+        """
+        return db_type, tuple(sorted((k, str(v)) for k, v in config.items()))
+
+    @staticmethod
+    def connect(db_type, config):
+        """Open a new connection
+
+        Parameters
+        ----------
+        db_type : str
+            either 'pgsql' or 'sqlite'
+        config : dict
+            SQL login credentials
+
+        Returns
+        -------
+        sqlite3.Connection, psycopg2.extensions.connection
+            A new database connection
+        """
+        if db_type == "sqlite":
+            db_file_path = config["host"]
+            if not dirname(
+                db_file_path
+            ):  # file_path has not directory, assume it lives in DATA_DIR
+                db_file_path = join(DATA_DIR, db_file_path)
+            # Pooled connections may be checked out by different threads,
+            # but only one thread at a time
+            cnx = sqlite3.connect(db_file_path, check_same_thread=False)
+            apply_sqlite_pragmas(cnx)
+            return cnx
+        return psycopg2.connect(**config)
+
+    @staticmethod
+    def is_healthy(cnx, db_type):
+        """Check that an idle connection is still usable
+
+        Parameters
+        ----------
+        cnx : sqlite3.Connection, psycopg2.extensions.connection
+            a pooled connection
+        db_type : str
+            either 'pgsql' or 'sqlite'
+
+        Returns
+        -------
+        bool
+            True if a trivial query succeeds on ``cnx``
+        """
+        try:
+            if db_type == "pgsql" and cnx.closed:
+                return False
+            cursor = cnx.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.fetchall()
+            cursor.close()
+            cnx.rollback()
+            return True
+        except Exception:
+            return False
+
+    def checkout(self, db_type, config):
+        """Get an idle connection, or open a new one
+
+        Parameters
+        ----------
+        db_type : str
+            either 'pgsql' or 'sqlite'
+        config : dict
+            SQL login credentials
+
+        Returns
+        -------
+        sqlite3.Connection, psycopg2.extensions.connection
+            A connection reserved for the caller until ``checkin``
+        """
+        key = self.get_key(db_type, config)
+        cnx = None
+        while cnx is None:
+            with self._lock:
+                idle = self._idle.get(key)
+                cnx = idle.pop() if idle else None
+            if cnx is None:
+                cnx = self.connect(db_type, config)
+            elif not self.is_healthy(cnx, db_type):
+                self._close(cnx)
+                cnx = None
+
+        with self._lock:
+            self._checked_out[id(cnx)] = key
+        return cnx
+
+    def checkin(self, cnx):
+        """Return a connection to the pool. Uncommitted changes are rolled
+        back, which matches the behavior of closing the connection
+
+        Parameters
+        ----------
+        cnx : sqlite3.Connection, psycopg2.extensions.connection
+            a connection returned from ``checkout``
+        """
+        with self._lock:
+            key = self._checked_out.pop(id(cnx), None)
+
+        if key is None or not self.enabled:
+            self._close(cnx)
+            return
+
+        try:
+            cnx.rollback()
+        except Exception:
+            self._close(cnx)
+            return
+
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(cnx)
+                return
+        self._close(cnx)
+
+    def get_schema(self, key, table):
+        """Get the cached column types of a table
+
+        Parameters
+        ----------
+        key : tuple
+            pool key of the database, see ``get_key``
+        table : str
+            SQL table
+
+        Returns
+        -------
+        dict, None
+            SQL data types by column name, None if not cached
+        """
+        with self._lock:
+            column_types = self._schema.get(key, {}).get(table.lower())
+        return None if column_types is None else dict(column_types)
+
+    def set_schema(self, key, table, column_types):
+        """Cache the column types of a table
+
+        Parameters
+        ----------
+        key : tuple
+            pool key of the database, see ``get_key``
+        table : str
+            SQL table
+        column_types : dict
+            SQL data types by column name
+        """
+        with self._lock:
+            self._schema.setdefault(key, {})[table.lower()] = dict(
+                column_types
+            )
+
+    def clear_schema(self, key=None):
+        """Invalidate cached schemas, call after any schema change
+
+        Parameters
+        ----------
+        key : tuple, optional
+            pool key of the database, clear all databases if None
+        """
+        with self._lock:
+            if key is None:
+                self._schema = {}
+            else:
+                self._schema.pop(key, None)
+
+    def close_all(self):
+        """Close every idle connection. Checked out connections are closed
+        when they are checked in"""
+        with self._lock:
+            idle = [cnx for cnxs in self._idle.values() for cnx in cnxs]
+            self._idle = {}
+            self._checked_out = {}
+        for cnx in idle:
+            self._close(cnx)
+
+    @property
+    def idle_count(self):
+        """Get the number of idle connections
+
+        Returns
+        -------
+        int
+            Number of connections available for checkout
+        """
+        with self._lock:
+            return sum(len(cnxs) for cnxs in self._idle.values())
+
+    @staticmethod
+    def _close(cnx):
+        try:
+            cnx.close()
+        except Exception as e:
+            push_to_log(e, msg="ConnectionPool: Failed to close connection")
+
+
+def apply_sqlite_pragmas(cnx, pragmas=None):
+    """Apply the SQLite tuning profile to a connection
+
+    Parameters
+    ----------
+    cnx : sqlite3.Connection
+        a new sqlite3 connection
+    pragmas : dict, optional
+        PRAGMA values by name, defaults to the SQLITE_PRAGMAS option
+    """
+    if pragmas is None:
+        pragmas = get_stored_sql_settings().get("SQLITE_PRAGMAS", {})
+    for pragma, value in pragmas.items():
+        try:
+            cnx.execute("PRAGMA %s = %s;" % (pragma, value)).fetchall()
+        except sqlite3.Error as e:
+            msg = "ConnectionPool: Failed to apply PRAGMA %s = %s" % (
+                pragma,
+                value,
+            )
+            push_to_log(e, msg=msg)
+
+
+CONNECTION_POOL = ConnectionPool()
+
+
+def close_all_connections():
+    """Close all idle pooled connections, call on application exit"""
+    CONNECTION_POOL.close_all()
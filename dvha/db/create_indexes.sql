@@ -0,0 +1,19 @@
+-- Secondary indexes, valid for both PostgreSQL and SQLite. Added as of DVH Analytics 0.9.8
+CREATE INDEX IF NOT EXISTS dvhs_uid_roi_name_idx ON DVHs (study_instance_uid, roi_name);
+CREATE INDEX IF NOT EXISTS dvhs_roi_name_idx ON DVHs (roi_name);
+CREATE INDEX IF NOT EXISTS dvhs_physician_roi_idx ON DVHs (physician_roi);
+CREATE INDEX IF NOT EXISTS dvhs_roi_type_idx ON DVHs (roi_type);
+CREATE INDEX IF NOT EXISTS dvhs_mrn_idx ON DVHs (mrn);
+CREATE INDEX IF NOT EXISTS plans_uid_idx ON Plans (study_instance_uid);
+CREATE INDEX IF NOT EXISTS plans_mrn_idx ON Plans (mrn);
+CREATE INDEX IF NOT EXISTS rxs_uid_idx ON Rxs (study_instance_uid);
+CREATE INDEX IF NOT EXISTS rxs_mrn_idx ON Rxs (mrn);
+CREATE INDEX IF NOT EXISTS beams_uid_idx ON Beams (study_instance_uid);
+CREATE INDEX IF NOT EXISTS beams_mrn_idx ON Beams (mrn);
+CREATE INDEX IF NOT EXISTS dicom_files_uid_idx ON DICOM_Files (study_instance_uid);
+CREATE INDEX IF NOT EXISTS dicom_files_mrn_idx ON DICOM_Files (mrn);
+CREATE INDEX IF NOT EXISTS dvhs_import_time_stamp_idx ON DVHs (import_time_stamp);
+CREATE INDEX IF NOT EXISTS plans_import_time_stamp_idx ON Plans (import_time_stamp);
+CREATE INDEX IF NOT EXISTS dvh_contours_uid_roi_name_idx ON DVH_Contours (study_instance_uid, roi_name);
+CREATE INDEX IF NOT EXISTS dvh_contours_mrn_idx ON DVH_Contours (mrn);
+CREATE INDEX IF NOT EXISTS dvha_sync_uid_idx ON DVHA_Sync (study_instance_uid);
@@ -74,4 +74,13 @@ ALTER TABLE DVHs ADD COLUMN IF NOT EXISTS ovh_75 real;
 ALTER TABLE DVHs ADD COLUMN IF NOT EXISTS dist_to_ptv_25 real;
 ALTER TABLE DVHs ADD COLUMN IF NOT EXISTS dist_to_ptv_75 real;
 -- The following columns have been added as of DVH Analytics 0.9.7
-ALTER TABLE DVHs ADD COLUMN IF NOT EXISTS integral_dose real;
\ No newline at end of file
+ALTER TABLE DVHs ADD COLUMN IF NOT EXISTS integral_dose real;
+-- The following columns have been added as of DVH Analytics 0.9.8
+ALTER TABLE DVHs ADD COLUMN IF NOT EXISTS dvh_curve bytea;
+-- The following table has been added as of DVH Analytics 0.9.8, the counter is incremented after any data change
+CREATE TABLE IF NOT EXISTS DVHA_Modifications (counter bigint);
+INSERT INTO DVHA_Modifications (counter) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM DVHA_Modifications);
+-- ROI contours are stored separately from DVHs as of DVH Analytics 0.9.8, see db.roi_contours
+CREATE TABLE IF NOT EXISTS DVH_Contours (mrn text, study_instance_uid text, roi_name varchar(50), contours bytea, import_time_stamp timestamp);
+-- Content hashes of each study are stored as of DVH Analytics 0.9.8, see db.delta_sync
+CREATE TABLE IF NOT EXISTS DVHA_Sync (study_instance_uid text, content_hash varchar(64), hash_time_stamp timestamp);
\ No newline at end of file
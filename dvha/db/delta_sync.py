@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# db.delta_sync.py
+"""Content hashes of each study, used to transfer only new or changed studies
+between two DVHA databases"""
+# Copyright (c) 2016-2019 Dan Cutright
+# This file is part of DVH Analytics, released under a BSD license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/cutright/DVH-Analytics
+
+import hashlib
+import numpy as np
+from dvha.db.bulk_copy import BulkCopy, ProgressThrottle
+from dvha.db.sql_connector import SYNC_TABLE
+
+
+# DICOM_Files is not hashed since its file paths are specific to the machine
+# that imported the data, its rows are still transferred with each study
+HASHED_TABLES = ["DVHs", "DVH_Contours", "Plans", "Rxs", "Beams"]
+UIDS_PER_QUERY = 500
+
+
+def normalize_value(value):
+    """Convert a queried value into bytes that are equal for pgsql and sqlite
+
+    Parameters
+    ----------
+    value : any
+        value from a cursor row, not None
+
+    Returns
+    -------
+    bytes
+        representation of ``value`` for hashing
+    """
+    if isinstance(value, memoryview):
+        value = bytes(value)
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, float):
+        # real columns are 4-byte floats in pgsql, 8-byte floats in sqlite
+        value = float(np.float32(value))
+    return str(value).encode()
+
+
+def get_row_digest(columns, row):
+    """Hash the non-NULL values of a row, so that adding a column to the
+    schema does not change the hashes of existing rows
+
+    Parameters
+    ----------
+    columns : list
+        SQL columns of ``row``, sorted
+    row : tuple
+        values from a cursor row
+
+    Returns
+    -------
+    bytes
+        sha256 digest of ``row``
+    """
+    row_hash = hashlib.sha256()
+    for column, value in zip(columns, row):
+        if value is not None:
+            row_hash.update(column.encode() + b"=")
+            value = normalize_value(value)
+            row_hash.update(b"%d:" % len(value) + value)
+    return row_hash.digest()
+
+
+def get_study_hashes(cnx, uids):
+    """Calculate the content hashes of studies, independent of row order
+
+    Parameters
+    ----------
+    cnx : DVH_SQL
+        a DVHA DB connection
+    uids : list
+        study instance uids
+
+    Returns
+    -------
+    dict
+        sha256 hex digest by study instance uid
+    """
+    condition = "study_instance_uid IN ('%s')" % "','".join(uids)
+    digests = {uid: [] for uid in uids}
+    for table in HASHED_TABLES:
+        columns = sorted(cnx.get_column_names(table))
+        if "study_instance_uid" not in columns:
+            continue  # e.g., DVH_Contours of a database older than 0.9.8
+        uid_index = columns.index("study_instance_uid")
+        for rows in cnx.query_iter(table, ",".join(columns), condition):
+            for row in rows:
+                digests[row[uid_index]].append(
+                    table.encode() + get_row_digest(columns, row)
+                )
+
+    study_hashes = {}
+    for uid, row_digests in digests.items():
+        study_hash = hashlib.sha256()
+        for digest in sorted(row_digests):
+            study_hash.update(digest)
+        study_hashes[uid] = study_hash.hexdigest()
+    return study_hashes
+
+
+def update_study_hashes(cnx, batch_size=100, callback=None):
+    """Store the content hashes of studies without a hash in DVHA_Sync, and
+    remove the hashes of deleted studies. Hashes are removed by DVH_SQL when a
+    study is modified, see DVH_SQL.invalidate_study_hashes
+
+    Parameters
+    ----------
+    cnx : DVH_SQL
+        a DVHA DB connection, initialized to 0.9.8 or later
+    batch_size : int, optional
+        number of studies hashed per query and transaction
+    callback : callable, optional
+        called as studies are hashed, should accept table (str), current
+        study (int), total study count (int) as parameters
+
+    Returns
+    -------
+    dict
+        content hash by study instance uid, of every study in the database
+    """
+    # hashes are metadata, so writing them does not mark the data as modified
+    is_modified = cnx.is_modified
+
+    uids = set()
+    for table in cnx.existing_tables:
+        uids.update(cnx.get_unique_values(table, "study_instance_uid"))
+    uids.discard("None")
+
+    hashes = dict(cnx.query(SYNC_TABLE, "study_instance_uid, content_hash"))
+    stale = sorted(set(hashes) - uids)
+    for i in range(0, len(stale), UIDS_PER_QUERY):
+        cnx.execute_str(
+            "DELETE FROM %s WHERE study_instance_uid IN ('%s');"
+            % (SYNC_TABLE, "','".join(stale[i : i + UIDS_PER_QUERY]))
+        )
+    hashes = {uid: hashes[uid] for uid in uids.intersection(hashes)}
+
+    missing = sorted(uids - set(hashes))
+    progress = ProgressThrottle(callback)
+    for i in range(0, len(missing), batch_size):
+        study_hashes = get_study_hashes(cnx, missing[i : i + batch_size])
+        now = cnx.now
+        cnx.insert_values(
+            SYNC_TABLE,
+            ["study_instance_uid", "content_hash", "hash_time_stamp"],
+            [(uid, h, now) for uid, h in study_hashes.items()],
+        )
+        hashes.update(study_hashes)
+        progress(SYNC_TABLE, i + len(study_hashes), len(missing))
+    if missing:
+        progress(SYNC_TABLE, len(missing), len(missing), force=True)
+
+    cnx.is_modified = is_modified
+    return hashes
+
+
+def delta_sync(
+    cnx_src,
+    cnx_dst,
+    callback=None,
+    delete_missing=False,
+    batch_size=2000,
+    workers=1,
+):
+    """Copy the studies of cnx_src that are new or changed compared to
+    cnx_dst. Changed studies are deleted from cnx_dst before being copied
+
+    Parameters
+    ----------
+    cnx_src : DVH_SQL
+        the source DVHA DB connection
+    cnx_dst : DVH_SQL
+        the destination DVHA DB connection
+    callback : callable, optional
+        called as studies are hashed and rows are copied, should accept
+        table (str), current row (int), total_row_count (int) as parameters
+    delete_missing : bool, optional
+        also delete studies from cnx_dst that are not in cnx_src
+    batch_size : int, optional
+        number of rows read and written at a time, see BulkCopy
+    workers : int, optional
+        number of tables to copy in parallel (pgsql destinations only)
+
+    Returns
+    -------
+    dict
+        number of 'new', 'changed', 'deleted', and 'unchanged' studies
+    """
+    for cnx in (cnx_src, cnx_dst):
+        cnx.initialize_database()  # ensure DVHA_Sync exists
+
+    src_hashes = update_study_hashes(cnx_src, callback=callback)
+    dst_hashes = update_study_hashes(cnx_dst, callback=callback)
+
+    new = [uid for uid in src_hashes if uid not in dst_hashes]
+    changed = [
+        uid
+        for uid, content_hash in src_hashes.items()
+        if uid in dst_hashes and dst_hashes[uid] != content_hash
+    ]
+    deleted = []
+    if delete_missing:
+        deleted = [uid for uid in dst_hashes if uid not in src_hashes]
+
+    removed = changed + deleted
+    for i in range(0, len(removed), UIDS_PER_QUERY):
+        cnx_dst.delete_rows(
+            "study_instance_uid IN ('%s')"
+            % "','".join(removed[i : i + UIDS_PER_QUERY])
+        )
+
+    if new or changed:
+        BulkCopy(
+            cnx_src,
+            cnx_dst,
+            callback=callback,
+            force=True,
+            batch_size=batch_size,
+            workers=workers,
+            uids=new + changed,
+        ).run()
+
+    return {
+        "new": len(new),
+        "changed": len(changed),
+        "deleted": len(deleted),
+        "unchanged": len(src_hashes) - len(new) - len(changed),
+    }
@@ -33,6 +33,7 @@ from dvha.tools.roi_formatter import (
 from dvha.tools import roi_geometry as roi_calc
 from mlca.mlc_analyzer import Beam as mlca
 from dvha.db.sql_connector import DVH_SQL
+from dvha.db.dvh_curve import encode_dvh_curve
 
 
 class DICOM_Parser:
@@ -737,10 +738,7 @@ class DICOM_Parser:
                 "min_dose": [dvh.min, "real"],
                 "mean_dose": [dvh.mean, "real"],
                 "max_dose": [dvh.max, "real"],
-                "dvh_string": [
-                    ",".join(["%.5f" % num for num in dvh.counts]),
-                    "text",
-                ],
+                "dvh_curve": [encode_dvh_curve(dvh.counts), "blob"],
                 "roi_coord_string": [geometries["roi_coord_str"], "text"],
                 "dist_to_ptv_min": [None, "real"],
                 "dist_to_ptv_mean": [None, "real"],
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# db.dvh_curve.py
+"""Binary storage of DVH curves, and migration from the legacy dvh_string"""
+# Copyright (c) 2016-2019 Dan Cutright
+# This file is part of DVH Analytics, released under a BSD license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/cutright/DVH-Analytics
+
+import numpy as np
+from dvha.db.sql_connector import DVH_SQL
+from dvha.tools.errors import push_to_log
+
+
+# DVHs are stored in the dvh_curve column as little-endian float32 volumes
+# (cm^3) with 1 cGy bins
+DVH_CURVE_DTYPE = np.dtype("<f4")
+DVH_CURVE_COLUMN = "dvh_curve"
+
+
+def encode_dvh_curve(counts):
+    """Convert a cumulative DVH into the binary format of DVHs.dvh_curve
+
+    Parameters
+    ----------
+    counts : list, np.ndarray
+        DVH volumes in cm^3 with 1 cGy bins
+
+    Returns
+    -------
+    bytes
+        little-endian float32 representation of ``counts``
+
+    """
+    return np.asarray(counts, dtype=DVH_CURVE_DTYPE).tobytes()
+
+
+def decode_dvh_curve(dvh_curve):
+    """Convert a DVHs.dvh_curve value into a numpy array
+
+    Parameters
+    ----------
+    dvh_curve : bytes, memoryview
+        value returned from the dvh_curve column (sqlite returns bytes,
+        psycopg2 returns memoryview)
+
+    Returns
+    -------
+    np.ndarray
+        DVH volumes in cm^3 with 1 cGy bins
+
+    """
+    return np.frombuffer(bytes(dvh_curve), dtype=DVH_CURVE_DTYPE)
+
+
+def is_dvh_curve(value):
+    """Check if a queried value is a non-empty dvh_curve
+
+    Parameters
+    ----------
+    value : any
+        value returned from the dvh_curve column
+
+    Returns
+    -------
+    bool
+        True if ``value`` can be passed into ``decode_dvh_curve``
+
+    """
+    return isinstance(value, (bytes, bytearray, memoryview)) and len(value)
+
+
+def get_dvh_counts(dvh_curve=None, dvh_string=None):
+    """Get a DVH from either storage format, dvh_curve takes priority
+
+    Parameters
+    ----------
+    dvh_curve : bytes, memoryview, optional
+        value from the dvh_curve column
+    dvh_string : str, optional
+        value from the legacy dvh_string column
+
+    Returns
+    -------
+    np.ndarray
+        DVH volumes in cm^3 with 1 cGy bins
+
+    """
+    if is_dvh_curve(dvh_curve):
+        return decode_dvh_curve(dvh_curve)
+    if dvh_string and dvh_string != "None":
+        return np.array(dvh_string.split(","), dtype=float)
+    return np.zeros(1)
+
+
+def get_dvh_counts_ragged(dvh_curves, dvh_strings, bin_width=1):
+    """Get every nth value of many DVHs from either storage format, end to
+    end in one float32 array without padding. dvh_curve takes priority
+
+    Parameters
+    ----------
+    dvh_curves : list
+        values from the dvh_curve column
+    dvh_strings : list
+        values from the legacy dvh_string column
+    bin_width : int, optional
+        keep every nth value
+
+    Returns
+    -------
+    tuple
+        sampled DVH volumes in cm^3 of all DVHs, and the sampled length of
+        each DVH (np.ndarray)
+
+    """
+    lengths, sampled_dvhs = _get_sampled_dvhs(
+        dvh_curves, dvh_strings, bin_width
+    )
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    counts = np.zeros(int(offsets[-1]), dtype=DVH_CURVE_DTYPE)
+    for i, dvh in sampled_dvhs:
+        counts[offsets[i] : offsets[i] + len(dvh)] = dvh
+    return counts, lengths
+
+
+def _get_sampled_dvhs(dvh_curves, dvh_strings, bin_width):
+    """Get the sampled length of each DVH without decoding it, so that the
+    result can be preallocated, and a generator of (index, sampled DVH).
+    DVHs are decoded one at a time, joining them into one np.frombuffer or
+    np.fromstring call was measured to be slower"""
+    is_curve = [bool(is_dvh_curve(c)) for c in dvh_curves]
+    curve_rows = np.flatnonzero(np.array(is_curve, dtype=bool))
+    curves = [dvh_curves[i] for i in curve_rows]
+    curve_lengths = np.array(
+        [len(c) // DVH_CURVE_DTYPE.itemsize for c in curves], dtype=np.int64
+    )
+
+    string_rows = [
+        i
+        for i, (dvh_string, curve) in enumerate(zip(dvh_strings, is_curve))
+        if not curve and dvh_string and dvh_string != "None"
+    ]
+    string_lengths = np.array(
+        [dvh_strings[i].count(",") + 1 for i in string_rows], dtype=np.int64
+    )
+
+    lengths = np.ones(len(dvh_strings), dtype=np.int64)  # missing: zeros(1)
+    lengths[curve_rows] = -(-curve_lengths // bin_width)  # len(c[::bw])
+    lengths[string_rows] = -(-string_lengths // bin_width)
+
+    def sampled_dvhs():
+        for i, dvh_curve in zip(curve_rows, curves):
+            yield i, decode_dvh_curve(dvh_curve)[::bin_width]
+        for i in string_rows:
+            # only the sampled values are converted into floats
+            tokens = dvh_strings[i].split(",")[::bin_width]
+            yield i, np.array(tokens, dtype=float)
+
+    return lengths, sampled_dvhs()
+
+
+def migrate_dvh_strings(
+    cnx=None, clear_dvh_string=False, batch_size=100, callback=None
+):
+    """Encode each DVHs.dvh_string without a dvh_curve into the binary
+    dvh_curve column. This is safe to call repeatedly, only rows missing a
+    dvh_curve are processed.
+
+    Parameters
+    ----------
+    cnx : DVH_SQL, optional
+        connection to DVHA SQL database, uses the stored group 1 connection
+        if not provided
+    clear_dvh_string : bool, optional
+        set dvh_string to NULL after migration to reclaim space
+    batch_size : int, optional
+        number of studies to process per transaction
+    callback : callable, optional
+        optional function to be called after each batch. Should accept
+        current study count (int) and total study count (int) as parameters
+
+    Returns
+    -------
+    int
+        number of DVHs migrated
+
+    """
+    if cnx is None:
+        with DVH_SQL() as cnx:
+            return migrate_dvh_strings(
+                cnx,
+                clear_dvh_string=clear_dvh_string,
+                batch_size=batch_size,
+                callback=callback,
+            )
+
+    cnx.initialize_database()  # ensure dvh_curve column exists
+
+    condition = "dvh_curve IS NULL AND dvh_string IS NOT NULL"
+    if clear_dvh_string:
+        condition = "dvh_string IS NOT NULL"
+    uids = cnx.get_unique_values("DVHs", "study_instance_uid", condition)
+
+    set_str = "dvh_curve = %s" % cnx.placeholder
+    if clear_dvh_string:
+        set_str += ", dvh_string = NULL"
+    update = "UPDATE DVHs SET %s WHERE study_instance_uid = %s AND " \
+             "roi_name = %s" % (set_str, cnx.placeholder, cnx.placeholder)
+
+    migrated_count = 0
+    for i in range(0, len(uids), batch_size):
+        uid_batch = uids[i:i + batch_size]
+        batch_condition = "(%s) AND study_instance_uid IN ('%s')" % (
+            condition,
+            "','".join(uid_batch),
+        )
+        rows = cnx.query(
+            "DVHs",
+            "study_instance_uid, roi_name, dvh_string, dvh_curve",
+            batch_condition,
+        )
+
+        params = []
+        for uid, roi_name, dvh_string, dvh_curve in rows:
+            if not is_dvh_curve(dvh_curve):
+                try:
+                    dvh_curve = encode_dvh_curve(
+                        get_dvh_counts(dvh_string=dvh_string)
+                    )
+                except ValueError as e:
+                    msg = (
+                        "db.dvh_curve.migrate_dvh_strings: Could not parse "
+                        "dvh_string of %s for uid %s" % (roi_name, uid)
+                    )
+                    push_to_log(e, msg=msg)
+                    continue
+            params.append((bytes(dvh_curve), uid, roi_name))
+
+        cnx.cursor.executemany(update, params)
+        cnx.invalidate_study_hashes({p[1] for p in params})
+        cnx.cnx.commit()
+        cnx.is_modified = True
+        migrated_count += len(params)
+
+        if callback is not None:
+            callback(min(i + batch_size, len(uids)), len(uids))
+
+    if clear_dvh_string and migrated_count:
+        cnx.vacuum()
+
+    return migrated_count
@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# db.dvh_store.py
+"""Memory-mapped matrices of normalized DVHs, derived from the DVHs table so
+that queried DVHs can be sliced rather than parsed"""
+# Copyright (c) 2016-2019 Dan Cutright
+# This file is part of DVH Analytics, released under a BSD license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/cutright/DVH-Analytics
+
+from collections import Counter
+import hashlib
+from os import listdir, makedirs, replace, unlink
+from os.path import isdir, isfile, join
+import pickle
+from threading import Lock, RLock
+import numpy as np
+from dvha.db.dvh_curve import get_dvh_counts, get_dvh_counts_ragged
+from dvha.db.sql_connector import DVH_SQL
+from dvha.paths import DVH_STORE_DIR
+from dvha.tools.errors import push_to_log
+
+
+# Each bin width has its own float32 matrix (dvhs_<bin width>_<n>.npy), with
+# one row per DVH. Rows are DVHs sampled at the bin width and normalized to
+# their max (as in models.dvh.DVH), zero padded to the matrix width. Rows are
+# shared by all bin widths and indexed by (study_instance_uid, roi_name) in
+# index.pickle. The rows of a bin width are filled when first queried (a
+# length of -1 marks a row not yet filled). Matrices are re-written under a
+# new file name when they grow, so that arrays sliced from the previous file
+# remain valid.
+DVH_STORE_DTYPE = np.dtype("<f4")
+INDEX_FILE = "index.pickle"
+INDEX_VERSION = 1
+MIN_CAPACITY = 1024
+WIDTH_STEP = 64
+BATCH_SIZE = 100  # studies per query when reading DVHs from SQL
+
+
+class DVHStore:
+    """Memory-mapped DVH matrices for one database. Use get_dvh_store rather
+    than creating this directly, so that each database has one instance
+
+    Parameters
+    ----------
+    store_dir : str
+        directory of the index and matrices
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self._lock = RLock()
+        self._maps = {}  # read-only memmaps by file name
+        self._index = self._load_index()
+
+    # ------------------------------------------------------------------
+    # Reading
+    # ------------------------------------------------------------------
+    def get_ragged_dvhs(self, keys, bin_width):
+        """Get the normalized DVHs of (study_instance_uid, roi_name) keys,
+        end to end without the zero padding of the matrix
+
+        Parameters
+        ----------
+        keys : list
+            (study_instance_uid, roi_name) tuples
+        bin_width : int
+            every nth value of each DVH (i.e., models.dvh.DVH.dvh_bin_width)
+
+        Returns
+        -------
+        tuple, None
+            values of all DVHs (np.ndarray), and the length of each DVH
+            (np.ndarray), None if any key is not in the store or
+            ``bin_width`` has not been synced
+        """
+        selection = self._get_rows(keys, bin_width)
+        if selection is None:
+            return None
+        rows, lengths, data = selection
+        lengths = lengths.astype(np.int64)
+
+        values = np.empty(int(np.sum(lengths)), dtype=DVH_STORE_DTYPE)
+        position = 0
+        step = max(1, 2 ** 22 // max(1, int(np.max(lengths))))
+        for start in range(0, len(rows), step):
+            block_lengths = lengths[start:start + step]
+            block = data[rows[start:start + step], : int(block_lengths.max())]
+            is_dvh = np.arange(block.shape[1]) < block_lengths[:, np.newaxis]
+            end = position + int(np.sum(block_lengths))
+            values[position:end] = block[is_dvh]
+            position = end
+        return values, lengths
+
+    def _get_rows(self, keys, bin_width):
+        """Get the matrix rows and DVH lengths of keys, and the memory-mapped
+        matrix of a bin width, None if any key is not stored"""
+        with self._lock:
+            matrix = self._index["matrices"].get(bin_width)
+            if matrix is None or not keys:
+                return None
+            try:
+                rows = np.array(
+                    [self._index["rows"][key][0] for key in keys],
+                    dtype=np.int64,
+                )
+            except KeyError:
+                return None
+            lengths = matrix["lengths"][rows]
+            if np.any(lengths < 0):
+                return None
+            return rows, lengths, self._get_map(matrix["file"])
+
+    @property
+    def count(self):
+        """Number of DVHs in the store"""
+        with self._lock:
+            return len(self._index["rows"])
+
+    def _get_map(self, file_name):
+        if file_name not in self._maps:
+            self._maps[file_name] = np.load(
+                join(self.store_dir, file_name), mmap_mode="r"
+            )
+        return self._maps[file_name]
+
+    # ------------------------------------------------------------------
+    # Syncing
+    # ------------------------------------------------------------------
+    def sync(self, cnx, bin_widths=None, keys=None):
+        """Incrementally apply imports, deletions, and re-imports in the DVHs
+        table to the store, and fill the rows of ``keys`` at ``bin_widths``.
+        Only DVHs of new studies and of ``keys`` not yet filled are read from
+        the DVHs table
+
+        Parameters
+        ----------
+        cnx : DVH_SQL
+            connection to the database of this store
+        bin_widths : list, optional
+            bin widths to add to the store, if not already stored
+        keys : list, optional
+            (study_instance_uid, roi_name) tuples to fill at ``bin_widths``,
+            e.g., the DVHs of a query
+
+        Returns
+        -------
+        int
+            number of DVHs read from the DVHs table
+        """
+        with self._lock:
+            index = self._index
+            bin_widths = list(bin_widths or [])
+            new_bin_widths = [
+                bw for bw in bin_widths if bw not in index["matrices"]
+            ]
+            state = cnx.get_modification_state()
+            is_changed = index["state"] != state or bool(new_bin_widths)
+
+            read_count = 0
+            try:
+                if index["state"] != state:
+                    read_count += self._sync_rows(cnx)
+                for bin_width in new_bin_widths:
+                    self._add_bin_width(bin_width)
+                for bin_width in bin_widths:
+                    read_count += self._fill_unfilled(
+                        cnx, keys or [], bin_width
+                    )
+            except Exception:
+                # matrices are only appended to or re-written under a new
+                # file name, so the saved index is still valid
+                self._index = self._load_index()
+                raise
+
+            if is_changed or read_count:
+                index["state"] = state
+                self._save_index()
+                self._delete_unused_files()
+            return read_count
+
+    def _sync_rows(self, cnx):
+        """Drop deleted or re-imported DVHs, and append new DVHs"""
+        index = self._index
+        db_rows = cnx.query(
+            "DVHs", "study_instance_uid, roi_name, import_time_stamp"
+        )
+        key_counts = Counter((row[0], row[1]) for row in db_rows)
+        # (uid, roi_name) does not identify duplicated rois, these are
+        # excluded so that DVH parses them from SQL instead
+        time_stamps = {
+            (uid, roi_name): str(time_stamp)
+            for uid, roi_name, time_stamp in db_rows
+            if key_counts[(uid, roi_name)] == 1
+        }
+
+        for key, (row, time_stamp) in list(index["rows"].items()):
+            if time_stamps.get(key) != time_stamp:
+                index["rows"].pop(key)
+
+        added = [key for key in time_stamps if key not in index["rows"]]
+        if not index["matrices"] or not added:
+            for key in added:
+                index["rows"][key] = (None, time_stamps[key])
+            self._compact_if_sparse()
+            return 0
+
+        self._compact_if_sparse()
+        self._reserve(index["row_count"] + len(added))
+        for row, key in enumerate(added, index["row_count"]):
+            index["rows"][key] = (row, time_stamps[key])
+        index["row_count"] += len(added)
+        return self._fill(cnx, added, list(index["matrices"]))
+
+    def _add_bin_width(self, bin_width):
+        """Create the matrix of a new bin width, with no rows filled"""
+        index = self._index
+        if not index["matrices"]:
+            # keys may have been recorded without rows, see _sync_rows
+            keys = list(index["rows"])
+            for row, key in enumerate(keys):
+                index["rows"][key] = (row, index["rows"][key][1])
+            index["row_count"] = len(keys)
+            index["capacity"] = max(MIN_CAPACITY, 2 * len(keys))
+
+        index["matrices"][bin_width] = {
+            "file": self._create_file(
+                bin_width, index["capacity"], WIDTH_STEP
+            ),
+            "width": WIDTH_STEP,
+            "lengths": np.full(index["capacity"], -1, dtype=np.int32),
+        }
+
+    def _fill_unfilled(self, cnx, keys, bin_width):
+        """Fill the rows of keys not yet filled at a bin width"""
+        rows = self._index["rows"]
+        lengths = self._index["matrices"][bin_width]["lengths"]
+        unfilled = [
+            key for key in keys if key in rows and lengths[rows[key][0]] < 0
+        ]
+        if not unfilled:
+            return 0
+        return self._fill(cnx, unfilled, [bin_width])
+
+    def _fill(self, cnx, keys, bin_widths):
+        """Read the DVHs of keys from SQL and write them into their rows"""
+        rows = self._index["rows"]
+        keys_by_uid = {}
+        for key in keys:
+            keys_by_uid.setdefault(key[0], set()).add(key[1])
+        uids = sorted(keys_by_uid)
+
+        read_count = 0
+        for i in range(0, len(uids), BATCH_SIZE):
+            condition = "study_instance_uid IN ('%s')" % "','".join(
+                uids[i:i + BATCH_SIZE]
+            )
+            batch = {bw: ([], []) for bw in bin_widths}
+            for uid, roi_name, dvh_curve, dvh_string in cnx.query(
+                "DVHs",
+                "study_instance_uid, roi_name, dvh_curve, dvh_string",
+                condition,
+            ):
+                if roi_name not in keys_by_uid[uid]:
+                    continue
+                try:
+                    counts = get_dvh_counts(dvh_curve, dvh_string)
+                except ValueError as e:
+                    msg = (
+                        "DVHStore: Could not parse the DVH of %s for uid %s"
+                        % (roi_name, uid)
+                    )
+                    push_to_log(e, msg=msg)
+                    rows.pop((uid, roi_name))
+                    continue
+                read_count += 1
+                for bw in bin_widths:
+                    batch[bw][0].append(rows[(uid, roi_name)][0])
+                    batch[bw][1].append(get_normalized_dvh(counts, bw))
+
+            for bw, (row_indices, dvhs) in batch.items():
+                self._write_rows(bw, row_indices, dvhs)
+        return read_count
+
+    def _write_rows(self, bin_width, row_indices, dvhs):
+        if not dvhs:
+            return
+        matrix = self._index["matrices"][bin_width]
+        width = max(len(dvh) for dvh in dvhs)
+        if width > matrix["width"]:
+            width = WIDTH_STEP * int(np.ceil(width / WIDTH_STEP))
+            self._rewrite(bin_width, self._index["capacity"], width)
+
+        data = self._open(matrix["file"])
+        for row, dvh in zip(row_indices, dvhs):
+            data[row, : len(dvh)] = dvh
+            data[row, len(dvh):] = 0
+            matrix["lengths"][row] = len(dvh)
+        data.flush()
+        del data
+
+    # ------------------------------------------------------------------
+    # File management
+    # ------------------------------------------------------------------
+    def _reserve(self, row_count):
+        """Grow each matrix to at least row_count rows"""
+        capacity = self._index["capacity"]
+        if row_count <= capacity:
+            return
+        while capacity < row_count:
+            capacity *= 2
+        for bin_width, matrix in self._index["matrices"].items():
+            self._rewrite(bin_width, capacity, matrix["width"])
+        self._index["capacity"] = capacity
+
+    def _compact_if_sparse(self):
+        """Remove rows of deleted DVHs, if they outnumber the stored DVHs"""
+        index = self._index
+        live = [(row, key) for key, (row, _) in index["rows"].items()]
+        live = sorted(i for i in live if i[0] is not None)
+        dead_count = index["row_count"] - len(live)
+        if dead_count < max(MIN_CAPACITY, len(live)):
+            return
+
+        old_rows = np.array([row for row, _ in live], dtype=np.int64)
+        for bin_width, matrix in index["matrices"].items():
+            self._rewrite(
+                bin_width, index["capacity"], matrix["width"], old_rows
+            )
+        for new_row, (_, key) in enumerate(live):
+            index["rows"][key] = (new_row, index["rows"][key][1])
+        index["row_count"] = len(live)
+
+    def _rewrite(self, bin_width, capacity, width, old_rows=None):
+        """Copy a matrix into a new file of shape (capacity, width). If
+        old_rows is provided, only these rows are copied, in order"""
+        matrix = self._index["matrices"][bin_width]
+        old = self._open(matrix["file"], mode="r")
+        file_name = self._create_file(bin_width, capacity, width)
+        new = self._open(file_name)
+
+        if old_rows is None:
+            old_rows = np.arange(self._index["row_count"])
+        columns = min(width, old.shape[1])
+        step = max(1, 2 ** 24 // max(1, columns))  # ~64 MB of float32
+        for start in range(0, len(old_rows), step):
+            selection = old_rows[start:start + step]
+            new[start:start + len(selection), :columns] = old[
+                selection, :columns
+            ]
+        new.flush()
+        del old, new
+
+        lengths = np.full(capacity, -1, dtype=np.int32)
+        lengths[: len(old_rows)] = matrix["lengths"][old_rows]
+        matrix.update(file=file_name, width=width, lengths=lengths)
+
+    def _create_file(self, bin_width, capacity, width):
+        self._index["file_counter"] += 1
+        file_name = "dvhs_%s_%s.npy" % (bin_width, self._index["file_counter"])
+        data = np.lib.format.open_memmap(
+            join(self.store_dir, file_name),
+            mode="w+",
+            dtype=DVH_STORE_DTYPE,
+            shape=(capacity, width),
+        )
+        del data
+        return file_name
+
+    def _open(self, file_name, mode="r+"):
+        return np.load(join(self.store_dir, file_name), mmap_mode=mode)
+
+    def _delete_unused_files(self):
+        """Delete matrices replaced by _rewrite. On Windows, files still
+        mapped by a previous DVH object are deleted on a later call"""
+        used = {m["file"] for m in self._index["matrices"].values()}
+        for file_name in listdir(self.store_dir):
+            if file_name.endswith(".npy") and file_name not in used:
+                self._maps.pop(file_name, None)
+                try:
+                    unlink(join(self.store_dir, file_name))
+                except OSError:
+                    pass
+
+    def _load_index(self):
+        file_path = join(self.store_dir, INDEX_FILE)
+        if isfile(file_path):
+            try:
+                with open(file_path, "rb") as infile:
+                    index = pickle.load(infile)
+                if index.get("version") == INDEX_VERSION and all(
+                    isfile(join(self.store_dir, m["file"]))
+                    for m in index["matrices"].values()
+                ):
+                    return index
+            except Exception as e:
+                push_to_log(e, msg="DVHStore: Could not load %s" % file_path)
+
+        if not isdir(self.store_dir):
+            makedirs(self.store_dir)
+        return {
+            "version": INDEX_VERSION,
+            "state": None,
+            "rows": {},  # (uid, roi_name): (row, import_time_stamp)
+            "row_count": 0,
+            "capacity": MIN_CAPACITY,
+            "matrices": {},  # bin_width: {"file", "width", "lengths"}
+            "file_counter": 0,
+        }
+
+    def _save_index(self):
+        file_path = join(self.store_dir, INDEX_FILE)
+        with open(file_path + ".tmp", "wb") as outfile:
+            pickle.dump(self._index, outfile, pickle.HIGHEST_PROTOCOL)
+        replace(file_path + ".tmp", file_path)
+
+    def clear(self):
+        """Remove all DVHs, the store is rebuilt on the next sync"""
+        with self._lock:
+            self._maps.clear()
+            self._index["matrices"] = {}
+            self._index["rows"] = {}
+            self._index["row_count"] = 0
+            self._index["state"] = None
+            self._save_index()
+            self._delete_unused_files()
+
+
+def get_normalized_dvh(counts, bin_width):
+    """Sample a DVH at a bin width and normalize it to its max, as stored in
+    DVHStore matrices
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        DVH volumes with 1 cGy bins (see db.dvh_curve.get_dvh_counts)
+    bin_width : int
+        keep every nth value
+
+    Returns
+    -------
+    np.ndarray
+        sampled and normalized DVH
+    """
+    dvh = np.asarray(counts, dtype=float)[::bin_width]
+    dvh_max = np.max(dvh)
+    if dvh_max > 0:
+        dvh = np.divide(dvh, dvh_max)
+    return dvh
+
+
+def get_normalized_dvh_ragged(dvh_curves, dvh_strings, bin_width):
+    """Sample many DVHs at a bin width and normalize them to their max, as
+    get_normalized_dvh, end to end without zero padding
+
+    Parameters
+    ----------
+    dvh_curves : list
+        values from the dvh_curve column
+    dvh_strings : list
+        values from the legacy dvh_string column
+    bin_width : int
+        keep every nth value
+
+    Returns
+    -------
+    tuple
+        sampled and normalized values of all DVHs with the dtype of DVHStore
+        matrices, and the length of each DVH (np.ndarray)
+    """
+    dvhs, lengths = get_dvh_counts_ragged(dvh_curves, dvh_strings, bin_width)
+    dvhs = dvhs.astype(DVH_STORE_DTYPE, copy=False)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))[lengths > 0]
+    if len(starts):
+        dvh_max = np.maximum.reduceat(dvhs, starts)
+        dvh_max[~(dvh_max > 0)] = 1.0  # as get_normalized_dvh
+        dvh_lengths = lengths[lengths > 0]
+        # divided in blocks of DVHs, rather than repeating dvh_max for every
+        # value at once
+        position = 0
+        step = max(1, 2 ** 22 // max(1, int(np.max(dvh_lengths))))
+        for start in range(0, len(starts), step):
+            block_lengths = dvh_lengths[start:start + step]
+            end = position + int(np.sum(block_lengths))
+            dvhs[position:end] /= np.repeat(
+                dvh_max[start:start + step], block_lengths
+            )
+            position = end
+    return dvhs, lengths
+
+
+_stores = {}
+_stores_lock = Lock()
+
+
+def get_dvh_store(cnx):
+    """Get the DVHStore of a connection's database
+
+    Parameters
+    ----------
+    cnx : DVH_SQL
+        connection to a DVHA database
+
+    Returns
+    -------
+    DVHStore
+        the store under paths.DVH_STORE_DIR for this database
+    """
+    store_key = hashlib.sha256(repr(cnx.pool_key).encode()).hexdigest()[:16]
+    with _stores_lock:
+        if store_key not in _stores:
+            _stores[store_key] = DVHStore(join(DVH_STORE_DIR, store_key))
+        return _stores[store_key]
+
+
+def sync_dvh_store(group=1):
+    """Apply changes in a group's DVHs table to its DVHStore, e.g., after an
+    import. Only bin widths already in the store are updated
+
+    Parameters
+    ----------
+    group : int, optional
+        either 1 or 2
+
+    Returns
+    -------
+    int
+        number of DVHs read from the DVHs table
+    """
+    try:
+        with DVH_SQL(group=group) as cnx:
+            return get_dvh_store(cnx).sync(cnx)
+    except Exception as e:
+        push_to_log(e, msg="DVHStore: sync failed")
+        return 0
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# db.roi_contours.py
+"""Binary storage of ROI contours in the DVH_Contours table, and migration
+from the legacy DVHs.roi_coord_string"""
+# Copyright (c) 2016-2019 Dan Cutright
+# This file is part of DVH Analytics, released under a BSD license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/cutright/DVH-Analytics
+
+import numpy as np
+from dvha.db.sql_connector import DVH_SQL
+from dvha.tools.errors import push_to_log
+from dvha.tools.roi_formatter import get_planes_from_string
+
+
+# DVH_Contours.contours layout (little-endian):
+#     uint32 contour count
+#     (float32 z, uint32 point count) for each contour
+#     float32 x, y for each point of each contour
+CONTOURS_TABLE = "DVH_Contours"
+CONTOUR_COUNT_DTYPE = np.dtype("<u4")
+CONTOUR_HEADER_DTYPE = np.dtype([("z", "<f4"), ("point_count", "<u4")])
+CONTOUR_POINT_DTYPE = np.dtype("<f4")
+
+# x, y are rounded to this many decimals in roi_coord_string, rounding the
+# decoded float32 values again reproduces the legacy coordinates
+COORDINATE_DECIMALS = 3
+
+
+def encode_contours(planes):
+    """Convert a "sets of points" dictionary into the binary format of
+    DVH_Contours.contours
+
+    Parameters
+    ----------
+    planes : dict
+        a "sets of points" formatted dictionary, see tools.roi_formatter
+
+    Returns
+    -------
+    bytes
+        binary representation of ``planes``
+
+    """
+    headers, points = [], []
+    for z, polygons in planes.items():
+        for polygon in polygons:
+            headers.append((float(z), len(polygon)))
+            points.extend((point[0], point[1]) for point in polygon)
+
+    return b"".join(
+        [
+            np.array(len(headers), dtype=CONTOUR_COUNT_DTYPE).tobytes(),
+            np.array(headers, dtype=CONTOUR_HEADER_DTYPE).tobytes(),
+            np.array(points, dtype=CONTOUR_POINT_DTYPE).tobytes(),
+        ]
+    )
+
+
+def encode_roi_coord_string(roi_coord_string):
+    """Convert a legacy roi_coord_string into the binary format of
+    DVH_Contours.contours
+
+    Parameters
+    ----------
+    roi_coord_string : str
+        roi string representation of an roi as formatted in the SQL database
+
+    Returns
+    -------
+    bytes, None
+        binary representation of the contours, None if the string is empty
+
+    """
+    if not roi_coord_string or roi_coord_string == "None":
+        return None
+    return encode_contours(get_planes_from_string(roi_coord_string))
+
+
+def decode_contours(contours):
+    """Convert a DVH_Contours.contours value into a "sets of points"
+    dictionary, equivalent to tools.roi_formatter.get_planes_from_string
+
+    Parameters
+    ----------
+    contours : bytes, memoryview
+        value returned from the contours column
+
+    Returns
+    -------
+    dict
+        a "sets of points" formatted dictionary
+
+    """
+    contours = bytes(contours)
+    count = int(np.frombuffer(contours, CONTOUR_COUNT_DTYPE, count=1)[0])
+    offset = CONTOUR_COUNT_DTYPE.itemsize
+    headers = np.frombuffer(
+        contours, CONTOUR_HEADER_DTYPE, count=count, offset=offset
+    )
+    offset += headers.nbytes
+    points = np.frombuffer(contours, CONTOUR_POINT_DTYPE, offset=offset)
+    points = np.round(points.astype(float), COORDINATE_DECIMALS).reshape(-1, 2)
+
+    planes = {}
+    start = 0
+    for z, point_count in headers.tolist():
+        z = round(z, 2)
+        xy = points[start:start + point_count].tolist()
+        start += point_count
+        planes.setdefault(str(z), []).append([[x, y, z] for x, y in xy])
+    return planes
+
+
+def get_contours_row(dvh_row):
+    """Move the roi_coord_string of a DVHs row (as returned by
+    DICOM_Parser.get_dvh_row) into a new DVH_Contours row
+
+    Parameters
+    ----------
+    dvh_row : dict
+        DVHs row, each column is stored as [value, sql_type]. The
+        roi_coord_string column is removed
+
+    Returns
+    -------
+    dict
+        DVH_Contours row, in the same format as ``dvh_row``
+
+    """
+    roi_coord_string = dvh_row.pop("roi_coord_string", [None])[0]
+    return {
+        "mrn": dvh_row["mrn"],
+        "study_instance_uid": dvh_row["study_instance_uid"],
+        "roi_name": dvh_row["roi_name"],
+        "contours": [encode_roi_coord_string(roi_coord_string), "blob"],
+        "import_time_stamp": [None, "timestamp"],
+    }
+
+
+def get_roi_planes(study_instance_uid, roi_name, cnx=None):
+    """Load the contours of an ROI
+
+    Parameters
+    ----------
+    study_instance_uid : str
+        study instance uid
+    roi_name : str
+        name of roi
+    cnx : DVH_SQL, optional
+        use this connection rather than creating a new one
+
+    Returns
+    -------
+    dict, None
+        a "sets of points" formatted dictionary, None if the ROI has no
+        contours
+
+    """
+    return get_study_planes(study_instance_uid, [roi_name], cnx=cnx).get(
+        roi_name
+    )
+
+
+def get_study_planes(study_instance_uid, roi_names, cnx=None):
+    """Load the contours of several ROIs of a study. ROIs not yet migrated
+    to DVH_Contours are read from DVHs.roi_coord_string
+
+    Parameters
+    ----------
+    study_instance_uid : str
+        study instance uid
+    roi_names : list
+        names of rois
+    cnx : DVH_SQL, optional
+        use this connection rather than creating a new one
+
+    Returns
+    -------
+    dict
+        "sets of points" formatted dictionaries by roi name, ROIs without
+        contours are excluded
+
+    """
+    if cnx is None:
+        with DVH_SQL() as cnx:
+            return get_study_planes(study_instance_uid, roi_names, cnx=cnx)
+
+    roi_names = list(roi_names)
+    if not roi_names:
+        return {}
+    condition = "study_instance_uid = '%s' and roi_name in ('%s')" % (
+        study_instance_uid,
+        "','".join(roi_names),
+    )
+
+    planes = {}
+    if cnx.has_table(CONTOURS_TABLE):  # missing before 0.9.8, if not migrated
+        for roi_name, contours in cnx.query(
+            CONTOURS_TABLE, "roi_name, contours", condition
+        ):
+            if contours is not None and len(contours):
+                planes[roi_name] = decode_contours(contours)
+
+    if len(planes) < len(set(roi_names)):
+        legacy_condition = "%s and roi_coord_string is not null" % condition
+        for roi_name, roi_coord_string in cnx.query(
+            "DVHs", "roi_name, roi_coord_string", legacy_condition
+        ):
+            if roi_name not in planes and roi_coord_string:
+                planes[roi_name] = get_planes_from_string(roi_coord_string)
+
+    return planes
+
+
+def migrate_roi_coord_strings(
+    cnx=None, clear_roi_coord_string=False, batch_size=100, callback=None
+):
+    """Encode each DVHs.roi_coord_string without a DVH_Contours row into the
+    binary DVH_Contours table. This is safe to call repeatedly, only ROIs
+    missing from DVH_Contours are processed.
+
+    Parameters
+    ----------
+    cnx : DVH_SQL, optional
+        connection to DVHA SQL database, uses the stored group 1 connection
+        if not provided
+    clear_roi_coord_string : bool, optional
+        set roi_coord_string to NULL after migration to reclaim space
+    batch_size : int, optional
+        number of studies to process per transaction
+    callback : callable, optional
+        optional function to be called after each batch. Should accept
+        current study count (int) and total study count (int) as parameters
+
+    Returns
+    -------
+    int
+        number of ROIs migrated
+
+    """
+    if cnx is None:
+        with DVH_SQL() as cnx:
+            return migrate_roi_coord_strings(
+                cnx,
+                clear_roi_coord_string=clear_roi_coord_string,
+                batch_size=batch_size,
+                callback=callback,
+            )
+
+    cnx.initialize_database()  # ensure DVH_Contours exists
+
+    condition = "roi_coord_string IS NOT NULL"
+    uids = cnx.get_unique_values("DVHs", "study_instance_uid", condition)
+
+    columns = [
+        "mrn",
+        "study_instance_uid",
+        "roi_name",
+        "contours",
+        "import_time_stamp",
+    ]
+    clear = (
+        "UPDATE DVHs SET roi_coord_string = NULL WHERE study_instance_uid = "
+        "%s AND roi_name = %s" % (cnx.placeholder, cnx.placeholder)
+    )
+
+    migrated_count = 0
+    for i in range(0, len(uids), batch_size):
+        uid_condition = "study_instance_uid IN ('%s')" % "','".join(
+            uids[i:i + batch_size]
+        )
+        existing = set(
+            cnx.query(CONTOURS_TABLE, "study_instance_uid, roi_name",
+                      uid_condition)
+        )
+        rows = cnx.query(
+            "DVHs",
+            "mrn, study_instance_uid, roi_name, roi_coord_string, "
+            "import_time_stamp",
+            "(%s) AND %s" % (condition, uid_condition),
+        )
+
+        params, migrated = [], list(existing)
+        for mrn, uid, roi_name, roi_coord_string, time_stamp in rows:
+            if (uid, roi_name) in existing:
+                continue
+            try:
+                contours = encode_roi_coord_string(roi_coord_string)
+            except ValueError as e:
+                msg = (
+                    "db.roi_contours.migrate_roi_coord_strings: Could not "
+                    "parse roi_coord_string of %s for uid %s" % (roi_name, uid)
+                )
+                push_to_log(e, msg=msg)
+                continue
+            time_stamp = None if time_stamp is None else str(time_stamp)
+            params.append((mrn, uid, roi_name, contours, time_stamp))
+            migrated.append((uid, roi_name))
+
+        if params:
+            cnx.insert_values(CONTOURS_TABLE, columns, params, commit=False)
+        if clear_roi_coord_string and migrated:
+            cnx.cursor.executemany(clear, migrated)
+            cnx.invalidate_study_hashes({m[0] for m in migrated})
+        cnx.cnx.commit()
+        cnx.is_modified = True
+        migrated_count += len(params)
+
+        if callback is not None:
+            callback(min(i + batch_size, len(uids)), len(uids))
+
+    if clear_roi_coord_string and uids:
+        cnx.vacuum()
+
+    return migrated_count
@@ -10,17 +10,55 @@
 
 from wx import CallAfter
 import psycopg2
+from psycopg2.extras import execute_values
 import sqlite3
 from datetime import datetime
+from itertools import count
+import re
 from dateutil.parser import parse as date_parser
-from os.path import dirname, join, isfile
+from os.path import isfile
+from shutil import copyfileobj
+from tempfile import TemporaryFile
+from time import perf_counter
+from dvha.db.connection_pool import CONNECTION_POOL
 from dvha.db.sql_columns import categorical, numerical
-from dvha.options import Options
-from dvha.paths import CREATE_PGSQL_TABLES, CREATE_SQLITE_TABLES, DATA_DIR
+from dvha.db.sql_profiler import SQL_PROFILER
+from dvha.options import get_stored_sql_settings
+from dvha.paths import (
+    CREATE_INDEXES,
+    CREATE_PGSQL_TABLES,
+    CREATE_SQLITE_TABLES,
+)
 from dvha.tools.errors import SQLError, push_to_log
 import json
 
 
+# Representative queries from db.update, db.roi_contours, models.dvh,
+# models.import_dicom, and DatabaseROIs.remap_rois, see DVH_SQL.check_index_usage
+INDEXED_QUERIES = [
+    "SELECT roi_name FROM DVHs WHERE study_instance_uid = 'uid';",
+    "SELECT roi_type FROM DVHs WHERE study_instance_uid = 'uid' "
+    "AND roi_name = 'roi';",
+    "SELECT contours FROM DVH_Contours WHERE study_instance_uid = 'uid' "
+    "AND roi_name = 'roi';",
+    "SELECT roi_name FROM DVHs WHERE physician_roi = 'roi';",
+    "SELECT study_instance_uid FROM DVHs WHERE roi_type = 'PTV';",
+    "SELECT study_instance_uid FROM DVHs WHERE mrn = 'mrn';",
+    "SELECT rx_dose FROM Plans WHERE study_instance_uid = 'uid';",
+    "SELECT fx_dose FROM Rxs WHERE study_instance_uid = 'uid';",
+    "SELECT beam_number FROM Beams WHERE study_instance_uid = 'uid';",
+    "SELECT folder_path FROM DICOM_Files WHERE study_instance_uid = 'uid';",
+]
+
+# Content hashes of each study, see db.delta_sync
+SYNC_TABLE = "DVHA_Sync"
+
+# e.g., "roi_name = 'x' and study_instance_uid = 'uid'", conditions containing
+# OR are resolved with a query instead
+UID_CONDITION = re.compile(r"study_instance_uid\s*=\s*'([^']*)'", re.I)
+OR_CONDITION = re.compile(r"\bor\b", re.I)
+
+
 class DVH_SQL:
     """This class is used to communicate to the SQL database
 
@@ -33,42 +71,51 @@ class DVH_SQL:
         either 'pgsql' or 'sqlite'
     group : int, optional
         use a group-specific connection, either 1 or 2
+    pooled : bool, optional
+        use a connection from the process-wide connection pool
     """
 
-    def __init__(self, *config, db_type=None, group=1):
+    cursor_ids = count()  # used to name server-side cursors of query_iter
 
-        stored_options = Options()
+    def __init__(self, *config, db_type=None, group=1, pooled=True):
 
         if config:
             self.db_type = db_type if db_type is not None else "pgsql"
             config = config[0]
         else:
             # Read SQL configuration file
-            if group == 2 and stored_options.SYNC_SQL_CNX:
+            stored_options = get_stored_sql_settings()
+            if group == 2 and stored_options["SYNC_SQL_CNX"]:
                 group = 1
             self.db_type = (
-                stored_options.DB_TYPE_GRPS[group]
+                stored_options["DB_TYPE_GRPS"][group]
                 if db_type is None
                 else db_type
             )
-            config = stored_options.SQL_LAST_CNX_GRPS[group][self.db_type]
+            config = stored_options["SQL_LAST_CNX_GRPS"][group][self.db_type]
 
         self.config = config
+        self.db_name = None if self.db_type == "sqlite" else config["dbname"]
 
-        if self.db_type == "sqlite":
-            db_file_path = config["host"]
-            if not dirname(
-                db_file_path
-            ):  # file_path has not directory, assume it lives in DATA_DIR
-                db_file_path = join(DATA_DIR, db_file_path)
-            self.db_name = None
-            self.cnx = sqlite3.connect(db_file_path)
+        self.pool_key = CONNECTION_POOL.get_key(self.db_type, config)
+        self.pooled = pooled
+        if pooled:
+            self.cnx = CONNECTION_POOL.checkout(self.db_type, config)
         else:
-            self.db_name = config["dbname"]
-            self.cnx = psycopg2.connect(**config)
+            self.cnx = CONNECTION_POOL.connect(self.db_type, config)
 
         self.cursor = self.cnx.cursor()
-        self.tables = ["DVHs", "Plans", "Rxs", "Beams", "DICOM_Files"]
+        self.tables = [
+            "DVHs",
+            "DVH_Contours",
+            "Plans",
+            "Rxs",
+            "Beams",
+            "DICOM_Files",
+        ]
+
+        # Set by methods that write data, see increment_modification_counter
+        self.is_modified = False
 
     def __enter__(self):
         return self
@@ -77,8 +124,17 @@ class DVH_SQL:
         self.close()
 
     def close(self):
-        """Close the SQL DB connection"""
-        self.cnx.close()
+        """Close the SQL DB connection, pooled connections are returned to
+        the connection pool"""
+        if self.cnx is None:
+            return
+        if self.is_modified:
+            self.increment_modification_counter()
+        if self.pooled:
+            CONNECTION_POOL.checkin(self.cnx)
+        else:
+            self.cnx.close()
+        self.cnx = None
 
     def execute_file(self, sql_file_name):
         """Executes lines within provided text file to SQL
@@ -94,6 +150,7 @@ class DVH_SQL:
             if not line.startswith("--"):  # ignore commented lines
                 self.cursor.execute(line)
         self.cnx.commit()
+        self.clear_schema_cache()  # e.g., CREATE TABLE
 
     def execute_str(self, command_str):
         """Execute and commit a string in proper SQL syntax, can handle
@@ -105,9 +162,14 @@ class DVH_SQL:
             command or commands to be executed and committed
 
         """
+        self.is_modified = True
         for line in command_str.split("\n"):
             if line:
+                start = perf_counter()
                 self.cursor.execute(line)
+                SQL_PROFILER.record(
+                    line, perf_counter() - start, self.cursor.rowcount
+                )
         self.cnx.commit()
 
     def check_table_exists(self, table_name):
@@ -156,43 +218,133 @@ class DVH_SQL:
             Returns a list of lists by default, or a dict of lists if
             bokeh_cds in kwargs and is true
         """
-        order, order_by = None, None
-        if kwargs:
-            if "order" in kwargs:
-                order = kwargs["order"]
-            if "order_by" in kwargs:
-                order_by = kwargs["order_by"]
-                if not order:
-                    order = "ASC"
-
-        query = "Select %s from %s;" % (return_col_str, table_name)
-        if condition_str and condition_str[0]:
-            query = "Select %s from %s where %s;" % (
-                return_col_str,
-                table_name,
-                condition_str[0],
-            )
-        if order and order_by:
-            query = "%s Order By %s %s;" % (query[:-1], order_by, order)
+        query = self.get_query_str(
+            table_name,
+            return_col_str,
+            *condition_str,
+            order=kwargs.get("order"),
+            order_by=kwargs.get("order_by"),
+        )
 
         try:
+            start = perf_counter()
             self.cursor.execute(query)
             results = self.cursor.fetchall()
+            SQL_PROFILER.record(query, perf_counter() - start, len(results))
         except Exception as e:
             raise SQLError(str(e), query)
 
         if "bokeh_cds" in kwargs and kwargs["bokeh_cds"]:
-            keys = [c.strip() for c in return_col_str.split(",")]
-            results = {
-                key: [results[r][i] for r in range(len(results))]
-                for i, key in enumerate(keys)
-            }
-            for key in list(results):
-                if "time" in key or "date" in key:
-                    results[key] = [str(value) for value in results[key]]
+            results = rows_to_cds(results, return_col_str)
 
         return results
 
+    def query_iter(
+        self, table_name, return_col_str, *condition_str, batch_size=1000,
+        **kwargs
+    ):
+        """A generator version of query, results are yielded in batches so
+        the full result is never held in memory. PostgreSQL uses a
+        server-side (named) cursor, SQLite uses fetchmany. Binary values are
+        yielded as bytes for both database types.
+
+        Parameters
+        ----------
+        table_name : str
+            DVHs', 'Plans', 'Rxs', 'Beams', or 'DICOM_Files'
+        return_col_str : str: str
+            a csv of SQL columns to be returned
+        condition_str : str: str
+            a condition in SQL syntax
+        batch_size : int, optional
+            maximum number of rows per batch
+        kwargs :
+            optional parameters order, order_by, and bokeh_cds
+
+        Yields
+        -------
+        list, dict
+            A list of row tuples by default, or a dict of lists if
+            bokeh_cds in kwargs and is true
+        """
+        query = self.get_query_str(
+            table_name,
+            return_col_str,
+            *condition_str,
+            order=kwargs.get("order"),
+            order_by=kwargs.get("order_by"),
+        )
+
+        if self.db_type == "pgsql":
+            cursor = self.cnx.cursor(
+                name="dvha_query_iter_%s" % next(DVH_SQL.cursor_ids)
+            )
+            cursor.itersize = batch_size
+        else:
+            cursor = self.cnx.cursor()
+
+        try:
+            try:
+                cursor.execute(query)
+            except Exception as e:
+                raise SQLError(str(e), query)
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                rows = [
+                    tuple(
+                        bytes(v) if isinstance(v, memoryview) else v
+                        for v in row
+                    )
+                    for row in rows
+                ]
+                if "bokeh_cds" in kwargs and kwargs["bokeh_cds"]:
+                    yield rows_to_cds(rows, return_col_str)
+                else:
+                    yield rows
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def get_query_str(
+        table_name, return_col_str, *condition_str, order=None, order_by=None
+    ):
+        """Build a SELECT statement for query and query_iter
+
+        Parameters
+        ----------
+        table_name : str
+            DVHs', 'Plans', 'Rxs', 'Beams', or 'DICOM_Files'
+        return_col_str : str: str
+            a csv of SQL columns to be returned
+        condition_str : str: str
+            a condition in SQL syntax
+        order : str, optional
+            'ASC' or 'DESC', defaults to 'ASC' if order_by is provided
+        order_by : str, optional
+            SQL column to sort by
+
+        Returns
+        -------
+        str
+            SQL query
+        """
+        if order_by and not order:
+            order = "ASC"
+
+        query = "Select %s from %s;" % (return_col_str, table_name)
+        if condition_str and condition_str[0]:
+            query = "Select %s from %s where %s;" % (
+                return_col_str,
+                table_name,
+                condition_str[0],
+            )
+        if order and order_by:
+            query = "%s Order By %s %s;" % (query[:-1], order_by, order)
+        return query
+
     def query_generic(self, query_str):
         """A generic query function that executes the provided string
 
@@ -207,8 +359,11 @@ class DVH_SQL:
             Results of ``cursor.fetchall()``
 
         """
+        start = perf_counter()
         self.cursor.execute(query_str)
-        return self.cursor.fetchall()
+        results = self.cursor.fetchall()
+        SQL_PROFILER.record(query_str, perf_counter() - start, len(results))
+        return results
 
     @property
     def now(self):
@@ -237,6 +392,34 @@ class DVH_SQL:
             sql_cmd = "NOW()"
         return sql_cmd
 
+    @property
+    def placeholder(self):
+        """Get the parameter placeholder used by the database driver
+
+        Returns
+        -------
+        str
+            '?' for sqlite3, '%s' for psycopg2
+        """
+        return "?" if self.db_type == "sqlite" else "%s"
+
+    def get_blob_literal(self, value):
+        """Get a SQL literal of binary data, based on database type
+
+        Parameters
+        ----------
+        value : bytes, memoryview
+            binary data
+
+        Returns
+        -------
+        str
+            binary data in SQL syntax
+        """
+        if self.db_type == "sqlite":
+            return "X'%s'" % bytes(value).hex()
+        return "'\\x%s'::bytea" % bytes(value).hex()
+
     def process_value(self, value):
         try:
             float(value)
@@ -278,7 +461,9 @@ class DVH_SQL:
 
         self.update_multicolumn(table_name, [column], [value], condition_str)
 
-    def update_multicolumn(self, table_name, columns, values, condition_str):
+    def update_multicolumn(
+        self, table_name, columns, values, condition_str, commit=True
+    ):
         """Change the data in the database
 
         Parameters
@@ -291,20 +476,38 @@ class DVH_SQL:
             list value to be set
         condition_str : str
             a condition in SQL syntax
+        commit : bool, optional
+            commit the update, set to False to group several updates in one
+            transaction. Errors are then raised, so that the caller can roll
+            back the transaction (pgsql aborts it on any error)
 
         """
 
+        new_uid = None
+        if "study_instance_uid" in columns:
+            new_uid = values[columns.index("study_instance_uid")]
         values = [self.process_value(v) for v in values]
+        self.is_modified = True
 
         set_str = [f"{columns[i]} = {value}" for i, value in enumerate(values)]
         set_str = ','.join(set_str)
         update = f"Update {table_name} SET {set_str} WHERE {condition_str}"
 
         try:
+            if self.is_dvha_table(table_name):
+                self.invalidate_condition_hashes(table_name, condition_str)
+                self.invalidate_study_hashes([new_uid])
+            start = perf_counter()
             self.cursor.execute(update)
-            self.cnx.commit()
+            if commit:
+                self.cnx.commit()
+            SQL_PROFILER.record(
+                update, perf_counter() - start, self.cursor.rowcount
+            )
         except Exception as e:
             push_to_log(e, msg="Database update failure!")
+            if not commit:
+                raise
 
     def is_study_instance_uid_in_table(self, table_name, study_instance_uid):
         """Check if a study instance uid exists in the provided table
@@ -389,49 +592,38 @@ class DVH_SQL:
             data returned from DICOM_Parser.get_<table>_row()
 
         """
-        columns = list(row)
-        allowed_columns = self.get_column_names(table)
-        used_columns = []
+        self.insert_rows(table, [row])
 
-        values = []
-        for column in columns:
-            if column in allowed_columns:
-                used_columns.append(column)
-                if (
-                    row[column] is None
-                    or row[column][0] is None
-                    or row[column][0] == ""
-                ):
-                    if column == "import_time_stamp":
-                        values.append(self.sql_cmd_now)
-                    else:
-                        values.append("NULL")
-                else:
-                    value = row[column][0]
-                    value_type = row[column][1]
+    def insert_rows(self, table, rows, commit=True, now=None):
+        """Insert many rows into a table with a single parameterized
+        statement (executemany for sqlite, execute_values for pgsql)
 
-                    if "varchar" in value_type:
-                        max_length = int(
-                            value_type.replace("varchar(", "").replace(")", "")
-                        )
-                        values.append(
-                            "'%s'" % truncate_string(value, max_length)
-                        )
+        Parameters
+        ----------
+        table : str
+            SQL table name
+        rows : list
+            list of data returned from DICOM_Parser.get_<table>_row(), where
+            each column is stored as [value, sql_type]
+        commit : bool, optional
+            commit the transaction after inserting
+        now : any, optional
+            value for a missing import_time_stamp, defaults to ``self.now``
 
-                    elif value_type in {"time_stamp", "date"}:
-                        date = date_parser(value)
-                        value = date.date()
-                        if value_type == "time_stamp":
-                            value = "%s %s" % (value, date.time())
-                        if (
-                            self.db_type == "pgsql"
-                        ):  # sqlite3 does not support ::date
-                            values.append("'%s'::date" % value)
-                        else:
-                            values.append("'%s'" % value)
-
-                    else:
-                        values.append("'%s'" % value)
+        """
+        allowed_columns = set(self.get_column_names(table))
+
+        # Collect columns and their types in order of first appearance
+        value_types = {}
+        for row in rows:
+            for column, data in row.items():
+                if column not in value_types:
+                    value_types[column] = data[1] if data is not None else ""
+
+        columns = []
+        for column in value_types:
+            if column in allowed_columns:
+                columns.append(column)
             else:
                 msg = (
                     "Failed to update SQL column %s in table %s, "
@@ -439,15 +631,102 @@ class DVH_SQL:
                 )
                 push_to_log(msg=msg)
 
-        cmd = "INSERT INTO %s (%s) VALUES (%s);\n" % (
-            table,
-            ",".join(used_columns),
-            ",".join(values),
-        )
-        self.execute_str(cmd)
+        if not rows or not columns:
+            return
+
+        # Process values by column, so the type conversion is only
+        # determined once per column
+        column_values = []
+        for column in columns:
+            values = [get_row_value(row, column) for row in rows]
+            values = self.coerce_values(values, value_types[column])
+            if column == "import_time_stamp" and None in values:
+                if now is None:
+                    now = self.now
+                values = [now if v is None else v for v in values]
+            column_values.append(values)
+        params = list(zip(*column_values))
+
+        self.insert_values(table, columns, params, commit=commit)
+
+    def insert_values(self, table, columns, params, commit=True):
+        """Insert many rows of pre-processed values with a single
+        parameterized statement
+
+        Parameters
+        ----------
+        table : str
+            SQL table name
+        columns : list
+            SQL columns in the order of each row of ``params``
+        params : list
+            list of tuples, one per row
+        commit : bool, optional
+            commit the transaction after inserting
+
+        """
+        if self.db_type == "sqlite":
+            cmd = "INSERT INTO %s (%s) VALUES (%s);" % (
+                table,
+                ",".join(columns),
+                ",".join([self.placeholder] * len(columns)),
+            )
+            self.cursor.executemany(cmd, params)
+        else:
+            cmd = "INSERT INTO %s (%s) VALUES %%s;" % (
+                table,
+                ",".join(columns),
+            )
+            execute_values(self.cursor, cmd, params, page_size=1000)
+        self.is_modified = True
+
+        if self.is_dvha_table(table) and "study_instance_uid" in columns:
+            uid_index = list(columns).index("study_instance_uid")
+            self.invalidate_study_hashes({row[uid_index] for row in params})
+
+        if commit:
+            self.cnx.commit()
+
+    @staticmethod
+    def coerce_values(values, value_type):
+        """Convert a column of values into parameters for an insert, with
+        varchar truncation and date formatting applied
+
+        Parameters
+        ----------
+        values : list
+            values of one column, None values are stored as NULL
+        value_type : str
+            SQL data type as provided by DICOM_Parser.get_<table>_row()
+
+        Returns
+        -------
+        list
+            values ready to be passed into cursor.executemany
+        """
+        if "varchar" in value_type:
+            max_length = int(
+                value_type.replace("varchar(", "").replace(")", "")
+            )
+            return [
+                None if v is None else truncate_string(str(v), max_length)
+                for v in values
+            ]
+
+        if value_type == "blob":
+            return [None if v is None else bytes(v) for v in values]
+
+        if value_type in {"time_stamp", "date"}:
+            return [
+                None if v is None else format_date(v, value_type)
+                for v in values
+            ]
+
+        # Let the database cast strings into the column's data type
+        return [None if v is None else str(v) for v in values]
 
     def insert_data_set(self, data_set):
-        """Insert an entire data set for a plan
+        """Insert an entire data set for a plan in a single transaction
 
         Parameters
         ----------
@@ -456,9 +735,14 @@ class DVH_SQL:
             data for values
 
         """
-        for key in list(data_set):
-            for row in data_set[key]:
-                self.insert_row(key, row)
+        now = self.now
+        try:
+            for table, rows in data_set.items():
+                self.insert_rows(table, rows, commit=False, now=now)
+            self.cnx.commit()
+        except Exception:
+            self.cnx.rollback()
+            raise
 
     def get_dicom_file_paths(self, mrn=None, uid=None):
         """Lookup the dicom file paths of imported data
@@ -487,9 +771,13 @@ class DVH_SQL:
                 "mrn, study_instance_uid, folder_path, plan_file, "
                 "structure_file, dose_file"
             )
-            return self.query(
+            results = {c.strip(): [] for c in columns.split(",")}
+            for batch in self.query_iter(
                 "DICOM_Files", columns, condition, bokeh_cds=True
-            )
+            ):
+                for key, values in batch.items():
+                    results[key].extend(values)
+            return results
 
     def delete_rows(self, condition_str, ignore_tables=None):
         """Delete all rows from all tables not in ignore_table for a given
@@ -504,15 +792,24 @@ class DVH_SQL:
 
         """
 
-        tables = set(self.tables)
+        tables = set(self.existing_tables)
         if ignore_tables:
             tables = tables - set(ignore_tables)
 
-        for table in tables:
-            self.cursor.execute(
-                "DELETE FROM %s WHERE %s;" % (table, condition_str)
-            )
+        # One transaction, so a failure does not leave orphaned rows
+        try:
+            for table in tables:
+                self.invalidate_condition_hashes(table, condition_str)
+
+            for table in tables:
+                self.cursor.execute(
+                    "DELETE FROM %s WHERE %s;" % (table, condition_str)
+                )
             self.cnx.commit()
+        except Exception:
+            self.cnx.rollback()
+            raise
+        self.is_modified = True
 
     def change_mrn(self, old, new):
         """Edit all mrns in database
@@ -526,7 +823,7 @@ class DVH_SQL:
 
         """
         condition = "mrn = '%s'" % old
-        for table in self.tables:
+        for table in self.existing_tables:
             self.update(table, "mrn", new, condition)
 
     def change_uid(self, old, new):
@@ -541,7 +838,7 @@ class DVH_SQL:
 
         """
         condition = "study_instance_uid = '%s'" % old
-        for table in self.tables:
+        for table in self.existing_tables:
             self.update(table, "study_instance_uid", new, condition)
 
     def delete_dvh(self, roi_name, study_instance_uid):
@@ -555,11 +852,21 @@ class DVH_SQL:
             the associated study instance uid
 
         """
-        self.cursor.execute(
-            "DELETE FROM DVHs WHERE roi_name = '%s' and "
-            "study_instance_uid = '%s';" % (roi_name, study_instance_uid)
-        )
-        self.cnx.commit()
+        try:
+            for table in ["DVHs", "DVH_Contours"]:
+                if not self.has_table(table):
+                    continue  # DVH_Contours of a database older than 0.9.8
+                self.cursor.execute(
+                    "DELETE FROM %s WHERE roi_name = '%s' and "
+                    "study_instance_uid = '%s';"
+                    % (table, roi_name, study_instance_uid)
+                )
+            self.invalidate_study_hashes([study_instance_uid])
+            self.cnx.commit()
+        except Exception:
+            self.cnx.rollback()
+            raise
+        self.is_modified = True
 
     def ignore_dvh(self, variation, study_instance_uid, unignore=False):
         """Change an uncategorized roi name to ignored so that it won't show
@@ -586,11 +893,103 @@ class DVH_SQL:
             % (variation, study_instance_uid),
         )
 
+    def is_dvha_table(self, table_name):
+        """Check if a table is one of the DVHA data tables (self.tables)
+
+        Parameters
+        ----------
+        table_name : str
+            SQL table name, case-insensitive
+
+        Returns
+        -------
+        bool
+            True if ``table_name`` is in self.tables
+        """
+        return table_name.lower() in {t.lower() for t in self.tables}
+
+    def has_table(self, table_name):
+        """Check if a table exists in the database, without a query once the
+        schema is cached
+
+        Parameters
+        ----------
+        table_name : str
+            SQL table name
+
+        Returns
+        -------
+        bool
+            True if ``table_name`` exists
+        """
+        return bool(self.get_column_types(table_name))
+
+    @property
+    def existing_tables(self):
+        """The DVHA data tables (self.tables) that exist in the database,
+        e.g., DVH_Contours is missing from a database created before 0.9.8
+        and not initialized since"""
+        return [table for table in self.tables if self.has_table(table)]
+
+    @property
+    def has_sync_table(self):
+        """Check if the database has a DVHA_Sync table (i.e., created by
+        0.9.8 or later), without a query once the schema is cached"""
+        return self.has_table(SYNC_TABLE)
+
+    def invalidate_condition_hashes(self, table_name, condition_str):
+        """Remove the stored content hashes of the studies with rows in a
+        table meeting a condition, with a single DELETE (see
+        invalidate_study_hashes)
+
+        Parameters
+        ----------
+        table_name : str
+            SQL table name
+        condition_str : str
+            a condition in SQL syntax
+        """
+        if not self.has_sync_table:
+            return
+        match = UID_CONDITION.search(condition_str)
+        if match and not OR_CONDITION.search(condition_str):
+            self.invalidate_study_hashes([match.group(1)])
+            return
+        self.cursor.execute(
+            "DELETE FROM %s WHERE study_instance_uid IN "
+            "(SELECT study_instance_uid FROM %s WHERE %s);"
+            % (SYNC_TABLE, table_name, condition_str)
+        )
+
+    def invalidate_study_hashes(self, uids):
+        """Remove the stored content hashes of studies (see db.delta_sync),
+        so they are recomputed before the next sync. Called by the methods
+        writing to the DVHA tables, the deletion is committed with their
+        transaction
+
+        Parameters
+        ----------
+        uids : iterable
+            study instance uids of modified studies
+        """
+        uids = sorted({str(uid) for uid in uids if uid is not None})
+        if not uids or not self.has_sync_table:
+            return  # nothing to invalidate, or database older than 0.9.8
+        for i in range(0, len(uids), 500):
+            batch = uids[i : i + 500]
+            self.cursor.execute(
+                "DELETE FROM %s WHERE study_instance_uid IN (%s);"
+                % (SYNC_TABLE, ",".join([self.placeholder] * len(batch))),
+                batch,
+            )
+
     def drop_tables(self):
         """Delete all tables in the database if they exist"""
         for table in self.tables:
             self.cursor.execute("DROP TABLE IF EXISTS %s;" % table)
             self.cnx.commit()
+        self.clear_schema_cache()
+        self.is_modified = True
 
     def drop_table(self, table):
         """Delete a table in the database if it exists
@@ -603,6 +1002,13 @@ class DVH_SQL:
         """
         self.cursor.execute("DROP TABLE IF EXISTS %s;" % table)
         self.cnx.commit()
+        self.clear_schema_cache()
+        self.is_modified = True
+
+    def clear_schema_cache(self):
+        """Invalidate the cached column names and types of this database,
+        call after any change to the database schema"""
+        CONNECTION_POOL.clear_schema(self.pool_key)
 
     def initialize_database(self):
         """Ensure that all of the latest SQL columns exist in the database"""
@@ -610,6 +1016,95 @@ class DVH_SQL:
             self.db_type == "sqlite"
         ]
         self.execute_file(create_tables_file)
+        self.clear_schema_cache()
+
+        if self.db_type == "sqlite":
+            # sqlite does not support ADD COLUMN IF NOT EXISTS
+            self.add_column_if_not_exists("DVHs", "dvh_curve", "blob")
+
+        self.execute_file(CREATE_INDEXES)
+
+    def add_column_if_not_exists(self, table, column, data_type):
+        """Add a column to a table, if it does not already exist
+
+        Parameters
+        ----------
+        table : str
+            SQL table
+        column : str
+            SQL column to be added
+        data_type : str
+            SQL data type of ``column``
+
+        """
+        if column not in self.get_column_names(table):
+            self.cursor.execute(
+                "ALTER TABLE %s ADD COLUMN %s %s;" % (table, column, data_type)
+            )
+            self.cnx.commit()
+            self.clear_schema_cache()
+
+    def explain(self, query_str):
+        """Get the query plan of a SELECT statement
+
+        Parameters
+        ----------
+        query_str : str
+            a SELECT statement
+
+        Returns
+        -------
+        list
+            each line of the query plan (str)
+
+        """
+        if self.db_type == "sqlite":
+            rows = self.query_generic("EXPLAIN QUERY PLAN %s" % query_str)
+            return [str(row[-1]) for row in rows]
+        rows = self.query_generic("EXPLAIN %s" % query_str)
+        return [str(row[0]) for row in rows]
+
+    def is_index_used(self, query_str):
+        """Check if the query plan of a SELECT statement uses an index
+
+        Parameters
+        ----------
+        query_str : str
+            a SELECT statement
+
+        Returns
+        -------
+        bool
+            True if any step of the query plan is an index search
+
+        """
+        plan = " ".join(self.explain(query_str)).lower()
+        # sqlite: 'SEARCH DVHs USING (COVERING) INDEX ...'
+        # pgsql: 'Index Scan using ...', 'Index Only Scan ...',
+        #        'Bitmap Index Scan on ...'
+        keys = ["using index", "using covering index", "index scan",
+                "index only scan"]
+        return any(key in plan for key in keys)
+
+    def check_index_usage(self, queries=None):
+        """Check that frequently executed queries use the secondary indexes
+        defined in create_indexes.sql. PostgreSQL may still choose a
+        sequential scan for small tables, or if the tables have not been
+        analyzed since the indexes were created.
+
+        Parameters
+        ----------
+        queries : list, optional
+            SELECT statements to check, defaults to INDEXED_QUERIES
+
+        Returns
+        -------
+        dict
+            query_str: True if an index is used
+
+        """
+        queries = INDEXED_QUERIES if queries is None else queries
+        return {query: self.is_index_used(query) for query in queries}
 
     def reinitialize_database(self):
         """Delete all data and create all tables with latest columns"""
@@ -617,6 +1112,56 @@ class DVH_SQL:
         self.vacuum()
         self.initialize_database()
 
+    def increment_modification_counter(self):
+        """Increment the counter in DVHA_Modifications, which is used to
+        detect data changes (e.g., to invalidate cached query results). This
+        is called on close if data was written, any uncommitted changes are
+        rolled back first. Databases without the table (i.e., not initialized
+        since 0.9.8) are skipped, QueryCache does not cache their results"""
+        try:
+            self.cnx.rollback()
+            if not self.has_table("DVHA_Modifications"):
+                self.is_modified = False
+                return
+            self.cursor.execute(
+                "UPDATE DVHA_Modifications SET counter = counter + 1;"
+            )
+            self.cnx.commit()
+            self.is_modified = False
+        except Exception as e:
+            self.cnx.rollback()
+            push_to_log(e, msg="Failed to increment modification counter")
+
+    def get_modification_state(self):
+        """Get values that change whenever the data in this database changes
+
+        Returns
+        -------
+        tuple
+            modification counter (None if the database has no
+            DVHA_Modifications table), and the latest import_time_stamp of
+            the Plans and DVHs tables (as str)
+
+        """
+        counter = None
+        if self.has_table("DVHA_Modifications"):
+            counter = self.query_generic(
+                "SELECT MAX(counter) FROM DVHA_Modifications;"
+            )[0][0]
+        time_stamps = [
+            str(self.get_max_value(table, "import_time_stamp"))
+            for table in ["Plans", "DVHs"]
+        ]
+        return (counter, *time_stamps)
+
+    def checkpoint(self):
+        """Move the contents of a SQLite write-ahead log into the database
+        file (only applicable with journal_mode=WAL)"""
+        if self.db_type == "sqlite":
+            self.cnx.commit()
+            self.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+            self.cursor.fetchall()
+
     def vacuum(self):
         """Call to reclaim space in the database"""
         if self.db_type == "sqlite":
@@ -706,6 +1251,33 @@ class DVH_SQL:
         unique_values.sort()
         return unique_values
 
+    def get_common_uids(self, conditions):
+        """Get the study instance uids meeting the condition of each table,
+        intersected by the database with a single INTERSECT query
+
+        Parameters
+        ----------
+        conditions : dict
+            Condition in SQL syntax (or None / empty for no condition) by
+            table name
+
+        Returns
+        -------
+        list
+            Sorted study_instance_uids found in every table
+        """
+        if not conditions:
+            return []
+        selects = []
+        for table, condition in conditions.items():
+            select = "SELECT study_instance_uid FROM %s" % table
+            if condition:
+                select += " WHERE %s" % condition
+            selects.append(select)
+        query = "%s ORDER BY 1;" % " INTERSECT ".join(selects)
+        self.cursor.execute(query)
+        return [str(row[0]) for row in self.cursor.fetchall()]
+
     def get_column_names(self, table_name):
         """Get all of the column names for a specified table
 
@@ -720,20 +1292,71 @@ class DVH_SQL:
             All columns names in ``table_name``
 
         """
+        return sorted(self.get_column_types(table_name))
+
+    def get_column_types(self, table_name):
+        """Get the SQL data type of each column in a specified table. Results
+        are cached until the schema is changed with this class (e.g.,
+        initialize_database, drop_table), including an empty result for a
+        table that does not exist
+
+        Parameters
+        ----------
+        table_name : str
+            SQL table
+
+        Returns
+        -------
+        dict
+            SQL data types of ``table_name`` stored by column name
+
+        """
+        column_types = CONNECTION_POOL.get_schema(self.pool_key, table_name)
+        if column_types is not None:
+            return column_types
+
         if self.db_type == "sqlite":
             query = "PRAGMA table_info(%s);" % table_name.lower()
-            index = 1
+            name_index, type_index = 1, 2
         else:
             query = (
-                "select column_name from information_schema.columns where "
-                "table_name = '%s';" % table_name.lower()
+                "select column_name, data_type from information_schema.columns"
+                " where table_name = '%s';" % table_name.lower()
             )
-            index = 0
+            name_index, type_index = 0, 1
         self.cursor.execute(query)
         cursor_return = self.cursor.fetchall()
-        columns = [str(c[index]) for c in cursor_return]
-        columns.sort()
-        return columns
+        column_types = {
+            str(c[name_index]): str(c[type_index]) for c in cursor_return
+        }
+        CONNECTION_POOL.set_schema(self.pool_key, table_name, column_types)
+        return column_types
+
+    def get_sqlite_datetime_columns(self, table_name):
+        """Get the sqlite columns of a table that store datetime data
+
+        Parameters
+        ----------
+        table_name : str
+            SQL table
+
+        Returns
+        -------
+        set
+            Column names of ``table_name`` with a date or time data type.
+            Always empty for pgsql
+
+        """
+        if self.db_type == "sqlite":
+            return {
+                column
+                for column, column_type in self.get_column_types(
+                    table_name
+                ).items()
+                if "time" in column_type.lower()
+                or "date" in column_type.lower()
+            }
+        return set()
 
     def is_sqlite_column_datetime(self, table_name, column):
         """Check if a sqlite column is a datetime data type
@@ -751,18 +1374,7 @@ class DVH_SQL:
             True if the ``table_name.column`` store datetime data
 
         """
-        if self.db_type == "sqlite":
-            query = "PRAGMA table_info(%s);" % table_name.lower()
-            self.cursor.execute(query)
-            cursor_return = self.cursor.fetchall()
-            columns = {str(c[1]): str(c[2]) for c in cursor_return}
-            if column in list(columns):
-                column_type = columns[column]
-                return (
-                    "time" in column_type.lower()
-                    or "date" in column_type.lower()
-                )
-        return False
+        return column in self.get_sqlite_datetime_columns(table_name)
 
     def get_min_value(self, table, column, condition=None):
         """Get the minimum value in the database for a given table and column
@@ -892,7 +1504,7 @@ class DVH_SQL:
             True if ``uid`` exists in any table
 
         """
-        for table in self.tables:
+        for table in self.existing_tables:
             if self.is_study_instance_uid_in_table(table, uid):
                 return True
         return False
@@ -911,7 +1523,7 @@ class DVH_SQL:
             True if ``mrn`` exists in any table
 
         """
-        for table in self.tables:
+        for table in self.existing_tables:
             if self.is_mrn_in_table(table, mrn):
                 return True
         return False
@@ -961,7 +1573,9 @@ class DVH_SQL:
             return ans[0][0]
         return 0
 
-    def export_to_sqlite(self, file_path, callback=None, force=False):
+    def export_to_sqlite(
+        self, file_path, callback=None, force=False, batch_size=2000
+    ):
         """Create a new SQLite database and import this database's data
 
         Parameters
@@ -969,30 +1583,79 @@ class DVH_SQL:
         file_path : str
             Path where the new SQLite database will be created
         callback : callable, optional
-            optional function to be called on each row insertion. Should accept
+            optional function to be called as rows are inserted. Should accept
             table (str), current row (int), total_row_count (int) as parameters
         force : bool, optional
             ignore duplicate StudyInstanceUIDs if False
+        batch_size : int, optional
+            number of rows read and written at a time
 
         """
         config = {"host": file_path}
-        new_cnx = DVH_SQL(config, db_type="sqlite")
-        new_cnx.initialize_database()
-        self.import_db(self, new_cnx, callback=callback, force=force)
+        with DVH_SQL(config, db_type="sqlite") as new_cnx:
+            new_cnx.initialize_database()
+            self.import_db(
+                self, new_cnx, callback=callback, force=force,
+                batch_size=batch_size
+            )
+            # write the WAL into the database file, so the new file is
+            # complete on its own while the connection is pooled
+            new_cnx.checkpoint()
+
+    def export_to_columnar(
+        self, dir_path, file_format="npz", chunk_size=5000, callback=None
+    ):
+        """Export this database into chunked columnar files, see
+        db.columnar.export_columnar
+
+        Parameters
+        ----------
+        dir_path : str
+            directory for the export, created if it does not exist
+        file_format : str, optional
+            either 'npz' (compressed numpy) or 'parquet' (requires pyarrow)
+        chunk_size : int, optional
+            maximum number of rows per file
+        callback : callable, optional
+            optional function to be called as rows are exported. Should
+            accept table (str), current row (int), total_row_count (int) as
+            parameters
 
-    @staticmethod
-    def import_db(cnx_src, cnx_dst, callback=None, force=False, create_new_uids=False, append_to_uid=None):
         """
+        from dvha.db.columnar import export_columnar  # imports DVH_SQL
+
+        export_columnar(
+            self,
+            dir_path,
+            file_format=file_format,
+            chunk_size=chunk_size,
+            callback=callback,
+        )
+
+    @staticmethod
+    def import_db(
+        cnx_src,
+        cnx_dst,
+        callback=None,
+        force=False,
+        create_new_uids=False,
+        append_to_uid=None,
+        batch_size=2000,
+        workers=1,
+    ):
+        """Copy all DVHA tables from cnx_src into cnx_dst. Tables are streamed
+        in batches, see db.bulk_copy.BulkCopy
 
         Parameters
         ----------
-        cnx_src : DVH_SQL
-            the source DVHA DB connection
+        cnx_src : DVH_SQL, ColumnarDB
+            the source DVHA DB connection, or a db.columnar.ColumnarDB
         cnx_dst : DVH_SQL
             the destination DVHA DB connection
         callback : callable, optional
-            optional function to be called on each row insertion. Should accept
-            table (str), current row (int), total_row_count (int) as parameters
+            optional function to be called as rows are inserted. Should accept
+            table (str), current row (int), total_row_count (int) as
+            parameters. Calls are throttled, so not every row is reported
         force : bool, optional
             ignore duplicate StudyInstanceUIDs if False
         create_new_uids : bool, optional
@@ -1001,64 +1664,69 @@ class DVH_SQL:
         append_to_uid : str
             If create_new_uids is true, append this to mrn and
             study_instance_uids instead of dbname
+        batch_size : int, optional
+            number of rows read and written at a time
+        workers : int, optional
+            number of tables to copy in parallel (pgsql destinations only)
 
         """
-        for table in cnx_src.tables:
-            columns = cnx_src.get_column_names(table)
-            uid_index = columns.index('study_instance_uid')
-            mrn_index = columns.index('mrn')
-            study_uids_1 = cnx_src.get_unique_values(
-                table, "study_instance_uid"
-            )
+        from dvha.db.bulk_copy import BulkCopy  # bulk_copy imports DVH_SQL
+
+        BulkCopy(
+            cnx_src,
+            cnx_dst,
+            callback=callback,
+            force=force,
+            create_new_uids=create_new_uids,
+            append_to_uid=append_to_uid,
+            batch_size=batch_size,
+            workers=workers,
+        ).run()
 
-            condition = None
-            if not force or create_new_uids:
-                study_uids_2 = cnx_dst.get_unique_values(
-                    table, "study_instance_uid"
-                )
-            if not force:
-                study_uids_1 = list(set(study_uids_1) - set(study_uids_2))
-                condition = "study_instance_uid IN ('%s')" % "','".join(
-                    study_uids_1
-                )
+    @staticmethod
+    def delta_sync(
+        cnx_src,
+        cnx_dst,
+        callback=None,
+        delete_missing=False,
+        batch_size=2000,
+        workers=1,
+    ):
+        """Copy only the studies of cnx_src that are new or changed compared
+        to cnx_dst, by comparing content hashes, see db.delta_sync
 
-            total_row_count = cnx_src.get_row_count(table, condition)
+        Parameters
+        ----------
+        cnx_src : DVH_SQL
+            the source DVHA DB connection
+        cnx_dst : DVH_SQL
+            the destination DVHA DB connection
+        callback : callable, optional
+            optional function to be called as studies are hashed and rows
+            are inserted. Should accept table (str), current row (int),
+            total_row_count (int) as parameters
+        delete_missing : bool, optional
+            also delete studies from cnx_dst that are not in cnx_src
+        batch_size : int, optional
+            number of rows read and written at a time
+        workers : int, optional
+            number of tables to copy in parallel (pgsql destinations only)
 
-            counter = 1
-            for uid in study_uids_1:
-                study_data = cnx_src.query(
-                    table, ",".join(columns), "study_instance_uid = '%s'" % uid
-                )
-                for r in range(len(study_data)):
-                    row = study_data[r]
-                    if create_new_uids:
-                        db_name = cnx_src.db_name if cnx_src.db_name else cnx_src.config["host"]
-                        append_with_me = append_to_uid if append_to_uid else db_name
-                        new_uid = f"{uid}_{append_with_me}"
-                        new_mrn = f"{row[mrn_index]}_{append_with_me}"
-                        uid_counter = 2
-                        while new_uid in study_uids_2:
-                            new_uid = f"{uid}_{append_with_me}_{uid_counter}"
-                            new_mrn = f"{row[mrn_index]}_{append_with_me}_{uid_counter}"
-                            uid_counter += 1
-                        row = [x for x in row]
-                        row[uid_index] = new_uid
-                        row[mrn_index] = new_mrn
-
-                    if callback is not None:
-                        try:
-                            CallAfter(callback, table, counter, total_row_count)
-                        except AssertionError:
-                            callback(table, counter, total_row_count)
-                        counter += 1
-                    row_str = "'" + "','".join([str(v) for v in row]) + "'"
-                    row_str = row_str.replace("'None'", "NULL")
-                    cmd = "INSERT INTO %s (%s) VALUES (%s);\n" % (
-                        table,
-                        ",".join(columns),
-                        row_str,
-                    )
-                    cnx_dst.execute_str(cmd)
+        Returns
+        -------
+        dict
+            number of 'new', 'changed', 'deleted', and 'unchanged' studies
+        """
+        from dvha.db.delta_sync import delta_sync  # imports DVH_SQL
+
+        return delta_sync(
+            cnx_src,
+            cnx_dst,
+            callback=callback,
+            delete_missing=delete_missing,
+            batch_size=batch_size,
+            workers=workers,
+        )
 
     def save_to_json(self, file_path, callback=None):
         """Export SQL database to a JSON file
@@ -1073,19 +1741,52 @@ class DVH_SQL:
             parameters
 
         """
-        json_data = {
-            "columns": {"categorical": categorical, "numerical": numerical}
-        }
-        for i, table in enumerate(self.tables):
-            if callback is not None:
-                CallAfter(callback, table, i, len(self.tables))
-            columns = self.get_column_names(table)
-            json_data[table] = self.query(
-                table, ",".join(columns), bokeh_cds=True
-            )
-
+        # Rows are read in batches, but each table is written as lists by
+        # column, so the values of each column are spooled to a temporary
+        # file. Only one batch of rows is held in memory
+        columns_json = json.dumps(
+            {"categorical": categorical, "numerical": numerical}
+        )
         with open(file_path, "w") as fp:
-            json.dump(json_data, fp)
+            fp.write('{"columns": %s' % columns_json)
+            for i, table in enumerate(self.tables):
+                if callback is not None:
+                    CallAfter(callback, table, i, len(self.tables))
+                fp.write(", %s: " % json.dumps(table))
+                self._write_json_table(fp, table)
+            fp.write("}")
+
+    def _write_json_table(self, fp, table):
+        """Write a table to an open JSON file as a dict of lists by column,
+        see save_to_json"""
+        columns = self.get_column_names(table)
+        spools = {column: TemporaryFile("w+") for column in columns}
+        try:
+            separator = ""
+            for batch in self.query_iter(
+                table, ",".join(columns), bokeh_cds=True
+            ):
+                for column, values in batch.items():
+                    # binary data (e.g., DVHs.dvh_curve) stored as hex strings
+                    spools[column].write(
+                        separator
+                        + ", ".join(
+                            json.dumps(v.hex() if isinstance(v, bytes) else v)
+                            for v in values
+                        )
+                    )
+                separator = ", "
+
+            fp.write("{")
+            for j, column in enumerate(columns):
+                fp.write("%s%s: [" % (", " if j else "", json.dumps(column)))
+                spools[column].seek(0)
+                copyfileobj(spools[column], fp)
+                fp.write("]")
+            fp.write("}")
+        finally:
+            for spool in spools.values():
+                spool.close()
 
     def get_ptv_counts(self):
         """Get number of PTVs for each study instance uid
@@ -1103,6 +1804,33 @@ class DVH_SQL:
         return {uid: uids.count(uid) for uid in list(set(uids))}
 
 
+def rows_to_cds(rows, return_col_str):
+    """Pivot query results into a dict of lists. Date and time values are
+    converted to strings
+
+    Parameters
+    ----------
+    rows : list
+        cursor rows
+    return_col_str : str
+        the csv of SQL columns used in the query
+
+    Returns
+    -------
+    dict
+        query results stored by column name
+    """
+    keys = [c.strip() for c in return_col_str.split(",")]
+    results = {
+        key: [rows[r][i] for r in range(len(rows))]
+        for i, key in enumerate(keys)
+    }
+    for key in list(results):
+        if "time" in key or "date" in key:
+            results[key] = [str(value) for value in results[key]]
+    return results
+
+
 def truncate_string(input_string, character_limit):
     """Used to truncate a string to ensure it may be imported into database
 
@@ -1124,6 +1852,50 @@ def truncate_string(input_string, character_limit):
     return input_string
 
 
+def get_row_value(row, column):
+    """Get a value from a DICOM_Parser.get_<table>_row() return
+
+    Parameters
+    ----------
+    row : dict
+        each column is stored as [value, sql_type]
+    column : str
+        SQL column
+
+    Returns
+    -------
+    any
+        The value of ``column``, None if empty or not in ``row``
+
+    """
+    data = row.get(column)
+    if data is None or data[0] is None or data[0] == "":
+        return None
+    return data[0]
+
+
+def format_date(value, value_type):
+    """Format a date or time_stamp for a SQL insert
+
+    Parameters
+    ----------
+    value : str, datetime
+        a value parsable with dateutil
+    value_type : str
+        either 'date' or 'time_stamp'
+
+    Returns
+    -------
+    str
+        The date, including time if ``value_type`` is 'time_stamp'
+
+    """
+    date = date_parser(str(value))
+    if value_type == "time_stamp":
+        return "%s %s" % (date.date(), date.time())
+    return str(date.date())
+
+
 def echo_sql_db(config=None, db_type="pgsql", group=1):
     """Echo the database using stored or provided credentials
 
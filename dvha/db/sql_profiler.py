@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# db.sql_profiler.py
+"""Opt-in timing of the SQL statements executed by DVH_SQL"""
+# Copyright (c) 2016-2019 Dan Cutright
+# This file is part of DVH Analytics, released under a BSD license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/cutright/DVH-Analytics
+
+from collections import Counter
+import csv
+from os.path import basename, normcase
+import re
+import sys
+from threading import Lock
+
+
+REPORT_COLUMNS = [
+    "SQL",
+    "Calls",
+    "Total (s)",
+    "Mean (ms)",
+    "Max (ms)",
+    "Rows",
+    "Call Sites",
+]
+
+# literals are replaced so that statements differing only by their values
+# share a report row, e.g., "mrn = 'A'" and "mrn = 'B'" become "mrn = ?"
+_BLOB_LITERAL = re.compile(r"[xX]'[0-9a-fA-F]*'(::bytea)?")
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(\.\d+)?([eE][-+]?\d+)?\b")
+_VALUE_LIST = re.compile(r"\(\s*\?(\s*,\s*\?)*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+# frames in these files are skipped when finding the calling site
+_IGNORED_FILES = {"sql_connector.py", "sql_profiler.py"}
+
+
+def normalize_sql(sql):
+    """Replace literals in a SQL statement with ?, and collapse whitespace
+
+    Parameters
+    ----------
+    sql : str
+        a SQL statement
+
+    Returns
+    -------
+    str
+        normalized statement
+    """
+    sql = _BLOB_LITERAL.sub("?", str(sql))
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _VALUE_LIST.sub("(...)", sql)
+    return _WHITESPACE.sub(" ", sql).strip().rstrip(";")
+
+
+def get_call_site():
+    """Get the first stack frame outside of DVH_SQL and this module
+
+    Returns
+    -------
+    str
+        calling site formatted as 'file.py:line (function)'
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        file_name = basename(normcase(frame.f_code.co_filename))
+        if file_name not in _IGNORED_FILES:
+            return "%s:%s (%s)" % (
+                file_name,
+                frame.f_lineno,
+                frame.f_code.co_name,
+            )
+        frame = frame.f_back
+    return "unknown"
+
+
+class SQLProfiler:
+    """Aggregate the duration and row count of SQL statements by their
+    normalized text. Recording is disabled until ``enabled`` is set, so the
+    only cost otherwise is reading a timer."""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = Lock()
+        self._stats = {}
+
+    def record(self, sql, duration, row_count=None):
+        """Record the execution of a SQL statement, if enabled
+
+        Parameters
+        ----------
+        sql : str
+            the executed statement
+        duration : float
+            execution time in seconds
+        row_count : int, optional
+            number of rows returned or affected, if known
+        """
+        if not self.enabled:
+            return
+        key = normalize_sql(sql)
+        call_site = get_call_site()
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = {
+                    "calls": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                    "rows": 0,
+                    "call_sites": Counter(),
+                }
+                self._stats[key] = stats
+            stats["calls"] += 1
+            stats["total"] += duration
+            stats["max"] = max(stats["max"], duration)
+            if row_count is not None and row_count > 0:
+                stats["rows"] += row_count
+            stats["call_sites"][call_site] += 1
+
+    def reset(self):
+        """Discard all recorded statements"""
+        with self._lock:
+            self._stats = {}
+
+    @property
+    def statement_count(self):
+        """Number of distinct normalized statements recorded"""
+        with self._lock:
+            return len(self._stats)
+
+    def get_report(self, top=None):
+        """Get the recorded statements, sorted by total time
+
+        Parameters
+        ----------
+        top : int, optional
+            only return this many statements
+
+        Returns
+        -------
+        dict
+            lists of values keyed by REPORT_COLUMNS, for use with DataTable
+        """
+        with self._lock:
+            rows = sorted(
+                self._stats.items(), key=lambda i: i[1]["total"], reverse=True
+            )
+            rows = [
+                (sql, dict(stats, call_sites=stats["call_sites"].copy()))
+                for sql, stats in rows[:top]
+            ]
+
+        report = {column: [] for column in REPORT_COLUMNS}
+        for sql, stats in rows:
+            report["SQL"].append(sql)
+            report["Calls"].append(stats["calls"])
+            report["Total (s)"].append(round(stats["total"], 4))
+            report["Mean (ms)"].append(
+                round(1000.0 * stats["total"] / stats["calls"], 3)
+            )
+            report["Max (ms)"].append(round(1000.0 * stats["max"], 3))
+            report["Rows"].append(stats["rows"])
+            report["Call Sites"].append(
+                "; ".join(
+                    "%s x%s" % item
+                    for item in stats["call_sites"].most_common()
+                )
+            )
+        return report
+
+    def save_csv(self, file_path, top=None):
+        """Write the report from get_report to a csv file
+
+        Parameters
+        ----------
+        file_path : str
+            destination of the csv file
+        top : int, optional
+            only write this many statements
+        """
+        report = self.get_report(top=top)
+        with open(file_path, "w", newline="", encoding="utf-8") as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(REPORT_COLUMNS)
+            writer.writerows(
+                zip(*[report[column] for column in REPORT_COLUMNS])
+            )
+
+
+SQL_PROFILER = SQLProfiler()
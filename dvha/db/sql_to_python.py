@@ -58,35 +58,46 @@ class QuerySQL:
                 else:
                     columns = all_columns
 
-                for column in columns:
-                    if column not in {
-                        "roi_coord_string",
-                        "distances_to_ptv",
-                    }:  # ignored for memory since not used here
-                        self.cursor = cnx.query(
-                            self.table_name, column, self.condition_str
-                        )
-                        force_date = cnx.is_sqlite_column_datetime(
-                            self.table_name, column
-                        )  # returns False for pgsql
-                        rtn_list = self.cursor_to_list(force_date=force_date)
-                        if unique:
-                            rtn_list = get_unique_list(rtn_list)
-                        # create property of QuerySQL based on SQL column name
-                        setattr(self, column, rtn_list)
+                # ignored for memory since not used here
+                columns = sorted(
+                    set(columns) - {"roi_coord_string", "distances_to_ptv"}
+                )
+
+                # returns an empty set for pgsql
+                date_columns = cnx.get_sqlite_datetime_columns(
+                    self.table_name
+                )
+
+                # Fetch all columns at once, rather than one query per column
+                self.cursor = []
+                if columns:
+                    self.cursor = cnx.query(
+                        self.table_name, ",".join(columns), self.condition_str
+                    )
+
+            for index, column in enumerate(columns):
+                rtn_list = self.cursor_to_list(
+                    force_date=column in date_columns, column_index=index
+                )
+                if unique:
+                    rtn_list = get_unique_list(rtn_list)
+                # create property of QuerySQL based on SQL column name
+                setattr(self, column, rtn_list)
         else:
             push_to_log(
                 msg="QuerySQL: Table name in valid. Please select from Beams, "
                 "DVHs, Plans, or Rxs."
             )
 
-    def cursor_to_list(self, force_date=False):
+    def cursor_to_list(self, force_date=False, column_index=0):
         """Convert a cursor return into a list of values
 
         Parameters
         ----------
         force_date : bool, optional
              Apply dateutil.parser to values
+        column_index : int, optional
+             The index of the column within each cursor row
 
         Returns
         -------
@@ -96,22 +107,66 @@ class QuerySQL:
         """
         rtn_list = []
         for row in self.cursor:
+            value = row[column_index]
             if force_date:
                 try:
-                    if type(row[0]) is int:
-                        rtn_list.append(str(date_parser(str(row[0]))))
+                    if type(value) is int:
+                        rtn_list.append(str(date_parser(str(value))))
                     else:
-                        rtn_list.append(str(date_parser(row[0])))
+                        rtn_list.append(str(date_parser(value)))
                 except Exception:
                     rtn_list.append("None")
 
-            elif isinstance(row[0], (int, float)):
-                rtn_list.append(row[0])
+            elif isinstance(value, (int, float)):
+                rtn_list.append(value)
+            elif isinstance(value, (bytes, memoryview)):
+                rtn_list.append(bytes(value))
             else:
-                rtn_list.append(str(row[0]))
+                rtn_list.append(str(value))
         return rtn_list
 
 
+def merge_query_sql(query_sqls, sources):
+    """Combine QuerySQL objects of the same table, queried from different
+    databases (e.g., for a federated query). A ``source`` value is added to
+    each row.
+
+    Parameters
+    ----------
+    query_sqls : list
+        QuerySQL objects of the same table, queried with unique=False
+    sources : list
+        a name for the database of each QuerySQL object
+
+    Returns
+    -------
+    QuerySQL
+        rows of all sources, in the order of ``query_sqls``
+    """
+    merged = QuerySQL.__new__(QuerySQL)
+    first = query_sqls[0]
+    merged.table_name = first.table_name
+    merged.condition_str = first.condition_str
+
+    # only columns found in every source are kept
+    columns = [
+        key
+        for key, value in first.__dict__.items()
+        if isinstance(value, list)
+        and all(isinstance(getattr(q, key, None), list) for q in query_sqls)
+    ]
+    for column in columns:
+        setattr(
+            merged, column, [v for q in query_sqls for v in getattr(q, column)]
+        )
+    merged.source = [
+        source
+        for query_sql, source in zip(query_sqls, sources)
+        for _ in range(len(query_sql.cursor))
+    ]
+    return merged
+
+
 def get_unique_list(input_list):
     """Remove duplicates in list and retain order
 
@@ -12,6 +12,7 @@
 import numpy as np
 from os.path import join as join_path
 import pydicom as dicom
+from dvha.db.roi_contours import get_roi_planes, get_study_planes
 from dvha.db.sql_connector import DVH_SQL
 from dvha.tools import roi_geometry as roi_geom
 from dvha.tools import roi_formatter as roi_form
@@ -22,7 +23,7 @@ from pubsub import pub
 from dvha.options import Options
 
 
-def centroid(study_instance_uid, roi_name):
+def centroid(study_instance_uid, roi_name, cnx=None):
     """Recalculate the centroid of an roi based on data in the SQL DB.
 
     Parameters
@@ -31,24 +32,22 @@ def centroid(study_instance_uid, roi_name):
         study instance uid
     roi_name : str
         name of roi
+    cnx : DVH_SQL, optional
+        connection used for queries and updates. If provided, changes are
+        not committed
     """
 
-    coordinates_string = query(
-        "dvhs",
-        "roi_coord_string",
-        "study_instance_uid = '%s' and roi_name = '%s'"
-        % (study_instance_uid, roi_name),
-    )
-
-    roi = roi_form.get_planes_from_string(coordinates_string[0][0])
+    roi = get_roi_planes(study_instance_uid, roi_name, cnx=cnx)
     data = roi_geom.centroid(roi)
 
     data = [str(round(v, 3)) for v in data]
 
-    update_dvhs_table(study_instance_uid, roi_name, "centroid", ",".join(data))
+    update_dvhs_table(
+        study_instance_uid, roi_name, "centroid", ",".join(data), cnx=cnx
+    )
 
 
-def cross_section(study_instance_uid, roi_name):
+def cross_section(study_instance_uid, roi_name, cnx=None):
     """Recalculate the centroid of an roi based on data in the SQL DB.
 
     Parameters
@@ -57,26 +56,22 @@ def cross_section(study_instance_uid, roi_name):
         study instance uid
     roi_name : str
         name of roi
+    cnx : DVH_SQL, optional
+        connection used for queries and updates. If provided, changes are
+        not committed
 
     """
 
-    coordinates_string = query(
-        "dvhs",
-        "roi_coord_string",
-        "study_instance_uid = '%s' and roi_name = '%s'"
-        % (study_instance_uid, roi_name),
-    )
-
-    roi = roi_form.get_planes_from_string(coordinates_string[0][0])
+    roi = get_roi_planes(study_instance_uid, roi_name, cnx=cnx)
     area = roi_geom.cross_section(roi)
 
-    for key in ["max", "median"]:
-        update_dvhs_table(
-            study_instance_uid, roi_name, "cross_section_%s" % key, area[key]
-        )
+    data_map = {
+        "cross_section_%s" % key: area[key] for key in ["max", "median"]
+    }
+    update_dvhs_columns(study_instance_uid, roi_name, data_map, cnx=cnx)
 
 
-def spread(study_instance_uid, roi_name):
+def spread(study_instance_uid, roi_name, cnx=None):
     """Recalculate the spread of an roi based on data in the SQL DB.
 
     Parameters
@@ -85,26 +80,24 @@ def spread(study_instance_uid, roi_name):
         study instance uid
     roi_name : str
         name of roi
+    cnx : DVH_SQL, optional
+        connection used for queries and updates. If provided, changes are
+        not committed
 
     """
 
-    coordinates_string = query(
-        "dvhs",
-        "roi_coord_string",
-        "study_instance_uid = '%s' and roi_name = '%s'"
-        % (study_instance_uid, roi_name),
-    )
-
-    roi = roi_form.get_planes_from_string(coordinates_string[0][0])
+    roi = get_roi_planes(study_instance_uid, roi_name, cnx=cnx)
     data = roi_geom.spread(roi)
 
     data = [str(round(v / 10.0, 3)) for v in data]
 
-    for i, column in enumerate(["spread_x", "spread_y", "spread_z"]):
-        update_dvhs_table(study_instance_uid, roi_name, column, data[i])
+    data_map = dict(zip(["spread_x", "spread_y", "spread_z"], data))
+    update_dvhs_columns(study_instance_uid, roi_name, data_map, cnx=cnx)
 
 
-def dist_to_ptv_centroids(study_instance_uid, roi_name, pre_calc=None):
+def dist_to_ptv_centroids(
+    study_instance_uid, roi_name, pre_calc=None, cnx=None
+):
     """Recalculate the OAR-to-PTV centroid distance based on data in the
     SQL DB. Optionally provide pre-calculated centroid of combined PTV
 
@@ -116,6 +109,9 @@ def dist_to_ptv_centroids(study_instance_uid, roi_name, pre_calc=None):
         name of roi
     pre_calc : np.ndarray
         Return from get_treatment_volume_centroid
+    cnx : DVH_SQL, optional
+        connection used for queries and updates. If provided, changes are
+        not committed
 
     """
 
@@ -124,6 +120,7 @@ def dist_to_ptv_centroids(study_instance_uid, roi_name, pre_calc=None):
         "centroid",
         "study_instance_uid = '%s' and roi_name = '%s'"
         % (study_instance_uid, roi_name),
+        cnx=cnx,
     )
     oar_centroid = np.array(
         [float(i) for i in oar_centroid_string[0][0].split(",")]
@@ -140,10 +137,11 @@ def dist_to_ptv_centroids(study_instance_uid, roi_name, pre_calc=None):
         roi_name,
         "dist_to_ptv_centroids",
         round(float(data), 3),
+        cnx=cnx,
     )
 
 
-def min_distances(study_instance_uid, roi_name, pre_calc=None):
+def min_distances(study_instance_uid, roi_name, pre_calc=None, cnx=None):
     """Recalculate the min, mean, median, and max PTV distances an roi based
     on data in the SQL DB.
 
@@ -155,15 +153,13 @@ def min_distances(study_instance_uid, roi_name, pre_calc=None):
         name of roi
     pre_calc : list, optional
         coordinates of combined PTV, return from get_treatment_volume_coord
+    cnx : DVH_SQL, optional
+        connection used for queries and updates. If provided, changes are
+        not committed
 
     """
 
-    oar_coordinates_string = query(
-        "dvhs",
-        "roi_coord_string",
-        "study_instance_uid = '%s' and roi_name = '%s'"
-        % (study_instance_uid, roi_name),
-    )
+    oar_planes = get_roi_planes(study_instance_uid, roi_name, cnx=cnx)
 
     if pre_calc is None:
         uid = study_instance_uid
@@ -176,19 +172,9 @@ def min_distances(study_instance_uid, roi_name, pre_calc=None):
             push_to_log(NotImplementedError, msg=msg)
 
     if pre_calc is None:
-        with DVH_SQL() as cnx:
-            ptv_coordinates_strings = cnx.query(
-                "dvhs",
-                "roi_coord_string",
-                "study_instance_uid = '%s' and roi_type like 'PTV%%'"
-                % study_instance_uid,
-            )
-
-        ptvs = [
-            roi_form.get_planes_from_string(ptv[0])
-            for ptv in ptv_coordinates_strings
-        ]
-        treatment_volume_roi = roi_geom.union(ptvs)
+        treatment_volume_roi = get_total_treatment_volume_of_study(
+            study_instance_uid, cnx=cnx
+        )
     else:
         treatment_volume_roi = pre_calc
 
@@ -200,9 +186,6 @@ def min_distances(study_instance_uid, roi_name, pre_calc=None):
         tv_shapely
     )
 
-    oar_planes = roi_form.get_planes_from_string(
-        oar_coordinates_string[0][0]
-    )
     oar_shapely = roi_form.get_shapely_from_sets_of_points(oar_planes, 0.5)
     oar_coordinates = roi_form.get_roi_coordinates_from_shapely(oar_shapely, sample_res=Options().DTH_RESOLUTION)
 
@@ -263,11 +246,12 @@ def min_distances(study_instance_uid, roi_name, pre_calc=None):
             data_map = None
 
         if data_map:
-            for key, value in data_map.items():
-                update_dvhs_table(study_instance_uid, roi_name, key, value)
+            update_dvhs_columns(
+                study_instance_uid, roi_name, data_map, cnx=cnx
+            )
 
 
-def ovh(study_instance_uid, roi_name, pre_calc=None):
+def ovh(study_instance_uid, roi_name, pre_calc=None, cnx=None):
     """Calculate the overlap volume histogram.
 
     Parameters
@@ -278,6 +262,9 @@ def ovh(study_instance_uid, roi_name, pre_calc=None):
         name of roi
     pre_calc : list, optional
         coordinates of combined PTV, return from get_treatment_volume_coord
+    cnx : DVH_SQL, optional
+        connection used for queries and updates. If provided, changes are
+        not committed
 
     """
 
@@ -285,12 +272,7 @@ def ovh(study_instance_uid, roi_name, pre_calc=None):
 
     if res > 0:
 
-        oar_coordinates_string = query(
-            "dvhs",
-            "roi_coord_string",
-            "study_instance_uid = '%s' and roi_name = '%s'"
-            % (study_instance_uid, roi_name),
-        )
+        oar_planes = get_roi_planes(study_instance_uid, roi_name, cnx=cnx)
 
         if pre_calc is None:
             uid = study_instance_uid
@@ -304,23 +286,12 @@ def ovh(study_instance_uid, roi_name, pre_calc=None):
 
         treatment_volume_roi = pre_calc
         if pre_calc is None:
-            with DVH_SQL() as cnx:
-                ptv_coordinates_strings = cnx.query(
-                    "dvhs",
-                    "roi_coord_string",
-                    "study_instance_uid = '%s' and roi_type like 'PTV%%'"
-                    % study_instance_uid,
-                )
-
-            ptvs = [
-                roi_form.get_planes_from_string(ptv[0])
-                for ptv in ptv_coordinates_strings
-            ]
-            treatment_volume_roi = roi_geom.union(ptvs)
+            treatment_volume_roi = get_total_treatment_volume_of_study(
+                study_instance_uid, cnx=cnx
+            )
 
         try:
-            oar = roi_form.get_planes_from_string(oar_coordinates_string[0][0])
-            data = get_ovh(oar, treatment_volume_roi, res=res)
+            data = get_ovh(oar_planes, treatment_volume_roi, res=res)
             ovh_string = ",".join(["%0.6f" % num for num in roi_geom.dth(data)])
 
             data_map = {
@@ -332,8 +303,9 @@ def ovh(study_instance_uid, roi_name, pre_calc=None):
                 "ovh_75": round(float(np.percentile(data, 75)), 2),
                 "ovh_string": ovh_string,
             }
-            for key, value in data_map.items():
-                update_dvhs_table(study_instance_uid, roi_name, key, value)
+            update_dvhs_columns(
+                study_instance_uid, roi_name, data_map, cnx=cnx
+            )
 
         except Exception as e:
             msg = "OVH failed for %s of study_instance_uid %s" % \
@@ -388,7 +360,9 @@ def get_ovh(oar, target, res=2):
     return voxel_data
 
 
-def treatment_volume_overlap(study_instance_uid, roi_name, pre_calc=None):
+def treatment_volume_overlap(
+    study_instance_uid, roi_name, pre_calc=None, cnx=None
+):
     """Recalculate the PTV overlap of an roi based on data in the SQL DB.
 
     Parameters
@@ -399,16 +373,13 @@ def treatment_volume_overlap(study_instance_uid, roi_name, pre_calc=None):
         name of roi
     pre_calc : dict, optional
         union of PTVs, return from get_total_treatment_volume_of_study
+    cnx : DVH_SQL, optional
+        connection used for queries and updates. If provided, changes are
+        not committed
 
     """
 
-    oar_coordinates_string = query(
-        "dvhs",
-        "roi_coord_string",
-        "study_instance_uid = '%s' and roi_name = '%s'"
-        % (study_instance_uid, roi_name),
-    )
-    oar = roi_form.get_planes_from_string(oar_coordinates_string[0][0])
+    oar = get_roi_planes(study_instance_uid, roi_name, cnx=cnx)
 
     treatment_volume = pre_calc
     if treatment_volume is None:
@@ -418,11 +389,15 @@ def treatment_volume_overlap(study_instance_uid, roi_name, pre_calc=None):
 
     overlap = roi_geom.overlap_volume(oar, treatment_volume)
     update_dvhs_table(
-        study_instance_uid, roi_name, "ptv_overlap", round(float(overlap), 2)
+        study_instance_uid,
+        roi_name,
+        "ptv_overlap",
+        round(float(overlap), 2),
+        cnx=cnx,
     )
 
 
-def volumes(study_instance_uid, roi_name):
+def volumes(study_instance_uid, roi_name, cnx=None):
     """Recalculate the volume of an roi based on data in the SQL DB.
 
     Parameters
@@ -431,26 +406,22 @@ def volumes(study_instance_uid, roi_name):
         study instance uid
     roi_name : str
         name of roi
+    cnx : DVH_SQL, optional
+        connection used for queries and updates. If provided, changes are
+        not committed
 
     """
 
-    coordinates_string = query(
-        "dvhs",
-        "roi_coord_string",
-        "study_instance_uid = '%s' and roi_name = '%s'"
-        % (study_instance_uid, roi_name),
-    )
-
-    roi = roi_form.get_planes_from_string(coordinates_string[0][0])
+    roi = get_roi_planes(study_instance_uid, roi_name, cnx=cnx)
 
     data = roi_geom.volume(roi)
 
     update_dvhs_table(
-        study_instance_uid, roi_name, "volume", round(float(data), 2)
+        study_instance_uid, roi_name, "volume", round(float(data), 2), cnx=cnx
     )
 
 
-def surface_area(study_instance_uid, roi_name):
+def surface_area(study_instance_uid, roi_name, cnx=None):
     """Recalculate the surface area of an roi based on data in the SQL DB.
 
     Parameters
@@ -459,26 +430,26 @@ def surface_area(study_instance_uid, roi_name):
         study instance uid
     roi_name : str
         name of roi
+    cnx : DVH_SQL, optional
+        connection used for queries and updates. If provided, changes are
+        not committed
 
     """
 
-    coordinates_string = query(
-        "dvhs",
-        "roi_coord_string",
-        "study_instance_uid = '%s' and roi_name = '%s'"
-        % (study_instance_uid, roi_name),
-    )
-
-    roi = roi_form.get_planes_from_string(coordinates_string[0][0])
+    roi = get_roi_planes(study_instance_uid, roi_name, cnx=cnx)
 
     data = roi_geom.surface_area(roi, coord_type="sets_of_points")
 
     update_dvhs_table(
-        study_instance_uid, roi_name, "surface_area", round(float(data), 2)
+        study_instance_uid,
+        roi_name,
+        "surface_area",
+        round(float(data), 2),
+        cnx=cnx,
     )
 
 
-def update_dvhs_table(study_instance_uid, roi_name, column, value):
+def update_dvhs_table(study_instance_uid, roi_name, column, value, cnx=None):
     """Generic function to update a value in the DVHs table
 
     Parameters
@@ -492,16 +463,44 @@ def update_dvhs_table(study_instance_uid, roi_name, column, value):
     value : str, int, float, datetime
         the value to be set, it's type should match the type as specified in
         the SQL table
+    cnx : DVH_SQL, optional
+        connection to DVHA SQL database. If provided, the update is not
+        committed
 
     """
-    with DVH_SQL() as cnx:
-        cnx.update(
-            "dvhs",
-            column,
-            value,
-            "study_instance_uid = '%s' and roi_name = '%s'"
-            % (study_instance_uid, roi_name),
-        )
+    update_dvhs_columns(study_instance_uid, roi_name, {column: value}, cnx=cnx)
+
+
+def update_dvhs_columns(study_instance_uid, roi_name, data_map, cnx=None):
+    """Update several values of a DVHs row with a single UPDATE
+
+    Parameters
+    ----------
+    study_instance_uid : str
+        study instance uid in the SQL table
+    roi_name : str
+        the roi name associated with the values to be updated
+    data_map : dict
+        values to be set, stored by SQL column
+    cnx : DVH_SQL, optional
+        connection to DVHA SQL database. If provided, the update is not
+        committed, allowing several ROIs to be updated in one transaction
+
+    """
+    if cnx is None:
+        with DVH_SQL() as cnx:
+            update_dvhs_columns(study_instance_uid, roi_name, data_map, cnx)
+            cnx.cnx.commit()
+        return
+
+    cnx.update_multicolumn(
+        "dvhs",
+        list(data_map),
+        list(data_map.values()),
+        "study_instance_uid = '%s' and roi_name = '%s'"
+        % (study_instance_uid, roi_name),
+        commit=False,
+    )
 
 
 def update_plan_toxicity_grades(cnx, study_instance_uid):
@@ -747,7 +746,9 @@ def update_ptv_data(tv, study_instance_uid):
             )
 
 
-def get_total_treatment_volume_of_study(study_instance_uid, ptvs=None):
+def get_total_treatment_volume_of_study(
+    study_instance_uid, ptvs=None, cnx=None
+):
     """Calculate combined PTV for the provided study_instance_uid
 
     Parameters
@@ -756,6 +757,8 @@ def get_total_treatment_volume_of_study(study_instance_uid, ptvs=None):
         study instance uid
     ptvs : list, optional
         names of ptvs (as stored in roi_name column)
+    cnx : DVH_SQL, optional
+        use this connection rather than creating a new one
 
     Returns
     -------
@@ -770,14 +773,10 @@ def get_total_treatment_volume_of_study(study_instance_uid, ptvs=None):
     )
     if ptvs:
         condition += " and roi_name in ('%s')" % "','".join(ptvs)
-    ptv_coordinates_strings = query("dvhs", "roi_coord_string", condition)
-
-    ptvs = [
-        roi_form.get_planes_from_string(ptv[0])
-        for ptv in ptv_coordinates_strings
-    ]
+    ptvs = [row[0] for row in query("DVHs", "roi_name", condition, cnx=cnx)]
+    planes = get_study_planes(study_instance_uid, ptvs, cnx=cnx)
 
-    return roi_geom.union(ptvs)
+    return roi_geom.union([planes[ptv] for ptv in ptvs if ptv in planes])
 
 
 def get_treatment_volume_centroid(tv):
@@ -817,7 +816,7 @@ def get_treatment_volume_coord(tv):
     return roi_form.get_roi_coordinates_from_planes(tv)
 
 
-def query(table, column, condition, unique=False):
+def query(table, column, condition, unique=False, cnx=None):
     """Helper function, automatically creates connection for query
 
     Parameters
@@ -830,6 +829,8 @@ def query(table, column, condition, unique=False):
         a condition in SQL syntax
     unique : bool, optional
         Call DVH_SQL.get_unique_values if true, DVH_SQL.query if false
+    cnx : DVH_SQL, optional
+        use this connection rather than creating a new one
 
     Returns
     -------
@@ -837,10 +838,11 @@ def query(table, column, condition, unique=False):
         return of query
 
     """
-    with DVH_SQL() as cnx:
-        func = cnx.get_unique_values if unique else cnx.query
-        ans = func(table, column, condition)
-    return ans
+    if cnx is None:
+        with DVH_SQL() as cnx:
+            return query(table, column, condition, unique=unique, cnx=cnx)
+    func = cnx.get_unique_values if unique else cnx.query
+    return func(table, column, condition)
 
 
 def uid_has_ptvs(study_instance_uid):
@@ -874,7 +876,7 @@ def update_roi_metric(
     Parameters
     ----------
     roi_metric_calc : callable
-        Function with parameters: study_instance_uid, roi_name, precalc
+        Function with parameters: study_instance_uid, roi_name, pre_calc, cnx
     uid : str
         study instance uid
     callback : callable, optional
@@ -900,18 +902,30 @@ def update_roi_metric(
         )
         rois = [row[0] for row in query("DVHs", "roi_name", condition)]
 
-        for i, roi in enumerate(rois):
-            if pre_calc is None:
-                roi_metric_calc(uid, roi)
-            else:
-                roi_metric_calc(uid, roi, pre_calc=pre_calc)
-            if callback is not None:
-                msg = {
-                    "label": "Processing (%s of %s): %s"
-                    % (i + 1, len(rois), roi),
-                    "gauge": float(i / len(rois)),
-                }
-                callback(msg)
+        # All ROIs of the study are updated in a single transaction
+        with DVH_SQL() as cnx:
+            try:
+                for i, roi in enumerate(rois):
+                    if pre_calc is None:
+                        roi_metric_calc(uid, roi, cnx=cnx)
+                    else:
+                        roi_metric_calc(uid, roi, pre_calc=pre_calc, cnx=cnx)
+                    if callback is not None:
+                        msg = {
+                            "label": "Processing (%s of %s): %s"
+                            % (i + 1, len(rois), roi),
+                            "gauge": float(i / len(rois)),
+                        }
+                        callback(msg)
+                cnx.cnx.commit()
+            except Exception as e:
+                cnx.cnx.rollback()
+                msg = (
+                    "update_roi_metric: %s failed for study_instance_uid %s, "
+                    "no ROIs of this study were updated"
+                    % (getattr(roi_metric_calc, "__name__", "calc"), uid)
+                )
+                push_to_log(e, msg=msg)
 
 
 def update_ptv_dist_data(uid, callback=None):
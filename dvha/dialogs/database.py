@@ -23,7 +23,10 @@ from dvha.db.sql_connector import (
     is_file_sqlite_db,
     write_test,
 )
+from dvha.db.sql_profiler import REPORT_COLUMNS, SQL_PROFILER
 import dvha.db.update as db_update
+from dvha.dialogs.export import save_data_to_file
+from dvha.models.data_table import DataTable
 from dvha.models.import_dicom import ImportDicomFrame
 from dvha.paths import DATA_DIR
 from dvha.tools.errors import SQLError, SQLErrorDialog
@@ -1259,3 +1262,116 @@ class RebuildDB(MessageDialog):
             inbox=self.options.IMPORTED_DIR,
             auto_parse=True,
         )
+
+
+class SQLTimingDialog(wx.Dialog):
+    """Display the SQL statements recorded by db.sql_profiler, sorted by
+    total time, so that I/O-bound views can be identified"""
+
+    def __init__(self, options):
+        """
+        :param options: user options object, SQL_PROFILING is edited
+        :type options: Options
+        """
+        wx.Dialog.__init__(self, None, title="SQL Timing Report")
+
+        self.options = options
+
+        self.checkbox_enabled = wx.CheckBox(
+            self, wx.ID_ANY, "Record SQL timing"
+        )
+        self.text_summary = wx.StaticText(self, wx.ID_ANY, "")
+        self.list_ctrl = wx.ListCtrl(
+            self,
+            wx.ID_ANY,
+            style=wx.BORDER_SUNKEN
+            | wx.LC_HRULES
+            | wx.LC_REPORT
+            | wx.LC_VRULES,
+        )
+        self.data_table = DataTable(
+            self.list_ctrl, widths=[400, 60, 80, 80, 80, 80, 400]
+        )
+        self.button_refresh = wx.Button(self, wx.ID_ANY, "Refresh")
+        self.button_reset = wx.Button(self, wx.ID_ANY, "Reset")
+        self.button_export = wx.Button(self, wx.ID_ANY, "Export CSV")
+        self.button_close = wx.Button(self, wx.ID_CANCEL, "Close")
+
+        self.__set_properties()
+        self.__do_bind()
+        self.__do_layout()
+
+        self.update_report()
+
+        self.run()
+
+    def __set_properties(self):
+        self.checkbox_enabled.SetValue(SQL_PROFILER.enabled)
+        self.checkbox_enabled.SetToolTip(
+            "Statements run while this is checked are timed. The setting is "
+            "remembered the next time DVH Analytics starts."
+        )
+
+    def __do_bind(self):
+        self.Bind(
+            wx.EVT_CHECKBOX,
+            self.on_enable,
+            id=self.checkbox_enabled.GetId(),
+        )
+        self.Bind(
+            wx.EVT_BUTTON, self.update_report, id=self.button_refresh.GetId()
+        )
+        self.Bind(wx.EVT_BUTTON, self.on_reset, id=self.button_reset.GetId())
+        self.Bind(
+            wx.EVT_BUTTON, self.on_export, id=self.button_export.GetId()
+        )
+
+    def __do_layout(self):
+        sizer_wrapper = wx.BoxSizer(wx.VERTICAL)
+        sizer_main = wx.BoxSizer(wx.VERTICAL)
+        sizer_buttons = wx.BoxSizer(wx.HORIZONTAL)
+
+        sizer_main.Add(self.checkbox_enabled, 0, wx.BOTTOM, 5)
+        sizer_main.Add(self.text_summary, 0, wx.BOTTOM, 5)
+        sizer_main.Add(self.list_ctrl, 1, wx.EXPAND, 0)
+
+        sizer_buttons.Add(self.button_refresh, 0, wx.ALL, 5)
+        sizer_buttons.Add(self.button_reset, 0, wx.ALL, 5)
+        sizer_buttons.Add(self.button_export, 0, wx.ALL, 5)
+        sizer_buttons.Add(self.button_close, 0, wx.ALL, 5)
+        sizer_main.Add(sizer_buttons, 0, wx.ALIGN_RIGHT | wx.TOP, 5)
+
+        sizer_wrapper.Add(sizer_main, 1, wx.EXPAND | wx.ALL, 10)
+
+        self.SetSizer(sizer_wrapper)
+        self.SetSize(get_window_size(0.7, 0.6))
+        self.Center()
+
+    def run(self):
+        self.ShowModal()
+        self.Destroy()
+
+    def update_report(self, *evt):
+        self.data_table.set_data(SQL_PROFILER.get_report(), REPORT_COLUMNS)
+        self.text_summary.SetLabel(
+            "%s distinct statements recorded (literals are replaced by ?)"
+            % SQL_PROFILER.statement_count
+        )
+        self.button_export.Enable(SQL_PROFILER.statement_count > 0)
+
+    def on_enable(self, *evt):
+        SQL_PROFILER.enabled = self.checkbox_enabled.GetValue()
+        self.options.set_option("SQL_PROFILING", SQL_PROFILER.enabled)
+        self.options.save()
+
+    def on_reset(self, *evt):
+        SQL_PROFILER.reset()
+        self.update_report()
+
+    def on_export(self, *evt):
+        save_data_to_file(
+            self,
+            "Save SQL timing report to csv",
+            SQL_PROFILER.save_csv,
+            data_type="function",
+        )
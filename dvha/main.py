@@ -22,8 +22,9 @@ from datetime import datetime
 import webbrowser
 from pubsub import pub
 from dvha.db import sql_columns
-from dvha.db.sql_to_python import QuerySQL
 from dvha.db.sql_connector import echo_sql_db, initialize_db
+from dvha.db.connection_pool import close_all_connections
+from dvha.db.sql_profiler import SQL_PROFILER
 from dvha.dialogs.main import (
     query_dlg,
     UserSettings,
@@ -31,7 +32,7 @@ from dvha.dialogs.main import (
     PythonLibraries,
     do_sqlite_backup,
 )
-from dvha.dialogs.database import SQLSettingsDialog
+from dvha.dialogs.database import SQLSettingsDialog, SQLTimingDialog
 from dvha.dialogs.export import (
     ExportCSVDialog,
     ExportFigure,
@@ -41,7 +42,12 @@ from dvha.models.import_dicom import ImportDicomFrame
 from dvha.models.database_editor import DatabaseEditorFrame
 from dvha.models.data_table import DataTable
 from dvha.models.plot import PlotStatDVH
-from dvha.models.dvh import DVH
+from dvha.models.query_cache import QUERY_CACHE
+from dvha.models.query_executor import (
+    MIN_DVH_COUNT,
+    QueryExecutor,
+    query_table_data,
+)
 from dvha.models.endpoint import EndpointFrame
 from dvha.models.queried_data import QueriedDataFrame
 from dvha.models.rad_bio import RadBioFrame
@@ -66,7 +72,7 @@ from dvha.tools.errors import (
 from dvha.tools.roi_name_manager import DatabaseROIs
 from dvha.tools.stats import StatsData, sync_variables_in_stats_data_objects
 from dvha.tools.utilities import (
-    get_study_instance_uids,
+    get_common_study_instance_uids,
     scale_bitmap,
     is_windows,
     is_linux,
@@ -166,9 +172,12 @@ class DVHAMainFrame(wx.Frame):
 
         self.options = Options()
         self.SetMinSize(self.options.MIN_RESOLUTION_MAIN)
+        SQL_PROFILER.enabled = self.options.SQL_PROFILING
+        QUERY_CACHE.disk_enabled = self.options.QUERY_CACHE_ON_DISK
 
         # Initial DVH object and data
         self.save_data = {}
+        self.query_executor = QueryExecutor()
         self.group_data = {
             1: {
                 "dvh": None,
@@ -388,6 +397,21 @@ class DVHAMainFrame(wx.Frame):
         self.data_menu.AppendSubMenu(load_model, "Load &Model")
         self.data_menu.AppendSubMenu(export, "&Export")
         menu_db_backup = self.data_menu.Append(wx.ID_ANY, "Backup SQLite DB")
+        menu_sql_timing = self.data_menu.Append(
+            wx.ID_ANY, "SQL Timing Report"
+        )
+        self.menu_federated = self.data_menu.AppendCheckItem(
+            wx.ID_ANY,
+            "Federated Query",
+            "Query the databases of groups 1 and 2, and merge the results",
+        )
+        self.menu_federated.Check(self.options.QUERY_FEDERATED)
+        self.menu_query_cache_on_disk = self.data_menu.AppendCheckItem(
+            wx.ID_ANY,
+            "Cache Queries on Disk",
+            "Keep query results, including patient data, between sessions",
+        )
+        self.menu_query_cache_on_disk.Check(self.options.QUERY_CACHE_ON_DISK)
         self.data_menu.AppendSeparator()
         self.data_menu_items = {
             "DVHs": self.data_menu.Append(wx.ID_ANY, "Show DVHs\tCtrl+1"),
@@ -449,6 +473,13 @@ class DVHAMainFrame(wx.Frame):
 
         self.Bind(wx.EVT_MENU, self.on_toolbar_database, menu_db_admin)
         self.Bind(wx.EVT_MENU, self.on_sqlite_backup, menu_db_backup)
+        self.Bind(wx.EVT_MENU, self.on_sql_timing, menu_sql_timing)
+        self.Bind(wx.EVT_MENU, self.on_federated, self.menu_federated)
+        self.Bind(
+            wx.EVT_MENU,
+            self.on_query_cache_on_disk,
+            self.menu_query_cache_on_disk,
+        )
         self.Bind(wx.EVT_MENU, self.on_view_dvhs, self.data_menu_items["DVHs"])
         self.Bind(
             wx.EVT_MENU, self.on_view_plans, self.data_menu_items["Plans"]
@@ -499,6 +530,8 @@ class DVHAMainFrame(wx.Frame):
         self.button_query_execute = wx.Button(
             self, wx.ID_ANY, "Query and Retrieve Group 1"
         )
+        self.gauge_query = wx.Gauge(self, wx.ID_ANY, 100)
+        self.text_query_status = wx.StaticText(self, wx.ID_ANY, "")
 
         self.notebook_main_view = wx.Notebook(self, wx.ID_ANY)
         self.tab_keys = [
@@ -730,6 +763,10 @@ class DVHAMainFrame(wx.Frame):
         panel_left.Add(
             sizer_query_exec_buttons, 0, wx.EXPAND | wx.RIGHT | wx.LEFT, 5
         )
+        panel_left.Add(
+            self.text_query_status, 0, wx.EXPAND | wx.RIGHT | wx.LEFT, 5
+        )
+        panel_left.Add(self.gauge_query, 0, wx.EXPAND | wx.RIGHT | wx.LEFT, 5)
         panel_left.Add(sizer_summary, 1, wx.ALL | wx.EXPAND, 5)
 
         bitmap_logo = wx.StaticBitmap(
@@ -883,6 +920,10 @@ class DVHAMainFrame(wx.Frame):
         if self.selected_group == 2 and self.group_data[1]["dvh"] is None:
             self.button_query_execute.Disable()
 
+        # A query in progress can always be cancelled
+        if self.query_executor.is_running(self.selected_group):
+            self.button_query_execute.Enable()
+
     def __catch_failed_sql_connection_on_app_launch(self):
         if self.options.DB_TYPE_GRPS[1] == "pgsql":
             if not echo_sql_db():
@@ -984,6 +1025,10 @@ class DVHAMainFrame(wx.Frame):
         return self.radio_button_query_group.GetSelection() + 1
 
     def save_data_obj(self):
+        # saved sessions do not depend on the database, see DVH.__getstate__
+        for group_data in self.group_data.values():
+            if group_data["dvh"] and group_data["dvh"].count:
+                group_data["dvh"].load_dvhs()
         self.save_data["group_data"] = self.group_data
         self.save_data["query_filters"] = self.query_filters
         self.save_data["time_stamp"] = datetime.now()
@@ -1088,6 +1133,23 @@ class DVHAMainFrame(wx.Frame):
     def on_sqlite_backup(self, *evt):
         wx.CallAfter(do_sqlite_backup, self, self.options)
 
+    def on_sql_timing(self, *evt):
+        SQLTimingDialog(self.options)
+
+    def on_federated(self, *evt):
+        self.options.set_option(
+            "QUERY_FEDERATED", self.menu_federated.IsChecked()
+        )
+        self.options.save()
+
+    def on_query_cache_on_disk(self, *evt):
+        enabled = self.menu_query_cache_on_disk.IsChecked()
+        QUERY_CACHE.disk_enabled = enabled
+        if not enabled:
+            QUERY_CACHE.clear_disk()
+        self.options.set_option("QUERY_CACHE_ON_DISK", enabled)
+        self.options.save()
+
     def call_sqlite_backup(self):
         if self.options.AUTO_SQL_DB_BACKUP:
             self.on_sqlite_backup()
@@ -1189,18 +1251,88 @@ class DVHAMainFrame(wx.Frame):
         self.update_all_query_buttons()
 
     def exec_query_button(self, evt):
-        self.exec_query()
+        if self.query_executor.is_running(self.selected_group):
+            self.query_executor.cancel(self.selected_group)
+            self.update_query_status()
+        else:
+            self.exec_query()
 
     def exec_query(self, load_saved_dvh_data=False, group=None):
 
         # Used to make sure Correlation calculation error of patient removal is only displayed once after a query
         self.correlation_error_displayed = False
 
-        wx.BeginBusyCursor()
         if group is not None:
             self.radio_button_query_group.SetSelection(group - 1)
         group = self.selected_group
 
+        if load_saved_dvh_data:
+            self.apply_query(group, load_saved_dvh_data=True)
+            return
+
+        # DVH, plan, and stats data are queried in a background thread,
+        # see on_query_complete
+        self.query_executor.submit(
+            group,
+            self.get_query_conditions(),
+            self.options.dvh_bin_width,
+            on_progress=self.on_query_progress,
+            on_complete=self.on_query_complete,
+            on_error=self.on_query_error,
+            federated=self.options.QUERY_FEDERATED,
+        )
+        self.update_query_status()
+
+    def on_query_progress(self, job, stage_index, stage_count, stage):
+        if job.cancelled:
+            return
+        self.gauge_query.SetValue(int(100 * stage_index / stage_count))
+        label = "Querying Group %s: %s" % (job.group, stage)
+        self.text_query_status.SetLabelText(label if stage else "")
+
+    def on_query_complete(self, job):
+        if not self.query_executor.finish(job):
+            return
+        self.update_query_status()
+        self.group_data[job.group]["dvh"] = job.dvh
+        if job.data is not None:
+            self.group_data[job.group]["data"] = job.data
+            self.group_data[job.group]["stats_data"] = job.stats_data
+        self.apply_query(job.group)
+
+    def on_query_error(self, job, exception):
+        if not self.query_executor.finish(job):
+            return
+        self.update_query_status()
+        if isinstance(exception, MemoryError):
+            msg = (
+                "Querying memory error. Try querying less data.\n"
+                "NOTE: Threshold of this error is dependent on your computer."
+            )
+            MemoryErrorDialog(self, msg)
+            self.close()
+            return
+        raise exception
+
+    def update_query_status(self):
+        """Update the query button, gauge, and status text for the query
+        jobs in progress"""
+        group = self.selected_group
+        label = "Query and Retrieve Group %s" % group
+        if self.query_executor.is_running(group):
+            label = "Cancel Group %s Query" % group
+        self.button_query_execute.SetLabelText(label)
+
+        if not any(self.query_executor.is_running(g) for g in [1, 2]):
+            self.gauge_query.SetValue(0)
+            self.text_query_status.SetLabelText("")
+
+        self.update_all_query_buttons()
+
+    def apply_query(self, group, load_saved_dvh_data=False):
+        """Update the GUI with the query results stored in group_data"""
+        wx.BeginBusyCursor()
+
         # TODO: retain group 1 endpoint defs after query of group 2
         self.endpoint.clear_data()
 
@@ -1211,28 +1343,8 @@ class DVHAMainFrame(wx.Frame):
             self.control_chart.clear_data()
             self.radbio.clear_data()
 
-        if not load_saved_dvh_data:
-            try:
-                uids, dvh_str = self.get_query()
-                self.group_data[group]["dvh"] = DVH(
-                    dvh_condition=dvh_str,
-                    uid=uids,
-                    dvh_bin_width=self.options.dvh_bin_width,
-                    group=group,
-                )
-            except MemoryError:
-                msg = (
-                    "Querying memory error. Try querying less data. At least %s DVHs returned.\n"
-                    "NOTE: Threshold of this error is dependent on your computer."
-                    % self.group_data[group]["dvh"].count
-                )
-                MemoryErrorDialog(self, msg)
-                self.close()
-                return
-
         count = self.group_data[group]["dvh"].count
-        min_dvh_count = 3
-        if count >= min_dvh_count:
+        if count >= MIN_DVH_COUNT:
             try:
                 self.endpoint.update_dvh(self.group_data)
                 self.set_summary_text(group)
@@ -1243,6 +1355,7 @@ class DVHAMainFrame(wx.Frame):
                 self.update_data(
                     load_saved_dvh_data=load_saved_dvh_data,
                     group_2_only=bool(group - 1),
+                    queried_group=group,
                 )
 
                 if group == 1:
@@ -1268,14 +1381,29 @@ class DVHAMainFrame(wx.Frame):
             wx.EndBusyCursor()
             msg = (
                 "%s DVHs returned. Please modify query or import more data."
-                % ["Less than %s" % min_dvh_count, "No"][count == 0]
+                % ["Less than %s" % MIN_DVH_COUNT, "No"][count == 0]
             )
             wx.MessageBox(
                 msg, "Query Error", wx.OK | wx.OK_DEFAULT | wx.ICON_WARNING
             )
             self.group_data[group]["dvh"] = None
 
-    def get_query(self):
+    def get_query(self, queries=None, group=1):
+        queries = self.get_query_conditions() if queries is None else queries
+
+        # DVHs condition is included so that studies without a matching DVH
+        # are not passed to the DVH class
+        uids = get_common_study_instance_uids(
+            group=group,
+            plans=queries["Plans"],
+            rxs=queries["Rxs"],
+            beams=queries["Beams"],
+            dvhs=queries["DVHs"],
+        )
+
+        return uids, queries["DVHs"]
+
+    def get_query_conditions(self):
 
         # Used to accumulate lists of query strings for each table
         # Will assume each item in list is complete query for that SQL column
@@ -1377,26 +1505,23 @@ class DVHAMainFrame(wx.Frame):
                 )
             queries[table] = " AND ".join(queries[table])
 
-        uids = get_study_instance_uids(
-            plans=queries["Plans"], rxs=queries["Rxs"], beams=queries["Beams"]
-        )["common"]
-
-        return uids, queries["DVHs"]
+        return queries
 
-    def update_data(self, load_saved_dvh_data=False, group_2_only=False):
+    def update_data(
+        self, load_saved_dvh_data=False, group_2_only=False, queried_group=None
+    ):
         wx.BeginBusyCursor()
         tables = ["Plans", "Rxs", "Beams"]
         for grp, grp_data in self.group_data.items():
             if not (grp == 1 and group_2_only) or grp == 2:
                 if hasattr(grp_data["dvh"], "study_instance_uid"):
-                    if not load_saved_dvh_data:
-                        condition_str = (
-                            "study_instance_uid in ('%s')"
-                            % "','".join(grp_data["dvh"].study_instance_uid)
-                        )
-                        grp_data["data"] = {
-                            key: QuerySQL(key, condition_str) for key in tables
-                        }
+                    # data of each group is set by its own QueryJob, so only
+                    # StatsData of the other group needs to be rebuilt
+                    if not load_saved_dvh_data and grp != queried_group:
+                        if grp_data["data"]["Plans"] is None:
+                            grp_data["data"] = query_table_data(
+                                grp_data["dvh"], group=grp
+                            )
                         grp_data["stats_data"] = StatsData(
                             grp_data["dvh"], grp_data["data"], group=grp
                         )
@@ -1451,6 +1576,7 @@ class DVHAMainFrame(wx.Frame):
         self.regression.close_mvr_frames()
 
     def on_quit(self, evt):
+        self.query_executor.cancel()
         self.close_windows()
         self.Destroy()
 
@@ -1474,6 +1600,8 @@ class DVHAMainFrame(wx.Frame):
             dlg.Destroy()
 
     def close(self):
+        self.query_executor.cancel()
+        self.update_query_status()
         self.group_data = {
             1: {
                 "dvh": None,
@@ -1758,9 +1886,7 @@ class DVHAMainFrame(wx.Frame):
         group = self.selected_group
         other = 3 - group
 
-        self.button_query_execute.SetLabelText(
-            "Query and Retrieve Group %s" % group
-        )
+        self.update_query_status()
 
         self.query_filters[other] = {
             "main_categorical": self.data_table_categorical.get_save_data(),
@@ -1858,6 +1984,7 @@ class MainApp(wx.App):
 
     def OnExit(self):
         self.frame.options.save()
+        close_all_connections()
         for window in wx.GetTopLevelWindows():
             wx.CallAfter(window.Close)
         return super().OnExit()
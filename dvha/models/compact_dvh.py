@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# models.compact_dvh.py
+"""
+DVHs stored end to end without zero padding, with the column access of the
+zero-padded dvh[bin, roi_index] matrix used by models.dvh.DVH
+"""
+# Copyright (c) 2016-2019 Dan Cutright
+# This file is part of DVH Analytics, released under a BSD license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/cutright/DVH-Analytics
+
+import numpy as np
+
+
+DVH_DTYPE = np.dtype(np.float32)
+QUANTIZED_DTYPE = np.dtype(np.uint16)
+QUANTIZED_SCALE = 1.0 / np.iinfo(QUANTIZED_DTYPE).max
+DENSE_BLOCK_SIZE = 2 ** 22  # max values of a zero-padded block
+
+
+class CompactDVHs:
+    """Normalized DVHs without zero padding. DVH i is
+    values[offsets[i]:offsets[i] + lengths[i]], bins past its length are
+    zero. Indexing (e.g., dvhs[:, i] or dvhs[bins, rois]) and np.asarray
+    return float32 values as if zero padded to bin_count.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        values of all DVHs, float32, or uint16 multiples of scale
+    lengths : np.ndarray
+        number of values of each DVH
+    bin_count : int, optional
+        number of dose bins, at least the max of lengths
+    scale : float, optional
+        the DVH value of 1 in values, if values are quantized
+    """
+
+    ndim = 2
+    dtype = DVH_DTYPE
+
+    def __init__(self, values, lengths, bin_count=None, scale=None):
+        self.values = values
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths)))
+        max_length = int(np.max(self.lengths)) if len(self.lengths) else 0
+        self.bin_count = max(max_length, bin_count or 0)
+        self.scale = scale
+
+    @classmethod
+    def from_dense(cls, dvhs):
+        """Remove the zero padding of DVHs
+
+        Parameters
+        ----------
+        dvhs : np.ndarray
+            zero-padded DVHs (dvh[bin, roi_index])
+
+        Returns
+        -------
+        CompactDVHs
+            DVHs of ``dvhs``, without trailing zeros
+        """
+        dvhs = np.asarray(dvhs, dtype=DVH_DTYPE)
+        bin_count, count = dvhs.shape
+        if not dvhs.size:
+            lengths = np.zeros(count, dtype=np.int64)
+            return cls(np.zeros(0, dtype=DVH_DTYPE), lengths, bin_count)
+        is_nonzero = dvhs[::-1] != 0
+        lengths = bin_count - np.argmax(is_nonzero, axis=0)
+        lengths[~np.any(is_nonzero, axis=0)] = 0
+        is_dvh = np.arange(bin_count) < lengths[:, np.newaxis]
+        return cls(dvhs.T[is_dvh], lengths, bin_count=bin_count)
+
+    @classmethod
+    def concatenate(cls, dvhs):
+        """Combine CompactDVHs, e.g., of DVH objects from several databases
+
+        Parameters
+        ----------
+        dvhs : list
+            CompactDVHs objects
+
+        Returns
+        -------
+        CompactDVHs
+            DVHs of ``dvhs`` in order, quantized only if all are quantized
+        """
+        is_quantized = all(d.is_quantized for d in dvhs)
+        return cls(
+            np.concatenate(
+                [d.values if is_quantized else d.get_values() for d in dvhs]
+            ),
+            np.concatenate([d.lengths for d in dvhs]),
+            bin_count=max(d.bin_count for d in dvhs),
+            scale=QUANTIZED_SCALE if is_quantized else None,
+        )
+
+    @property
+    def count(self):
+        """Number of DVHs"""
+        return len(self.lengths)
+
+    @property
+    def shape(self):
+        """Shape of the equivalent zero-padded matrix"""
+        return self.bin_count, self.count
+
+    @property
+    def nbytes(self):
+        """Memory used by values, lengths, and offsets"""
+        return self.values.nbytes + self.lengths.nbytes + self.offsets.nbytes
+
+    @property
+    def is_quantized(self):
+        return self.scale is not None
+
+    def quantize(self):
+        """Round values to multiples of 1/65535, stored as uint16. Values
+        should be normalized to 1 or less (see db.dvh_store)
+
+        Returns
+        -------
+        CompactDVHs
+            DVHs using half the memory of float32 values
+        """
+        if self.is_quantized:
+            return self
+        values = np.empty(len(self.values), dtype=QUANTIZED_DTYPE)
+        for start in range(0, len(values), DENSE_BLOCK_SIZE):
+            block = self.values[start : start + DENSE_BLOCK_SIZE]
+            values[start : start + len(block)] = np.rint(
+                np.clip(block, 0, 1) / QUANTIZED_SCALE
+            )
+        return CompactDVHs(
+            values, self.lengths, self.bin_count, scale=QUANTIZED_SCALE
+        )
+
+    def get_values(self):
+        """Get the values of all DVHs as float32"""
+        if not self.is_quantized:
+            return self.values
+        return self.values * DVH_DTYPE.type(self.scale)
+
+    def get_dvh(self, index):
+        """Get one DVH without zero padding
+
+        Parameters
+        ----------
+        index : int
+            index of the DVH
+
+        Returns
+        -------
+        np.ndarray
+            float32 values of the DVH, a view of values if not quantized
+        """
+        index = range(self.count)[index]
+        values = self.values[self.offsets[index] : self.offsets[index + 1]]
+        if self.is_quantized:
+            return values * DVH_DTYPE.type(self.scale)
+        return values
+
+    def multiply(self, factors):
+        """Multiply each DVH by a factor, e.g., to convert to absolute volume
+
+        Parameters
+        ----------
+        factors : list, np.ndarray
+            one factor per DVH
+
+        Returns
+        -------
+        CompactDVHs
+            float32 DVHs scaled by ``factors``
+        """
+        factors = np.asarray(factors, dtype=float)
+        if self.is_quantized:
+            factors = factors * self.scale
+        values = np.empty(len(self.values), dtype=DVH_DTYPE)
+        for rois, start, end in self._iter_value_blocks():
+            values[start:end] = self.values[start:end] * np.repeat(
+                factors[rois], self.lengths[rois]
+            )
+        return CompactDVHs(values, self.lengths, self.bin_count)
+
+    def take(self, bins, rois):
+        """Get the values of dose bins of DVHs, zero past the end of a DVH
+
+        Parameters
+        ----------
+        bins : int, np.ndarray
+            dose bin indices
+        rois : int, np.ndarray
+            DVH indices, broadcast with ``bins``
+
+        Returns
+        -------
+        np.ndarray
+            float32 values with the broadcast shape of ``bins`` and ``rois``
+        """
+        bins, rois = np.broadcast_arrays(
+            np.asarray(bins, dtype=np.int64), np.asarray(rois, dtype=np.int64)
+        )
+        is_valid = (bins >= 0) & (bins < self.lengths[rois])
+        indices = np.where(is_valid, self.offsets[rois] + bins, 0)
+        if not len(self.values):
+            return np.zeros(indices.shape, dtype=DVH_DTYPE)
+        values = self.values[indices].astype(DVH_DTYPE)
+        if self.is_quantized:
+            values *= DVH_DTYPE.type(self.scale)
+        values[~is_valid] = 0
+        return values
+
+    def to_dense(self, rois=None, bins=None):
+        """Get zero-padded DVHs
+
+        Parameters
+        ----------
+        rois : int, slice, np.ndarray, optional
+            DVHs to include, all if None
+        bins : int, slice, np.ndarray, optional
+            dose bins to include, all if None
+
+        Returns
+        -------
+        np.ndarray
+            float32 DVHs (dvh[bin, roi_index])
+        """
+        # consecutive DVHs are copied from one slice of values
+        if rois is None:
+            rois = slice(None)
+        if np.ndim(rois) == 0 and not isinstance(rois, slice):
+            dvh = np.zeros(self.bin_count, dtype=DVH_DTYPE)
+            values = self.get_dvh(rois)
+            dvh[: len(values)] = values
+            return dvh if bins is None else dvh[bins]
+        if bins is None and isinstance(rois, slice):
+            start, stop, step = rois.indices(self.count)
+            if step == 1:
+                return self._pad(start, max(start, stop)).T
+
+        bins = np.arange(self.bin_count)[slice(None) if bins is None else bins]
+        rois = np.arange(self.count)[slice(None) if rois is None else rois]
+        if bins.ndim and rois.ndim:
+            bins = bins[:, np.newaxis]
+        return self.take(bins, rois)
+
+    def iter_dense_blocks(self, block_size=DENSE_BLOCK_SIZE):
+        """Iterate over consecutive DVHs, zero padded to bin_count
+
+        Parameters
+        ----------
+        block_size : int, optional
+            max values of each block
+
+        Yields
+        ------
+        tuple
+            slice of the DVHs in the block, and the zero-padded DVHs
+            (dvh[bin, roi_index])
+        """
+        step = max(1, block_size // max(1, self.bin_count))
+        for start in range(0, self.count, step):
+            rois = slice(start, min(start + step, self.count))
+            yield rois, self.to_dense(rois=rois)
+
+    def reduce_bins(self, function, block_size=DENSE_BLOCK_SIZE):
+        """Apply a statistical function to the DVHs of each dose bin, one
+        zero-padded block of dose bins at a time
+
+        Parameters
+        ----------
+        function : callable
+            accepts zero-padded DVHs (dvh[bin, roi_index]) and returns one
+            value per bin along the last axis, e.g., lambda d: np.mean(d, 1)
+        block_size : int, optional
+            max values of each block
+
+        Returns
+        -------
+        np.ndarray
+            results of ``function`` for all dose bins
+        """
+        step = max(1, block_size // max(1, self.count))
+        results = [
+            function(self.to_dense(bins=slice(start, start + step)))
+            for start in range(0, self.bin_count, step)
+        ]
+        if not results:
+            return function(np.zeros((0, self.count), dtype=DVH_DTYPE))
+        return np.concatenate(results, axis=-1)
+
+    def _pad(self, start, stop):
+        """Zero pad consecutive DVHs, as rows (dvh[roi_index, bin])"""
+        lengths = self.lengths[start:stop]
+        rows = np.zeros((len(lengths), self.bin_count), dtype=DVH_DTYPE)
+        is_dvh = np.arange(self.bin_count) < lengths[:, np.newaxis]
+        rows[is_dvh] = self.values[self.offsets[start] : self.offsets[stop]]
+        if self.is_quantized:
+            rows *= DVH_DTYPE.type(self.scale)
+        return rows
+
+    def _iter_value_blocks(self):
+        """Iterate over DVHs in blocks of about DENSE_BLOCK_SIZE values, as
+        (slice of DVHs, start, end) of their values"""
+        start = 0
+        while start < self.count:
+            end = int(
+                np.searchsorted(
+                    self.offsets,
+                    self.offsets[start] + DENSE_BLOCK_SIZE,
+                    side="right",
+                )
+            )
+            end = min(self.count, max(start + 1, end - 1))
+            yield slice(start, end), self.offsets[start], self.offsets[end]
+            start = end
+
+    def __getitem__(self, key):
+        bins, rois = key
+        if isinstance(bins, slice) or isinstance(rois, slice):
+            return self.to_dense(rois=rois, bins=bins)
+        return self.take(bins, rois)
+
+    def __array__(self, dtype=None, copy=None):
+        dvhs = self.to_dense()
+        return dvhs if dtype is None else dvhs.astype(dtype)
+
+    def __len__(self):
+        return self.bin_count
@@ -344,7 +344,10 @@ class DatabaseEditorFrame(wx.Frame):
         tree = get_database_tree()
         for table in list(tree):
             tree[table] = [
-                column for column in tree[table] if "string" not in column
+                column
+                for column in tree[table]
+                if "string" not in column
+                and column not in {"dvh_curve", "contours"}
             ]
         return tree
 
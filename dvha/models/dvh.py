@@ -12,13 +12,19 @@ Class to retrieve DVH data from SQL, calculate parameters dependent on DVHs, and
 
 from copy import deepcopy
 from dateutil.parser import parse as date_parser
+from threading import RLock
 import numpy as np
 from dvha.db.sql_connector import DVH_SQL
+from dvha.db.dvh_store import get_dvh_store, get_normalized_dvh_ragged
 from dvha.db.sql_to_python import QuerySQL
+from dvha.models.compact_dvh import CompactDVHs
 from dvha.options import Options
+from dvha.tools.errors import push_to_log
 
 
 MAX_DOSE_VOLUME = Options().MAX_DOSE_VOLUME
+DVH_COLUMNS = {"dvh_curve", "dvh_string"}  # queried by DVH.parse_dvhs
+ENDPOINT_CHUNK_SIZE = 2 ** 25  # max DVH bins compared per pass of endpoints
 
 
 # This class retrieves DVH data from the SQL database and calculates statistical DVHs (min, max, quartiles)
@@ -37,11 +43,29 @@ class DVH:
         retrieve every nth value from dvh_string in SQL
     group : int
         either 1 or 2
+    lazy : bool, optional
+        only load the DVH metadata, the DVH curves (dvh and bin_count) are
+        loaded on first access, see load_dvhs
 
     """
 
-    def __init__(self, uid=None, dvh_condition=None, dvh_bin_width=5, group=1):
+    # Plans and Rxs columns fetched with the DVHs, see load_plan_and_rx_values
+    plan_columns = ["rx_dose", "sim_study_date", "fxs", "tx_site", "physician"]
+    rx_columns = ["fx_dose"]
+
+    _dvh = None
+    _bin_count = None
+
+    def __init__(
+        self,
+        uid=None,
+        dvh_condition=None,
+        dvh_bin_width=5,
+        group=1,
+        lazy=False,
+    ):
         self.dvh_bin_width = dvh_bin_width
+        self.group = group
 
         constraints_str = ""
         if uid:
@@ -54,8 +78,13 @@ class DVH:
         elif dvh_condition:
             constraints_str = dvh_condition
 
-        # Get DVH data from SQL and set as attributes
-        dvh_data = QuerySQL("DVHs", constraints_str, group=group)
+        # Get DVH metadata from SQL and set as attributes, the DVH curves
+        # are loaded separately by load_dvhs
+        with DVH_SQL(group=group) as cnx:
+            columns = set(cnx.get_column_names("DVHs")) - DVH_COLUMNS
+        dvh_data = QuerySQL(
+            "DVHs", constraints_str, columns=columns, group=group
+        )
         if dvh_data.mrn:
             ignored_keys = {
                 "cnx",
@@ -67,13 +96,8 @@ class DVH:
             self.keys = []
             for key, value in dvh_data.__dict__.items():
                 if not key.startswith("__") and key not in ignored_keys:
-                    if key == "dvh_string":
-                        dvh_split = [
-                            dvh.split(",")[:: self.dvh_bin_width]
-                            for dvh in value
-                        ]
                     setattr(self, key, value)
-                    if "_string" not in key:
+                    if "_string" not in key and key != "dvh_curve":
                         self.keys.append(key)
 
             # Move mrn to beginning of self.keys
@@ -87,27 +111,17 @@ class DVH:
             # Add these properties to dvh_data since they aren't in the DVHs SQL table
             self.count = len(self.mrn)
             self.study_count = len(set(self.uid))
+            self.load_plan_and_rx_values(self.plan_columns, self.rx_columns)
             self.rx_dose = self.get_plan_values("rx_dose")
             self.sim_study_date = self.get_plan_values("sim_study_date")
             self.keys.append("rx_dose")
             self.endpoints = {"data": None, "defs": None}
+            self.endpoint_cache = {}  # see get_endpoint_values
             self.eud = None
             self.ntcp_or_tcp = None
 
-            self.bin_count = max([len(dvh) for dvh in dvh_split])
-
-            self.dvh = np.zeros([self.bin_count, self.count])
-
-            # Get needed values not in DVHs table
-            for i in range(self.count):
-                # Process dvh_string to numpy array, and pad with zeros at the end
-                # so that all dvhs are the same length
-                current_dvh = np.array(dvh_split[i], dtype=np.float)
-                current_dvh_max = np.max(current_dvh)
-                if current_dvh_max > 0:
-                    current_dvh = np.divide(current_dvh, current_dvh_max)
-                zero_fill = np.zeros(self.bin_count - len(current_dvh))
-                self.dvh[:, i] = np.concatenate((current_dvh, zero_fill))
+            if not lazy:
+                self.load_dvhs()
 
             self.dth = []
             for i in range(self.count):
@@ -120,19 +134,201 @@ class DVH:
                     self.dth.append(np.array([0]))
 
             # Store these now so they can be saved in DVH object without needing to query later
-            with DVH_SQL() as cnx:
-                self.physician_count = len(
-                    cnx.get_unique_values(
-                        "Plans",
-                        "physician",
-                        "study_instance_uid in ('%s')" % "','".join(self.uid),
-                    )
-                )
+            self.physician_count = len(
+                set(self.plan_values["physician"].values())
+            )
             self.total_fxs = self.get_plan_values("fxs")
             self.fx_dose = self.get_rx_values("fx_dose")
         else:
             self.count = 0
 
+    def get_dvhs_from_store(self, uids, roi_names):
+        """Get DVHs from the DVH store (see db.dvh_store), after applying
+        any changes to the DVHs table and filling the rows of these DVHs
+
+        Parameters
+        ----------
+        uids : list
+            study_instance_uid of each DVH
+        roi_names : list
+            roi_name of each DVH
+
+        Returns
+        -------
+        CompactDVHs, None
+            normalized DVHs, None if any DVH is not in the store
+        """
+        keys = list(zip(uids, roi_names))
+        try:
+            with DVH_SQL(group=self.group) as cnx:
+                store = get_dvh_store(cnx)
+                store.sync(cnx, bin_widths=[self.dvh_bin_width], keys=keys)
+            dvhs = store.get_ragged_dvhs(keys, self.dvh_bin_width)
+            if dvhs is not None:
+                return CompactDVHs(*dvhs)
+        except Exception as e:
+            push_to_log(e, msg="DVH: Could not load DVHs from the DVH store")
+
+    @property
+    def dvh(self):
+        """Normalized DVHs (dvh[bin, roi_index]) as CompactDVHs, loaded on
+        first access if this object was created with lazy=True"""
+        if self._dvh is None:
+            self.load_dvhs()
+        return self._dvh
+
+    @dvh.setter
+    def dvh(self, value):
+        self._dvh = value
+
+    @property
+    def bin_count(self):
+        """Number of dose bins of dvh"""
+        if self._bin_count is None:
+            self.load_dvhs()
+        return self._bin_count
+
+    @bin_count.setter
+    def bin_count(self, value):
+        self._bin_count = value
+
+    @property
+    def is_loaded(self):
+        """True if the DVH curves have been loaded"""
+        return self._dvh is not None
+
+    def load_dvhs(self):
+        """Load the DVH curves of the queried DVHs, sliced from the
+        memory-mapped DVH store if possible, otherwise parsed from SQL"""
+        # DVH objects created by merge_dvhs or unpickled have no lock yet
+        with self.__dict__.setdefault("_load_lock", RLock()):
+            if self._dvh is not None:
+                return
+            dvhs = None
+            if self.count:
+                dvhs = self.get_dvhs_from_store(
+                    self.study_instance_uid, self.roi_name
+                )
+            if dvhs is None:
+                dvhs = self.parse_dvhs()
+            if Options().DVH_QUANTIZED:
+                dvhs = dvhs.quantize()
+            self._bin_count = dvhs.bin_count
+            self._dvh = dvhs
+
+    def parse_dvhs(self):
+        """Query the dvh_curve and dvh_string columns of the DVHs, and parse
+        them without zero padding
+
+        Returns
+        -------
+        CompactDVHs
+            normalized DVHs
+        """
+        dvh_curves = [None] * self.count
+        dvh_strings = [None] * self.count
+        if self.count:
+            rows = {}
+            keys = zip(self.study_instance_uid, self.roi_name)
+            for i, key in enumerate(keys):
+                rows.setdefault(key, []).append(i)
+            condition = "study_instance_uid in ('%s')" % "', '".join(
+                sorted(set(self.study_instance_uid))
+            )
+            with DVH_SQL(group=self.group) as cnx:
+                # dvh_curve does not exist in databases older than 0.9.8
+                curve_column = ["NULL", "dvh_curve"][
+                    "dvh_curve" in cnx.get_column_names("DVHs")
+                ]
+                results = cnx.query(
+                    "DVHs",
+                    "study_instance_uid, roi_name, %s, dvh_string"
+                    % curve_column,
+                    condition,
+                )
+            # DVHs may be stored in the binary dvh_curve column or the legacy
+            # dvh_string column, dvh_curve takes priority
+            for uid, roi_name, dvh_curve, dvh_string in results:
+                indices = rows.get((str(uid), str(roi_name)))
+                if indices:
+                    i = indices.pop(0)
+                    dvh_curves[i], dvh_strings[i] = dvh_curve, dvh_string
+        return CompactDVHs(
+            *get_normalized_dvh_ragged(
+                dvh_curves, dvh_strings, self.dvh_bin_width
+            )
+        )
+
+    def __getstate__(self):
+        # DVH curves are only pickled if loaded (e.g., a query cached before
+        # its curves are needed), call load_dvhs first for saved sessions
+        state = self.__dict__.copy()
+        state.pop("_load_lock", None)
+        return state
+
+    def __setstate__(self, state):
+        # dvh and bin_count were instance attributes prior to lazy loading
+        for key in ["dvh", "bin_count"]:
+            if key in state:
+                state["_" + key] = state.pop(key)
+        # dvh was a zero-padded matrix prior to CompactDVHs
+        if isinstance(state.get("_dvh"), np.ndarray):
+            state["_dvh"] = CompactDVHs.from_dense(state["_dvh"])
+        self.__dict__.update(state)
+
+    def load_plan_and_rx_values(self, plan_columns=None, rx_columns=None):
+        """Fetch Plans and Rxs columns for every study with a single joined
+        query, and index them by study_instance_uid in ``plan_values`` and
+        ``rx_values``. Previously loaded columns are kept
+
+        Parameters
+        ----------
+        plan_columns : list, optional
+            SQL columns of the Plans table
+        rx_columns : list, optional
+            SQL columns of the Rxs table
+        """
+        if not hasattr(self, "plan_values"):  # e.g., a DVH saved by v0.9.7
+            self.plan_values, self.rx_values = {}, {}
+        plan_columns = [
+            c for c in plan_columns or [] if c not in self.plan_values
+        ]
+        rx_columns = [c for c in rx_columns or [] if c not in self.rx_values]
+        if not plan_columns and not rx_columns:
+            return
+
+        columns = ["Plans.study_instance_uid"]
+        columns.extend("Plans.%s" % c for c in plan_columns)
+        columns.extend("Rxs.%s" % c for c in rx_columns)
+        table = "Plans"
+        if rx_columns:
+            table = (
+                "Plans LEFT JOIN Rxs "
+                "ON Plans.study_instance_uid = Rxs.study_instance_uid"
+            )
+        condition = "Plans.study_instance_uid in ('%s')" % "','".join(
+            set(self.study_instance_uid)
+        )
+
+        with DVH_SQL(group=getattr(self, "group", 1)) as cnx:
+            data = cnx.query(table, ",".join(columns), condition)
+            # sqlite does not have date or time like variables
+            date_columns = {
+                c
+                for c in plan_columns
+                if cnx.is_sqlite_column_datetime("Plans", c)
+            }  # empty for pgsql
+
+        for i, column in enumerate(plan_columns, 1):
+            values = {row[0]: row[i] for row in data}
+            if column in date_columns:
+                values = {u: parse_date_value(v) for u, v in values.items()}
+            self.plan_values[column] = values
+
+        # Only the last Rx of each study is kept, as in previous versions
+        for i, column in enumerate(rx_columns, len(plan_columns) + 1):
+            self.rx_values[column] = {row[0]: str(row[i]) for row in data}
+
     def get_plan_values(self, plan_column):
         """Get values from the Plans table and store in order matching mrn / study_instance_uid
 
@@ -147,29 +343,9 @@ class DVH:
             values from the Plans table for the DVHs stored in this class
 
         """
-        with DVH_SQL() as cnx:
-            condition = "study_instance_uid in ('%s')" % "','".join(
-                self.study_instance_uid
-            )
-            data = cnx.query(
-                "Plans", "study_instance_uid, %s" % plan_column, condition
-            )
-            force_date = cnx.is_sqlite_column_datetime(
-                "Plans", plan_column
-            )  # returns False for pgsql
-
-        uids = [row[0] for row in data]
-        values = [row[1] for row in data]
-        if force_date:  # sqlite does not have date or time like variables
-            for i, value in enumerate(values):
-                try:
-                    if type(value) is int:
-                        values[i] = str(date_parser(str(value)))
-                    else:
-                        values[i] = str(date_parser(value))
-                except Exception:
-                    values[i] = "None"
-        return [values[uids.index(uid)] for uid in self.study_instance_uid]
+        self.load_plan_and_rx_values(plan_columns=[plan_column])
+        values = self.plan_values[plan_column]
+        return [values[uid] for uid in self.study_instance_uid]
 
     def get_rx_values(self, rx_column):
         """Get values from the Rxs table and store in order matching mrn / study_instance_uid
@@ -185,23 +361,9 @@ class DVH:
             values from the Rxs table for the DVHs stored in this class
 
         """
-        with DVH_SQL() as cnx:
-            condition = "study_instance_uid in ('%s')" % "','".join(
-                self.study_instance_uid
-            )
-            data = cnx.query(
-                "Rxs", "study_instance_uid, %s" % rx_column, condition
-            )
-
-        uids = [row[0] for row in data]
-        values = [row[1] for row in data]
-        final_values = {}
-        for i, uid in enumerate(uids):
-            if uid in list(values):
-                final_values[uid] = "%s,%s" % (final_values[uid], values[i])
-            else:
-                final_values[uid] = str(values[i])
-        return [final_values[uid] for uid in self.study_instance_uid]
+        self.load_plan_and_rx_values(rx_columns=[rx_column])
+        values = self.rx_values[rx_column]
+        return [values[uid] for uid in self.study_instance_uid]
 
     @property
     def x_axis(self):
@@ -237,7 +399,9 @@ class DVH:
             all DVHs in order (i.e., same as mrn, study_instance_uid)
 
         """
-        return [self.dvh[:, i].tolist() for i in range(self.count)]
+        return [
+            round_float32(self.dvh[:, i]).tolist() for i in range(self.count)
+        ]
 
     def get_cds_data(self, keys=None):
         """Get data from this class in a format compatible with bokeh's ColumnDataSource.data
@@ -275,7 +439,7 @@ class DVH:
             bin over the whole sample
 
         """
-        return np.percentile(self.dvh, percentile, 1)
+        return reduce_bins(self.dvh, lambda d: np.percentile(d, percentile, 1))
 
     def get_dose_to_volume(
         self,
@@ -303,42 +467,12 @@ class DVH:
             the dose in Gy to the specified volume
 
         """
-        doses = np.zeros(self.count)
-        for x in range(self.count):
-            dvh = np.zeros(len(self.dvh))
-            for y in range(len(self.dvh)):
-                dvh[y] = self.dvh[y][x]
-            if volume_scale == "relative":
-                doses[x] = dose_to_volume(
-                    dvh, volume, dvh_bin_width=self.dvh_bin_width
-                )
-            else:
-                if self.volume[x]:
-                    doses[x] = dose_to_volume(
-                        dvh,
-                        volume / self.volume[x],
-                        dvh_bin_width=self.dvh_bin_width,
-                    )
-                else:
-                    doses[x] = 0
-        if dose_scale == "relative":
-            if self.rx_dose[0]:
-                doses = np.divide(doses * 100, self.rx_dose[0 : self.count])
-            else:
-                self.rx_dose[
-                    0
-                ] = 1  # if review dvh isn't defined, the following line would crash
-                doses = np.divide(doses * 100, self.rx_dose[0 : self.count])
-                self.rx_dose[0] = 0
-                doses[0] = 0
-
-        if compliment:
-            if dose_scale == "absolute":
-                doses = self.max_dose[0 : self.count] - doses
-            else:
-                doses = 100.0 * np.divide(self.max_dose[0 : self.count], self.rx_dose) - doses
-
-        return doses.tolist()
+        doses = doses_to_volume(
+            self.dvh,
+            self.get_rel_volumes(volume, volume_scale),
+            dvh_bin_width=self.dvh_bin_width,
+        )
+        return self.scale_doses(doses, dose_scale, compliment).tolist()
 
     def get_volume_of_dose(
         self,
@@ -366,26 +500,118 @@ class DVH:
             a list of V_dose
 
         """
-        volumes = np.zeros(self.count)
-        for x in range(self.count):
-
-            dvh = np.zeros(len(self.dvh))
-            for y in range(len(self.dvh)):
-                dvh[y] = self.dvh[y][x]
-            if dose_scale == "relative":
-                if isinstance(self.rx_dose[x], str):
-                    volumes[x] = 0
-                else:
-                    volumes[x] = volume_of_dose(
-                        dvh,
-                        dose * self.rx_dose[x],
-                        dvh_bin_width=self.dvh_bin_width,
-                    )
+        volumes = volumes_of_dose(
+            self.dvh,
+            self.get_abs_doses(dose, dose_scale),
+            dvh_bin_width=self.dvh_bin_width,
+        )
+        return self.scale_volumes(volumes, volume_scale, compliment).tolist()
+
+    def get_rel_volumes(self, volume, volume_scale="absolute"):
+        """Convert a volume into a fractional volume for each DVH
+
+        Parameters
+        ----------
+        volume : int, float
+            a volume in cm^3, or fractional volume
+        volume_scale : str, optional
+            either 'relative' or 'absolute'
+
+        Returns
+        -------
+        np.ndarray
+            fractional volume for each DVH, NaN if a DVH has no volume
+        """
+        if volume_scale == "relative":
+            return np.full(self.count, float(volume))
+        roi_volumes = np.array(self.volume[: self.count], dtype=float)
+        has_volume = np.isfinite(roi_volumes) & (roi_volumes != 0)
+        return np.divide(
+            volume,
+            roi_volumes,
+            out=np.full(self.count, np.nan),
+            where=has_volume,
+        )
+
+    def get_abs_doses(self, dose, dose_scale="absolute"):
+        """Convert a dose into Gy for each DVH
+
+        Parameters
+        ----------
+        dose : int, float
+            a dose in Gy, or fraction of rx_dose
+        dose_scale : str, optional
+            either 'relative' or 'absolute'
+
+        Returns
+        -------
+        np.ndarray
+            dose in Gy for each DVH, NaN if a study has no numeric rx_dose
+        """
+        if dose_scale == "absolute":
+            return np.full(self.count, float(dose))
+        rx_doses = np.array(
+            [
+                np.nan if v is None or isinstance(v, str) else v
+                for v in self.rx_dose[: self.count]
+            ],
+            dtype=float,
+        )
+        return np.multiply(dose, rx_doses)
+
+    def scale_doses(self, doses, dose_scale="absolute", compliment=False):
+        """Apply the output scale of a dose-to-volume endpoint
+
+        Parameters
+        ----------
+        doses : np.ndarray
+            dose in Gy for each DVH
+        dose_scale : str, optional
+            either 'relative' or 'absolute'
+        compliment : bool, optional
+            return the max dose - value
+
+        Returns
+        -------
+        np.ndarray
+            scaled doses
+        """
+        if dose_scale == "relative":
+            if self.rx_dose[0]:
+                doses = np.divide(doses * 100, self.rx_dose[0 : self.count])
             else:
-                volumes[x] = volume_of_dose(
-                    dvh, dose, dvh_bin_width=self.dvh_bin_width
-                )
+                self.rx_dose[
+                    0
+                ] = 1  # if review dvh isn't defined, the following line would crash
+                doses = np.divide(doses * 100, self.rx_dose[0 : self.count])
+                self.rx_dose[0] = 0
+                doses[0] = 0
+
+        if compliment:
+            if dose_scale == "absolute":
+                doses = self.max_dose[0 : self.count] - doses
+            else:
+                doses = 100.0 * np.divide(self.max_dose[0 : self.count], self.rx_dose) - doses
 
+        return doses
+
+    def scale_volumes(self, volumes, volume_scale="absolute", compliment=False):
+        """Apply the output scale of a volume-of-dose endpoint
+
+        Parameters
+        ----------
+        volumes : np.ndarray
+            fractional volume for each DVH
+        volume_scale : str, optional
+            either 'relative' or 'absolute'
+        compliment : bool, optional
+            return the ROI volume - value
+
+        Returns
+        -------
+        np.ndarray
+            scaled volumes
+        """
         if volume_scale == "absolute":
             volumes = np.multiply(volumes, self.volume[0 : self.count])
         else:
@@ -397,7 +623,71 @@ class DVH:
             else:
                 volumes = 100.0 * np.ones(self.count) - volumes
 
-        return volumes.tolist()
+        return volumes
+
+    def get_endpoint_values(self, ep_defs):
+        """Evaluate endpoint definitions (see models.endpoint.EndpointFrame)
+        with one call of doses_to_volume and volumes_of_dose. Values are
+        cached by definition, so only new definitions are calculated
+
+        Parameters
+        ----------
+        ep_defs : dict
+            lists keyed by 'label', 'output_type', 'input_type', and
+            'input_value', as in EndpointFrame.endpoint_defs.data
+
+        Returns
+        -------
+        dict
+            endpoint values (list) by label
+        """
+        # DVH objects of previous versions are loaded without a cache
+        cache = self.__dict__.setdefault("endpoint_cache", {})
+
+        keys = {
+            label: get_endpoint_key(label, *ep_def)
+            for label, *ep_def in zip(
+                ep_defs["label"],
+                ep_defs["output_type"],
+                ep_defs["input_type"],
+                ep_defs["input_value"],
+            )
+        }
+        missing = [
+            key for key in dict.fromkeys(keys.values()) if key not in cache
+        ]
+
+        dose_keys = [key for key in missing if key[0] == "dose"]
+        if dose_keys:
+            rel_volumes = [
+                self.get_rel_volumes(value, input_type)
+                for _, _, input_type, _, value in dose_keys
+            ]
+            doses = doses_to_volume(
+                self.dvh, rel_volumes, dvh_bin_width=self.dvh_bin_width
+            )
+            for key, key_doses in zip(dose_keys, doses):
+                _, output_type, _, compliment, _ = key
+                cache[key] = self.scale_doses(
+                    key_doses, output_type, compliment
+                ).tolist()
+
+        volume_keys = [key for key in missing if key[0] == "volume"]
+        if volume_keys:
+            abs_doses = [
+                self.get_abs_doses(value, input_type)
+                for _, _, input_type, _, value in volume_keys
+            ]
+            volumes = volumes_of_dose(
+                self.dvh, abs_doses, dvh_bin_width=self.dvh_bin_width
+            )
+            for key, key_volumes in zip(volume_keys, volumes):
+                _, output_type, _, compliment, _ = key
+                cache[key] = self.scale_volumes(
+                    key_volumes, output_type, compliment
+                ).tolist()
+
+        return {label: list(cache[key]) for label, key in keys.items()}
 
     def get_resampled_x_axis(self, resampled_bin_count=5000):
         """Get the x_axis of a resampled dvh
@@ -452,10 +742,9 @@ class DVH:
             "median": np.median,
             "max": np.max,
             "std": np.std,
-        }
-        dvh = stat_function[stat_type](dvhs, 1)
+        }[stat_type]
 
-        return dvh
+        return reduce_bins(dvhs, lambda d: stat_function(d, 1))
 
     def get_standard_stat_dvh(
         self, dose_scale="absolute", volume_scale="relative"
@@ -484,31 +773,37 @@ class DVH:
         if volume_scale == "absolute":
             dvhs = self.dvhs_to_abs_vol(dvhs)
 
-        standard_stat_dvh = {
-            "min": np.min(dvhs, 1),
-            "q1": np.percentile(dvhs, 25, 1),
-            "mean": np.mean(dvhs, 1),
-            "median": np.median(dvhs, 1),
-            "q3": np.percentile(dvhs, 75, 1),
-            "max": np.max(dvhs, 1),
+        stat_functions = {
+            "min": lambda d: np.min(d, 1),
+            "q1": lambda d: np.percentile(d, 25, 1),
+            "mean": lambda d: np.mean(d, 1),
+            "median": lambda d: np.median(d, 1),
+            "q3": lambda d: np.percentile(d, 75, 1),
+            "max": lambda d: np.max(d, 1),
         }
+        # all statistics are calculated from each block of CompactDVHs
+        stats = reduce_bins(
+            dvhs, lambda d: np.stack([f(d) for f in stat_functions.values()])
+        )
 
-        return standard_stat_dvh
+        return dict(zip(stat_functions, stats))
 
     def dvhs_to_abs_vol(self, dvhs):
         """Get DVHs in absolute volume
 
         Parameters
         ----------
-        dvhs : np.ndarray
+        dvhs : np.ndarray, CompactDVHs
             relative DVHs (dvh[bin, roi_index])
 
         Returns
         -------
-        np.ndarray
+        np.ndarray, CompactDVHs
             absolute DVHs
 
         """
+        if isinstance(dvhs, CompactDVHs):
+            return dvhs.multiply(self.volume)
         return np.multiply(dvhs, self.volume)
 
     def resample_dvh(self, resampled_bin_count=5000):
@@ -607,6 +902,262 @@ class DVH:
         return bool(len(self.mrn))
 
 
+def merge_dvhs(dvhs, sources):
+    """Combine DVH objects queried from different databases into one DVH
+    object, e.g., for a federated query. A ``source`` value is added to each
+    DVH. Values not loaded by the source DVH objects (e.g., get_plan_values
+    of a new column) are only available from the database of the first
+    source.
+
+    Parameters
+    ----------
+    dvhs : list
+        DVH objects with the same dvh_bin_width
+    sources : list
+        a name for the database of each DVH object
+
+    Returns
+    -------
+    DVH
+        DVHs of all sources, in the order of ``dvhs``
+    """
+    merged = DVH.__new__(DVH)
+    items = [(dvh, source) for dvh, source in zip(dvhs, sources) if dvh.count]
+    merged.count = sum(dvh.count for dvh, _ in items)
+    if not items:
+        return merged
+    first = items[0][0]
+    merged.dvh_bin_width = first.dvh_bin_width
+    merged.group = first.group
+
+    # values with one item per DVH, available in all sources
+    row_keys = [
+        key
+        for key, value in first.__dict__.items()
+        if isinstance(value, list)
+        and len(value) == first.count
+        and all(isinstance(getattr(d, key, None), list) for d, _ in items)
+    ]
+    for key in row_keys:
+        setattr(merged, key, [v for dvh, _ in items for v in getattr(dvh, key)])
+    merged.source = [source for dvh, source in items for _ in range(dvh.count)]
+    merged.keys = [key for key in first.keys if key in row_keys] + ["source"]
+
+    merged.dvh = CompactDVHs.concatenate([dvh.dvh for dvh, _ in items])
+    merged.bin_count = merged.dvh.bin_count
+
+    merged.plan_values, merged.rx_values = {}, {}
+    for attr in ["plan_values", "rx_values"]:
+        merged_values = getattr(merged, attr)
+        for column_name in getattr(first, attr):
+            if all(column_name in getattr(d, attr) for d, _ in items):
+                merged_values[column_name] = {}
+                for dvh, _ in items:
+                    merged_values[column_name].update(
+                        getattr(dvh, attr)[column_name]
+                    )
+
+    merged.study_count = sum(dvh.study_count for dvh, _ in items)
+    merged.physician_count = len(
+        {p for dvh, _ in items for p in dvh.plan_values["physician"].values()}
+    )
+    merged.endpoints = {"data": None, "defs": None}
+    merged.endpoint_cache = {}
+    merged.eud = None
+    merged.ntcp_or_tcp = None
+    return merged
+
+
+def get_endpoint_key(label, output_type, input_type, input_value):
+    """Get a hashable definition of an endpoint, as defined by
+    dialogs.main.AddEndpointDialog
+
+    Parameters
+    ----------
+    label : str
+        short-hand label, e.g., 'D_95%[Gy]' or 'CV_20Gy[cc]'
+    output_type : str
+        either 'absolute' or 'relative'
+    input_type : str
+        either 'absolute' or 'relative'
+    input_value : float
+        volume (cm^3 or %) of a dose endpoint, or dose (Gy or %) of a volume
+        endpoint
+
+    Returns
+    -------
+    tuple
+        'dose' or 'volume', output_type, input_type, compliment (bool), and
+        input_value (as a fraction if relative)
+    """
+    input_value = float(input_value)
+    if input_type == "relative":
+        input_value /= 100.0
+    return (
+        "volume" if "V" in label else "dose",
+        output_type,
+        input_type,
+        "C" in label,
+        input_value,
+    )
+
+
+def reduce_bins(dvhs, function):
+    """Apply a statistical function to the DVHs of each dose bin
+
+    Parameters
+    ----------
+    dvhs : np.ndarray, CompactDVHs
+        DVHs (dvh[bin, roi_index])
+    function : callable
+        accepts zero-padded DVHs (dvh[bin, roi_index]) and returns one value
+        per bin along the last axis, e.g., lambda d: np.mean(d, 1)
+
+    Returns
+    -------
+    np.ndarray
+        results of ``function`` for all dose bins (see round_float32),
+        CompactDVHs are passed one block of dose bins at a time (see
+        CompactDVHs.reduce_bins)
+    """
+    if isinstance(dvhs, CompactDVHs):
+        return round_float32(dvhs.reduce_bins(function))
+    return round_float32(function(dvhs))
+
+
+def round_float32(values):
+    """Convert DVH values into float64, rounded to the 7 significant digits
+    of float32, so that plots and exports show e.g. 0.3 rather than
+    0.30000001192092896 (casting alone keeps the float32 error)
+
+    Parameters
+    ----------
+    values : np.ndarray
+        float32 or float64 values
+
+    Returns
+    -------
+    np.ndarray
+        rounded float64 values
+    """
+    values = np.asarray(values, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        exponent = np.floor(np.log10(np.abs(values)))
+    # 0, NaN, and inf are not rounded
+    digits = np.where(np.isfinite(exponent), 6 - exponent, 0)
+    # dividing by an exact power of ten (up to 1e22), rather than multiplying
+    # by an inexact one, so that the result is the closest float64 to the
+    # decimal
+    scale = 10.0 ** np.abs(digits)
+    return np.where(
+        digits >= 0,
+        np.round(values * scale) / scale,
+        np.round(values / scale) * scale,
+    )
+
+
+def doses_to_volume(dvhs, rel_volumes, dvh_bin_width=1):
+    """Calculate the minimum dose to a relative volume for many DVHs at once,
+    with linear interpolation between dose bins
+
+    Parameters
+    ----------
+    dvhs : np.ndarray, CompactDVHs
+        relative DVHs (dvh[bin, roi_index])
+    rel_volumes : float, np.ndarray
+        fractional volume, one fractional volume per DVH, or a 2D array of
+        fractional volumes (volume[endpoint, roi_index]). DVHs with a NaN
+        volume have a dose of 0
+    dvh_bin_width : int, optional
+        dose bin width of dvhs
+
+    Returns
+    -------
+    np.ndarray
+        minimum dose in Gy of specified volume for each DVH (with the
+        leading axis of ``rel_volumes`` if 2D), the max dose of the DVH axis
+        if the volume is never reached
+
+    """
+    bin_count, count = np.shape(dvhs)
+    rel_volumes = np.asarray(rel_volumes, dtype=float)
+    shape = (len(rel_volumes), count) if rel_volumes.ndim == 2 else (count,)
+    rel_volumes = np.broadcast_to(rel_volumes, shape).reshape(-1, count)
+
+    if isinstance(dvhs, CompactDVHs):
+        doses = np.empty(rel_volumes.shape)
+        for rois, block in dvhs.iter_dense_blocks():
+            doses[:, rois] = doses_to_volume(
+                block, rel_volumes[:, rois], dvh_bin_width=dvh_bin_width
+            )
+        return doses.reshape(shape)
+
+    rois = np.arange(count)
+    doses = np.empty(rel_volumes.shape)
+    step = max(1, ENDPOINT_CHUNK_SIZE // max(1, bin_count * count))
+    for i in range(0, len(rel_volumes), step):
+        volumes = rel_volumes[i : i + step, np.newaxis, :]
+
+        # first bin below the volume, 0 if there is none
+        below = dvhs < volumes
+        dose_high = np.argmax(below, axis=1)
+        is_found = np.take_along_axis(below, dose_high[:, np.newaxis], 1)
+        is_found = is_found[:, 0]
+
+        dose_low = np.maximum(dose_high - 1, 0)
+        volumes = volumes[:, 0]
+        y_low = np.asarray(dvhs[dose_low, rois], dtype=float)
+        y_high = np.asarray(dvhs[dose_high, rois], dtype=float)
+        fraction = np.divide(
+            y_low - volumes,
+            y_low - y_high,
+            out=np.zeros(volumes.shape),
+            where=y_low > y_high,
+        )
+        dose_bins = np.where(is_found, dose_low + fraction, bin_count)
+        doses[i : i + step] = np.where(np.isnan(volumes), 0, dose_bins)
+
+    return doses.reshape(shape) * dvh_bin_width * 0.01
+
+
+def volumes_of_dose(dvhs, doses, dvh_bin_width=1):
+    """Calculate the relative volumes of isodose lines for many DVHs at
+    once, with linear interpolation between dose bins
+
+    Parameters
+    ----------
+    dvhs : np.ndarray, CompactDVHs
+        relative DVHs (dvh[bin, roi_index])
+    doses : float, np.ndarray
+        dose in Gy, one dose per DVH, or a 2D array of doses
+        (dose[endpoint, roi_index]). DVHs with a NaN dose have a volume of 0
+    dvh_bin_width : int, optional
+        dose bin width of dvhs
+
+    Returns
+    -------
+    np.ndarray
+        fractional volume receiving at least the specified dose for each DVH
+        (with the leading axis of ``doses`` if 2D)
+
+    """
+    bin_count, count = np.shape(dvhs)
+    dose_bins = np.asarray(doses, dtype=float)
+    shape = (len(dose_bins), count) if dose_bins.ndim == 2 else (count,)
+    dose_bins = np.broadcast_to(dose_bins, shape) * 100.0 / dvh_bin_width
+    is_valid = np.isfinite(dose_bins)
+    dose_bins = np.clip(np.where(is_valid, dose_bins, 0), 0, bin_count - 1)
+
+    rois = np.arange(count)
+    bin_low = np.floor(dose_bins).astype(int)
+    bin_high = np.minimum(bin_low + 1, bin_count - 1)
+    y_low = np.asarray(dvhs[bin_low, rois], dtype=float)
+    y_high = np.asarray(dvhs[bin_high, rois], dtype=float)
+    volumes = y_low + (y_high - y_low) * (dose_bins - bin_low)
+
+    return np.where(is_valid, volumes, 0.0)
+
+
 # Returns the isodose level outlining the given volume
 def dose_to_volume(dvh, rel_volume, dvh_bin_width=1):
     """Calculate the minimum dose to a relative volume for one DVH
@@ -626,18 +1177,8 @@ def dose_to_volume(dvh, rel_volume, dvh_bin_width=1):
         minimum dose in Gy of specified volume
 
     """
-
-    # Return the maximum dose instead of extrapolating
-    if rel_volume < dvh[-1]:
-        return len(dvh) * dvh_bin_width * 0.01
-
-    dose_high = np.argmax(dvh < rel_volume)
-    y = rel_volume
-    x_range = [dose_high - 1, dose_high]
-    y_range = [dvh[dose_high - 1], dvh[dose_high]]
-    dose = np.interp(y, y_range, x_range) * dvh_bin_width * 0.01
-
-    return dose
+    dvhs = np.reshape(dvh, (-1, 1))
+    return float(doses_to_volume(dvhs, rel_volume, dvh_bin_width)[0])
 
 
 def volume_of_dose(dvh, dose, dvh_bin_width=1):
@@ -649,27 +1190,18 @@ def volume_of_dose(dvh, dose, dvh_bin_width=1):
     dvh : np.ndarray
         a single dvh
     dose : float
-        dose in cGy
+        dose in Gy
     dvh_bin_width : int, optional
         dose bin width of dvh
 
     Returns
     -------
     float
-        volume in cm^3 of roi receiving at least the specified dose
+        fractional volume of roi receiving at least the specified dose
 
     """
-
-    x = [
-        int(np.floor(dose / dvh_bin_width * 100)),
-        int(np.ceil(dose / dvh_bin_width * 100)),
-    ]
-    if len(dvh) < x[1]:
-        return dvh[-1]
-    y = [dvh[x[0]], dvh[x[1]]]
-    roi_volume = np.interp(float(dose) / dvh_bin_width, x, y)
-
-    return roi_volume
+    dvhs = np.reshape(dvh, (-1, 1))
+    return float(volumes_of_dose(dvhs, dose, dvh_bin_width)[0])
 
 
 def calc_eud(dvh, a, dvh_bin_width=1):
@@ -725,3 +1257,22 @@ def calc_tcp(gamma, td_tcd, eud):
 
     """
     return 1.0 / (1.0 + (td_tcd / eud) ** (4.0 * gamma))
+
+
+def parse_date_value(value):
+    """Convert a date stored in sqlite into a string
+
+    Parameters
+    ----------
+    value : str, int
+        value of a sqlite datetime column
+
+    Returns
+    -------
+    str
+        the parsed date, or 'None' if it could not be parsed
+    """
+    try:
+        return str(date_parser(str(value)))
+    except Exception:
+        return "None"
@@ -11,7 +11,6 @@ Class for the Endpoint frame in the main view
 #    available at https://github.com/cutright/DVH-Analytics
 
 import wx
-from copy import deepcopy
 from dvha.models.data_table import DataTable
 from dvha.dialogs.main import AddEndpointDialog, DelEndpointDialog
 from dvha.dialogs.export import save_data_to_file
@@ -128,14 +127,6 @@ class EndpointFrame:
     def calculate_endpoints(self):
 
         columns = {key: [c for c in self.initial_columns] for key in [1, 2]}
-        if self.data_table[1].data:
-            current_labels = [
-                key
-                for key in list(self.data_table[1].data)
-                if key not in columns
-            ]
-        else:
-            current_labels = []
 
         eps = {
             grp: {
@@ -148,39 +139,18 @@ class EndpointFrame:
             if group_data["dvh"]
         }
 
+        # all definitions are evaluated together, values of previously
+        # calculated definitions are cached by the DVH object
         ep_defs = self.endpoint_defs.data
         for group, ep in eps.items():
             if ep_defs:
-                for i, ep_name in enumerate(ep_defs["label"]):
-
+                ep_values = self.group_data[group]["dvh"].get_endpoint_values(
+                    ep_defs
+                )
+                for ep_name in ep_defs["label"]:
                     if ep_name not in columns[group]:
                         columns[group].append(ep_name)
-
-                        if ep_name in current_labels:
-                            ep[ep_name] = deepcopy(
-                                self.data_table[group].data[ep_name]
-                            )
-
-                        else:
-                            endpoint_input = ep_defs["input_type"][i]
-                            endpoint_output = ep_defs["output_type"][i]
-
-                            x = float(ep_defs["input_value"][i])
-                            if endpoint_input == "relative":
-                                x /= 100.0
-
-                            func = getattr(
-                                self.group_data[group]["dvh"],
-                                "get_volume_of_dose"
-                                if "V" in ep_name
-                                else "get_dose_to_volume",
-                            )
-                            ep[ep_name] = func(
-                                x,
-                                volume_scale=endpoint_output,
-                                dose_scale=endpoint_input,
-                                compliment="C" in ep_name,
-                            )
+                        ep[ep_name] = ep_values[ep_name]
 
         for group, ep in eps.items():
             self.data_table[group].set_data(ep, columns[group])
@@ -29,6 +29,9 @@ from queue import Queue
 from functools import partial
 from dvha.db import update as db_update
 from dvha.db.sql_connector import DVH_SQL, write_test as sql_write_test
+from dvha.db.dvh_curve import decode_dvh_curve
+from dvha.db.dvh_store import sync_dvh_store
+from dvha.db.roi_contours import get_contours_row
 from dvha.models.dicom_tree_builder import (
     DicomTreeBuilder,
     PreImportFileSetParserWorker,
@@ -1806,7 +1809,8 @@ class StudyImporter:
             "Beams": parsed_data.get_beam_rows(),
             "DICOM_Files": [parsed_data.get_dicom_file_row()],
             "DVHs": [],
-        }  # DVHs will only include PTVs, others pushed en route
+            "DVH_Contours": [],
+        }  # entire study is pushed in one transaction after DVH calculations
 
         # remove uncategorized ROIs unless this is checked
         if not self.import_uncategorized:
@@ -1862,12 +1866,15 @@ class StudyImporter:
 
                     # Collect dvh, volume, and index of ptvs to be used for post-import calculations
                     if roi_type.startswith("PTV"):
-                        ptvs["dvh"].append(dvh_row["dvh_string"][0])
+                        ptvs["dvh"].append(
+                            decode_dvh_curve(dvh_row["dvh_curve"][0])
+                        )
                         ptvs["volume"].append(dvh_row["volume"][0])
                         ptvs["index"].append(len(data_to_import["DVHs"]))
-                        data_to_import["DVHs"].append(dvh_row)
-                    else:
-                        self.push({"DVHs": [dvh_row]})
+                    data_to_import["DVH_Contours"].append(
+                        get_contours_row(dvh_row)
+                    )
+                    data_to_import["DVHs"].append(dvh_row)
 
         # Sort PTVs by their D_95% (applicable to SIBs)
         if ptvs["dvh"] and not self.terminate:
@@ -1927,47 +1934,66 @@ class StudyImporter:
                                     clean_name(roi_name_map[roi_key])
                                 )
 
-                # Calculate the PTV overlap for each roi
                 tv = db_update.get_total_treatment_volume_of_study(
                     study_uid, ptvs=parsed_data.plan_ptvs
                 )
-                self.post_import_calc(
-                    "PTV Overlap Volume",
-                    study_uid,
-                    post_import_rois,
-                    db_update.treatment_volume_overlap,
-                    tv,
-                )
-
-                # Calculate the centroid distances of roi-to-PTV for each roi
                 tv_centroid = db_update.get_treatment_volume_centroid(tv)
-                self.post_import_calc(
-                    "Centroid Distance to PTV",
-                    study_uid,
-                    post_import_rois,
-                    db_update.dist_to_ptv_centroids,
-                    tv_centroid,
-                )
 
-                # Calculate minimum, mean, median, and max distances and DTH
-                # tv_coord = db_update.get_treatment_volume_coord(tv)
-                # tv_coord = sample_roi(tv_coord)
-                self.post_import_calc(
-                    "Distances to PTV",
-                    study_uid,
-                    post_import_rois,
-                    db_update.min_distances,
-                    tv,
-                )
+                # all calculations of the study are committed together
+                with DVH_SQL() as cnx:
+                    try:
+                        # Calculate the PTV overlap for each roi
+                        self.post_import_calc(
+                            "PTV Overlap Volume",
+                            study_uid,
+                            post_import_rois,
+                            db_update.treatment_volume_overlap,
+                            tv,
+                            cnx,
+                        )
 
-                # Calculate OVH
-                self.post_import_calc(
-                    "Overlap Volume Histogram (OVH)",
-                    study_uid,
-                    post_import_rois,
-                    db_update.ovh,
-                    tv,
-                )
+                        # Calculate the centroid distances of roi-to-PTV for
+                        # each roi
+                        self.post_import_calc(
+                            "Centroid Distance to PTV",
+                            study_uid,
+                            post_import_rois,
+                            db_update.dist_to_ptv_centroids,
+                            tv_centroid,
+                            cnx,
+                        )
+
+                        # Calculate minimum, mean, median, and max distances
+                        # and DTH
+                        # tv_coord = db_update.get_treatment_volume_coord(tv)
+                        # tv_coord = sample_roi(tv_coord)
+                        self.post_import_calc(
+                            "Distances to PTV",
+                            study_uid,
+                            post_import_rois,
+                            db_update.min_distances,
+                            tv,
+                            cnx,
+                        )
+
+                        # Calculate OVH
+                        self.post_import_calc(
+                            "Overlap Volume Histogram (OVH)",
+                            study_uid,
+                            post_import_rois,
+                            db_update.ovh,
+                            tv,
+                            cnx,
+                        )
+                        cnx.cnx.commit()
+                    except Exception as e:
+                        cnx.cnx.rollback()
+                        msg = (
+                            "StudyImporter.run: Post-import calculations "
+                            "failed, no PTV-related values were stored for "
+                            "mrn: %s" % mrn
+                        )
+                        push_to_log(e, msg=msg)
 
                 self.update_ptv_data_in_db(tv, study_uid)
 
@@ -1989,15 +2015,15 @@ class StudyImporter:
     @staticmethod
     def push(data_to_import):
         """
-        Push data to the SQL database
+        Push data to the SQL database in a single transaction
         :param data_to_import: data to import, should be formatted as
-        indicated in db.sql_connector.DVH_SQL.insert_row
+        indicated in db.sql_connector.DVH_SQL.insert_rows
         :type data_to_import: dict
         """
         with DVH_SQL() as cnx:
             cnx.insert_data_set(data_to_import)
 
-    def post_import_calc(self, title, uid, rois, func, pre_calc):
+    def post_import_calc(self, title, uid, rois, func, pre_calc, cnx):
         """
         Generic function to perform a post-import calculation
         :param title: title to be displayed in progress dialog
@@ -2008,6 +2034,8 @@ class StudyImporter:
         :type rois: list
         :param func: the function from db.update called to process the data
         :param pre_calc: data related to total treatment volume for the specific func passed
+        :param cnx: connection for the updates, which are not committed
+        :type cnx: DVH_SQL
         """
 
         if not self.terminate:
@@ -2021,7 +2049,7 @@ class StudyImporter:
                     "progress": int(100 * roi_counter / roi_total),
                 }
                 wx.CallAfter(pub.sendMessage, "update_calculation", msg=msg)
-                func(uid, roi_name, pre_calc=pre_calc)
+                func(uid, roi_name, pre_calc=pre_calc, cnx=cnx)
 
     def update_ptv_data_in_db(self, tv, study_uid):
         if not self.terminate:
@@ -2147,6 +2175,7 @@ class ImportWorker(Thread):
         try:
             self.run_import()
             if not self.terminate:
+                sync_dvh_store()
                 wx.CallAfter(pub.sendMessage, "backup_sqlite_db")
         except Exception as e:
             msg = "ERROR: Import failed"
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# models.query_cache.py
+"""
+In-memory and on-disk LRU cache of query results (e.g., DVH and QuerySQL objects)
+"""
+# Copyright (c) 2016-2019 Dan Cutright
+# This file is part of DVH Analytics, released under a BSD license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/cutright/DVH-Analytics
+
+from collections import OrderedDict
+import hashlib
+from os import listdir, mkdir, unlink
+from os.path import getmtime, isdir, isfile, join
+import pickle
+import re
+from threading import Lock
+from dvha.db.sql_connector import DVH_SQL
+from dvha.paths import QUERY_CACHE_DIR
+from dvha.tools.errors import push_to_log
+
+
+def normalize_condition(condition):
+    """Normalize a SQL condition so that equivalent filters share a cache
+    key. Whitespace is collapsed, and top-level AND terms are sorted
+
+    Parameters
+    ----------
+    condition : str
+        a condition in SQL syntax
+
+    Returns
+    -------
+    str
+        normalized condition
+    """
+    if not condition:
+        return ""
+    condition = re.sub(r"\s+", " ", str(condition)).strip()
+
+    # split on AND outside of parentheses and quotes
+    pieces, depth, in_quote, start = [], 0, False, 0
+    upper = condition.upper()
+    for i, char in enumerate(condition):
+        if char == "'":
+            in_quote = not in_quote
+        elif not in_quote and char in "()":
+            depth += 1 if char == "(" else -1
+        elif not in_quote and not depth and upper.startswith(" AND ", i):
+            pieces.append(condition[start:i])
+            start = i + 5
+    pieces.append(condition[start:])
+
+    # re-join the AND of BETWEEN clauses
+    terms = []
+    for piece in pieces:
+        if terms and re.search(r"\bBETWEEN \S+$", terms[-1], re.IGNORECASE):
+            terms[-1] = "%s AND %s" % (terms[-1], piece)
+        else:
+            terms.append(piece.strip())
+    return " AND ".join(sorted(terms))
+
+
+class QueryCache:
+    """LRU cache of query results. Values are pickled, so cached objects are
+    never shared with (or modified by) the caller. Each value is stored with
+    the modification state of its database (see
+    DVH_SQL.get_modification_state) and is discarded if the state has
+    changed. Databases without a modification counter (DVHA_Modifications)
+    are not cached, since the remaining state misses edits and deletions.
+
+    Parameters
+    ----------
+    max_memory_items : int, optional
+        number of results kept in memory
+    max_disk_items : int, optional
+        number of results kept in ``cache_dir``
+    max_disk_item_size : int, optional
+        pickled results larger than this (bytes) are only kept in memory
+    cache_dir : str, optional
+        directory for the on-disk cache
+
+    Cached values include patient data (e.g., mrn), so the on-disk cache is
+    off until ``disk_enabled`` is set (see Options.QUERY_CACHE_ON_DISK)
+    """
+
+    def __init__(
+        self,
+        max_memory_items=8,
+        max_disk_items=32,
+        max_disk_item_size=2 ** 26,
+        cache_dir=QUERY_CACHE_DIR,
+    ):
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.max_disk_item_size = max_disk_item_size
+        self.cache_dir = cache_dir
+        self.enabled = True
+        self.disk_enabled = False
+
+        self._lock = Lock()
+        self._memory = OrderedDict()
+
+    @staticmethod
+    def get_key(kind, *args, group=1):
+        """Get a cache key
+
+        Parameters
+        ----------
+        kind : str
+            type of the cached value, e.g., 'dvh'
+        args :
+            values defining the query (conditions are normalized)
+        group : int, optional
+            either 1 or 2
+
+        Returns
+        -------
+        str
+            hex digest identifying the query and group's database
+        """
+        with DVH_SQL(group=group) as cnx:
+            db_key = cnx.pool_key
+        values = [
+            normalize_condition(arg) if isinstance(arg, str) else arg
+            for arg in args
+        ]
+        key_str = repr((kind, db_key, values))
+        return hashlib.sha256(key_str.encode()).hexdigest()
+
+    @staticmethod
+    def get_state(group=1):
+        """Get the modification state of a group's database
+
+        Parameters
+        ----------
+        group : int, optional
+            either 1 or 2
+
+        Returns
+        -------
+        tuple, None
+            return of DVH_SQL.get_modification_state, None if the database
+            has no modification counter
+        """
+        with DVH_SQL(group=group) as cnx:
+            state = cnx.get_modification_state()
+        return None if state[0] is None else state
+
+    def get(self, key, group=1):
+        """Get a cached value
+
+        Parameters
+        ----------
+        key : str
+            return from get_key
+        group : int, optional
+            either 1 or 2
+
+        Returns
+        -------
+        any
+            the cached value, None if not cached or out of date
+        """
+        if not self.enabled:
+            return None
+
+        state = self.get_state(group)
+        if state is None:
+            return None
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+        if entry is None:
+            entry = self._read(key)
+            if entry is not None:
+                self._remember(key, entry)
+
+        if entry is None:
+            return None
+        if entry[0] != state:
+            self.discard(key)
+            return None
+        return pickle.loads(entry[1])
+
+    def set(self, key, value, group=1):
+        """Cache a value
+
+        Parameters
+        ----------
+        key : str
+            return from get_key
+        value : any
+            a picklable object
+        group : int, optional
+            either 1 or 2
+        """
+        if not self.enabled:
+            return
+        state = self.get_state(group)
+        if state is None:
+            return
+        try:
+            entry = (state, pickle.dumps(value))
+        except Exception as e:
+            push_to_log(e, msg="QueryCache: Could not pickle value")
+            return
+        self._remember(key, entry)
+        if len(entry[1]) <= self.max_disk_item_size:
+            self._write(key, entry)
+
+    def discard(self, key):
+        """Remove a value from the cache
+
+        Parameters
+        ----------
+        key : str
+            return from get_key
+        """
+        with self._lock:
+            self._memory.pop(key, None)
+        file_path = self._get_file_path(key)
+        if isfile(file_path):
+            try:
+                unlink(file_path)
+            except OSError:
+                pass
+
+    def clear(self):
+        """Remove all cached values, including those on disk"""
+        with self._lock:
+            self._memory.clear()
+        self.clear_disk()
+
+    def clear_disk(self):
+        """Remove all cached values from disk, e.g., after disabling the
+        on-disk cache"""
+        if isdir(self.cache_dir):
+            for file_name in listdir(self.cache_dir):
+                if file_name.endswith(".pickle"):
+                    try:
+                        unlink(join(self.cache_dir, file_name))
+                    except OSError:
+                        pass
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def _get_file_path(self, key):
+        return join(self.cache_dir, "%s.pickle" % key)
+
+    def _read(self, key):
+        file_path = self._get_file_path(key)
+        if not self.disk_enabled or not isfile(file_path):
+            return None
+        try:
+            with open(file_path, "rb") as infile:
+                return pickle.load(infile)
+        except Exception as e:
+            push_to_log(e, msg="QueryCache: Could not read %s" % file_path)
+            self.discard(key)
+
+    def _write(self, key, entry):
+        if not self.disk_enabled:
+            return
+        try:
+            if not isdir(self.cache_dir):
+                mkdir(self.cache_dir)
+            with open(self._get_file_path(key), "wb") as outfile:
+                pickle.dump(entry, outfile, pickle.HIGHEST_PROTOCOL)
+            self._prune_disk()
+        except Exception as e:
+            push_to_log(e, msg="QueryCache: Could not write cache file")
+
+    def _prune_disk(self):
+        """Delete the least recently written files beyond max_disk_items"""
+        file_paths = [
+            join(self.cache_dir, f)
+            for f in listdir(self.cache_dir)
+            if f.endswith(".pickle")
+        ]
+        file_paths.sort(key=getmtime, reverse=True)
+        for file_path in file_paths[self.max_disk_items:]:
+            unlink(file_path)
+
+
+QUERY_CACHE = QueryCache()
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# models.query_executor.py
+"""
+Run the query pipeline (UIDs, DVHs, plan data, stats data) in background
+threads, so the GUI remains responsive
+"""
+# Copyright (c) 2016-2019 Dan Cutright
+# This file is part of DVH Analytics, released under a BSD license.
+#    See the file LICENSE included with this distribution, also
+#    available at https://github.com/cutright/DVH-Analytics
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+import wx
+from dvha.db.sql_connector import DVH_SQL
+from dvha.db.sql_to_python import QuerySQL, merge_query_sql
+from dvha.models.dvh import DVH, merge_dvhs
+from dvha.models.query_cache import QUERY_CACHE
+from dvha.tools.stats import StatsData
+from dvha.tools.utilities import get_common_study_instance_uids
+
+
+MIN_DVH_COUNT = 3  # fewer DVHs than this are not processed past the DVHs
+QUERY_STAGES = ["UIDs", "DVHs", "Plan Data", "Stats Data"]
+TABLES = ["Plans", "Rxs", "Beams"]
+
+
+class QueryCancelled(Exception):
+    """Raised within a QueryJob after QueryJob.cancel is called"""
+
+    pass
+
+
+def query_dvh(queries, dvh_bin_width, group=1, stage_callback=None):
+    """Query a DVH object, re-using the cached result if the database has not
+    been modified since. The DVH curves are loaded on first access, so only
+    the DVH metadata is cached
+
+    Parameters
+    ----------
+    queries : dict
+        conditions in SQL syntax for the Plans, Rxs, Beams, and DVHs tables
+    dvh_bin_width : int
+        retrieve every nth value of each DVH
+    group : int, optional
+        either 1 or 2
+    stage_callback : callable, optional
+        called with the name of a stage (see QUERY_STAGES) when it begins
+
+    Returns
+    -------
+    DVH
+        DVHs meeting the conditions of ``queries``
+    """
+    key = QUERY_CACHE.get_key(
+        "dvh",
+        queries["Plans"],
+        queries["Rxs"],
+        queries["Beams"],
+        queries["DVHs"],
+        dvh_bin_width,
+        group=group,
+    )
+    dvh = QUERY_CACHE.get(key, group=group)
+    if dvh is None:
+        if stage_callback is not None:
+            stage_callback("UIDs")
+        # DVHs condition is included so that studies without a matching DVH
+        # are not passed to the DVH class
+        uids = get_common_study_instance_uids(
+            group=group,
+            plans=queries["Plans"],
+            rxs=queries["Rxs"],
+            beams=queries["Beams"],
+            dvhs=queries["DVHs"],
+        )
+        if stage_callback is not None:
+            stage_callback("DVHs")
+        dvh = DVH(
+            dvh_condition=queries["DVHs"],
+            uid=uids,
+            dvh_bin_width=dvh_bin_width,
+            group=group,
+            lazy=True,
+        )
+        QUERY_CACHE.set(key, dvh, group=group)
+    return dvh
+
+
+def query_table_data(dvh, group=1):
+    """Query the Plans, Rxs, and Beams data of the studies in a DVH object,
+    re-using the cached result if the database has not been modified since
+
+    Parameters
+    ----------
+    dvh : DVH
+        the result of a query
+    group : int, optional
+        either 1 or 2
+
+    Returns
+    -------
+    dict
+        QuerySQL objects by table name
+    """
+    uids = dvh.study_instance_uid
+    key = QUERY_CACHE.get_key("data", sorted(set(uids)), group=group)
+    data = QUERY_CACHE.get(key, group=group)
+    if data is None:
+        condition_str = "study_instance_uid in ('%s')" % "','".join(uids)
+        # each table is queried on its own pooled connection
+        with ThreadPoolExecutor(len(TABLES)) as pool:
+            futures = {
+                table: pool.submit(
+                    QuerySQL, table, condition_str, group=group
+                )
+                for table in TABLES
+            }
+            data = {table: future.result() for table, future in futures.items()}
+        QUERY_CACHE.set(key, data, group=group)
+    return data
+
+
+def get_source_groups(groups=(1, 2)):
+    """Get the groups connected to distinct databases, and a name for each
+    database
+
+    Parameters
+    ----------
+    groups : iterable, optional
+        groups to consider
+
+    Returns
+    -------
+    dict
+        database name by group, groups sharing a database with a previous
+        group are excluded
+    """
+    sources, pool_keys = {}, set()
+    for group in groups:
+        with DVH_SQL(group=group) as cnx:
+            if cnx.pool_key in pool_keys:
+                continue
+            pool_keys.add(cnx.pool_key)
+            if cnx.db_type == "sqlite":
+                name = cnx.config["host"]
+            else:
+                name = "%s@%s" % (cnx.config["dbname"], cnx.config["host"])
+            sources[group] = "%s: %s" % (cnx.db_type, name)
+    return sources
+
+
+def query_federated(
+    queries, dvh_bin_width, groups=(1, 2), stage_callback=None
+):
+    """Query the same conditions from the database of each group
+    concurrently, and merge the results. Each DVH and table row is tagged with
+    its database in a ``source`` value
+
+    Parameters
+    ----------
+    queries : dict
+        conditions in SQL syntax for the Plans, Rxs, Beams, and DVHs tables
+    dvh_bin_width : int
+        retrieve every nth value of each DVH
+    groups : iterable, optional
+        the groups whose databases are queried, groups sharing a database
+        are only queried once
+    stage_callback : callable, optional
+        called with the name of a stage (see QUERY_STAGES) when it begins
+
+    Returns
+    -------
+    tuple
+        merged DVH, and merged QuerySQL objects by table name (None if fewer
+        than MIN_DVH_COUNT DVHs are found)
+    """
+    sources = get_source_groups(groups)
+    groups = list(sources)
+    names = [sources[group] for group in groups]
+
+    if stage_callback is not None:
+        stage_callback("DVHs")
+
+    # DVH curves are loaded in the pool, so sources are parsed in parallel
+    def query_and_load(group):
+        dvh = query_dvh(queries, dvh_bin_width, group=group)
+        if dvh.count:
+            dvh.load_dvhs()
+        return dvh
+
+    with ThreadPoolExecutor(len(groups)) as pool:
+        dvhs = list(pool.map(query_and_load, groups))
+    dvh = merge_dvhs(dvhs, names)
+    if dvh.count < MIN_DVH_COUNT:
+        return dvh, None
+
+    if stage_callback is not None:
+        stage_callback("Plan Data")
+    found = [i for i, d in enumerate(dvhs) if d.count]
+    with ThreadPoolExecutor(len(found)) as pool:
+        table_data = list(
+            pool.map(
+                lambda i: query_table_data(dvhs[i], group=groups[i]), found
+            )
+        )
+    data = {
+        table: merge_query_sql(
+            [d[table] for d in table_data], [names[i] for i in found]
+        )
+        for table in TABLES
+    }
+    return dvh, data
+
+
+class QueryJob(Thread):
+    """Query DVH, plan, and stats data for one group in a background thread.
+    Callbacks are called on the GUI thread with the job as the first
+    argument.
+
+    Parameters
+    ----------
+    group : int
+        either 1 or 2
+    queries : dict
+        conditions in SQL syntax for the Plans, Rxs, Beams, and DVHs tables
+    dvh_bin_width : int
+        retrieve every nth value of each DVH
+    on_progress : callable, optional
+        called with the job, stage index, stage count, and stage name
+    on_complete : callable, optional
+        called with the job once ``dvh``, ``data``, and ``stats_data`` are set
+    on_error : callable, optional
+        called with the job and the raised exception
+    federated : bool, optional
+        query the databases of both groups, see query_federated
+    """
+
+    def __init__(
+        self,
+        group,
+        queries,
+        dvh_bin_width,
+        on_progress=None,
+        on_complete=None,
+        on_error=None,
+        federated=False,
+    ):
+        Thread.__init__(self, daemon=True)
+        self.group = group
+        self.queries = queries
+        self.dvh_bin_width = dvh_bin_width
+        self.federated = federated
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        self.on_error = on_error
+
+        self.dvh = None
+        self.data = None
+        self.stats_data = None
+
+        self._cancelled = Event()
+
+    def cancel(self):
+        """Stop the job at the start of the next stage, and never call
+        on_complete or on_error"""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def run(self):
+        try:
+            if self.federated:
+                self.dvh, self.data = query_federated(
+                    self.queries,
+                    self.dvh_bin_width,
+                    stage_callback=self.stage,
+                )
+            else:
+                self.dvh = query_dvh(
+                    self.queries,
+                    self.dvh_bin_width,
+                    group=self.group,
+                    stage_callback=self.stage,
+                )
+                # load the DVH curves here rather than on the GUI thread
+                if self.dvh.count:
+                    self.dvh.load_dvhs()
+            if self.dvh.count >= MIN_DVH_COUNT:
+                if self.data is None:
+                    self.stage("Plan Data")
+                    self.data = query_table_data(self.dvh, group=self.group)
+                self.stage("Stats Data")
+                self.stats_data = StatsData(
+                    self.dvh, self.data, group=self.group
+                )
+            self.stage(None)
+            self.post(self.on_complete, self)
+        except QueryCancelled:
+            pass
+        except Exception as e:  # includes MemoryError
+            self.post(self.on_error, self, e)
+
+    def stage(self, name):
+        """Begin a stage of the query, raise QueryCancelled if the job has
+        been cancelled
+
+        Parameters
+        ----------
+        name : str, None
+            a name in QUERY_STAGES, or None when all stages are complete
+        """
+        if self.cancelled:
+            raise QueryCancelled
+        index = len(QUERY_STAGES) if name is None else QUERY_STAGES.index(name)
+        self.post(self.on_progress, self, index, len(QUERY_STAGES), name)
+
+    def post(self, callback, *args):
+        """Call a callback on the GUI thread, unless the job is cancelled"""
+        if callback is None or self.cancelled:
+            return
+        try:
+            wx.CallAfter(callback, *args)
+        except AssertionError:  # no wx.App, e.g., scripting
+            callback(*args)
+
+
+class QueryExecutor:
+    """Run at most one QueryJob per group, so that group 1 and group 2 can be
+    queried concurrently. Submitting a query for a group cancels its previous
+    job."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._jobs = {}
+
+    def submit(self, group, queries, dvh_bin_width, **kwargs):
+        """Start a QueryJob
+
+        Parameters
+        ----------
+        group : int
+            either 1 or 2
+        queries : dict
+            conditions in SQL syntax for the Plans, Rxs, Beams, and DVHs
+            tables
+        dvh_bin_width : int
+            retrieve every nth value of each DVH
+        kwargs :
+            on_progress, on_complete, on_error, and federated, see QueryJob
+
+        Returns
+        -------
+        QueryJob
+            the started job
+        """
+        job = QueryJob(group, queries, dvh_bin_width, **kwargs)
+        with self._lock:
+            previous = self._jobs.get(group)
+            self._jobs[group] = job
+        if previous is not None:
+            previous.cancel()
+        job.start()
+        return job
+
+    def cancel(self, group=None):
+        """Cancel the job of a group
+
+        Parameters
+        ----------
+        group : int, optional
+            either 1 or 2, cancel all jobs if None
+        """
+        with self._lock:
+            groups = list(self._jobs) if group is None else [group]
+            jobs = [self._jobs.pop(g) for g in groups if g in self._jobs]
+        for job in jobs:
+            job.cancel()
+
+    def is_running(self, group):
+        """Check if a group has a job that has not been finished
+
+        Parameters
+        ----------
+        group : int
+            either 1 or 2
+
+        Returns
+        -------
+        bool
+            True if a submitted job of ``group`` is not yet finished
+        """
+        with self._lock:
+            return group in self._jobs
+
+    def finish(self, job):
+        """Release a job, call from its on_complete or on_error callback
+
+        Parameters
+        ----------
+        job : QueryJob
+            a job returned from submit
+
+        Returns
+        -------
+        bool
+            False if ``job`` has been cancelled or replaced, in which case
+            its results should be ignored
+        """
+        with self._lock:
+            if self._jobs.get(job.group) is not job or job.cancelled:
+                return False
+            self._jobs.pop(job.group)
+            return True
@@ -12,9 +12,10 @@ Class used to manage user options
 
 import pickle
 from os.path import isfile, isdir
-from os import unlink
+from os import unlink, stat
 import hashlib
 from copy import deepcopy
+from threading import Lock
 from dvha._version import __version__
 from dvha.paths import (
     OPTIONS_PATH,
@@ -56,6 +57,31 @@ class DefaultOptions:
             "SQL_LAST_CNX_GRPS",
         ]
 
+        # Applied to each new SQLite connection, see db.connection_pool
+        # journal_mode=WAL allows reading (e.g., backups, queries) while
+        # importing. Negative cache_size is in KiB, mmap_size is in bytes
+        self.SQLITE_PRAGMAS = {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -65536,
+            "mmap_size": 268435456,
+            "temp_store": "MEMORY",
+        }
+
+        # Record the duration of each SQL statement, see db.sql_profiler
+        self.SQL_PROFILING = False
+
+        # Query the databases of both groups, and merge the results
+        self.QUERY_FEDERATED = False
+
+        # Keep cached query results in QUERY_CACHE_DIR between sessions. Off
+        # by default, since cached results include patient data (e.g., mrn)
+        self.QUERY_CACHE_ON_DISK = False
+
+        # Hold queried DVHs in memory as 16-bit fractions of their max
+        # (rounded to 1/65535) rather than float32, see models.compact_dvh
+        self.DVH_QUANTIZED = False
+
         self.MIN_BORDER = 50
 
         # These colors propagate to all tabs that visualize your two groups
@@ -506,3 +532,33 @@ class Options(DefaultOptions):
             loaded_options["ROI_TYPES"].insert(0, "NONE")
         if "IGNORED" not in loaded_options["ROI_TYPES"]:
             loaded_options["ROI_TYPES"].append("IGNORED")
+
+
+_sql_settings_lock = Lock()
+_sql_settings_cache = {"time_stamp": None, "settings": None}
+
+
+def get_stored_sql_settings():
+    """Get the stored SQL connection options. The options file is only
+    re-loaded if it has changed since the last call, so this is cheap to call
+    for every new DVH_SQL object
+
+    Returns
+    -------
+    dict
+        The SQL options (``DefaultOptions._sql_vars``, SYNC_SQL_CNX, and
+        SQLITE_PRAGMAS)
+    """
+    time_stamp = tuple(
+        (stat(path).st_mtime_ns, stat(path).st_size) if isfile(path) else None
+        for path in [OPTIONS_PATH, OPTIONS_CHECKSUM_PATH]
+    )
+    with _sql_settings_lock:
+        if _sql_settings_cache["time_stamp"] != time_stamp:
+            options = Options()
+            keys = options._sql_vars + ["SYNC_SQL_CNX", "SQLITE_PRAGMAS"]
+            _sql_settings_cache["settings"] = {
+                key: deepcopy(getattr(options, key)) for key in keys
+            }
+            _sql_settings_cache["time_stamp"] = time_stamp
+        return deepcopy(_sql_settings_cache["settings"])
@@ -32,6 +32,8 @@ REVIEW_DIR = join(DATA_DIR, "review")
 BACKUP_DIR = join(DATA_DIR, "backup")
 TEMP_DIR = join(DATA_DIR, "temp")
 MODELS_DIR = join(DATA_DIR, "models")
+QUERY_CACHE_DIR = join(DATA_DIR, "query_cache")
+DVH_STORE_DIR = join(DATA_DIR, "dvh_store")
 DIRECTORIES = {
     key[:-4]: value for key, value in locals().items() if key.endswith("_DIR")
 }
@@ -42,6 +44,7 @@ SQL_CNF_PATH = join(PREF_DIR, "sql_connection.cnf")
 LICENSE_PATH = join(RESOURCES_DIR, "LICENSE.txt")
 CREATE_PGSQL_TABLES = join(SCRIPT_DIR, "db", "create_tables.sql")
 CREATE_SQLITE_TABLES = join(SCRIPT_DIR, "db", "create_tables_sqlite.sql")
+CREATE_INDEXES = join(SCRIPT_DIR, "db", "create_indexes.sql")
 TG263_CSV = join(
     SCRIPT_DIR, "resources", "TG263_Nomenclature_Worksheet_20170815.csv"
 )
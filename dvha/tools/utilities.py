@@ -32,9 +32,11 @@ import pickle
 import pydicom
 from pydicom.uid import ImplicitVRLittleEndian
 import shutil
+import sqlite3
 from subprocess import check_output
 import sys
 import tracemalloc
+from dvha.db.columnar import ColumnarDB
 from dvha.db.sql_connector import DVH_SQL
 from dvha.paths import (
     SQL_CNF_PATH,
@@ -222,75 +224,24 @@ def get_file_paths(
     return []
 
 
-def get_study_instance_uids(**kwargs):
-    """Get lists of study instance uids in the SQL database that meet provided conditions
-    The values return in the 'common' key are used for the DVH class in models.dvh.py
+def get_common_study_instance_uids(group=1, **kwargs):
+    """Get the study instance uids that meet the provided condition of every
+    table, with a single query
 
     Parameters
     ----------
+    group : int, optional
+        either 1 or 2
     kwargs :
         keys are SQL table names and the values are conditions in SQL syntax
-    **kwargs :
-
-
-    Returns
-    -------
-    dict
-        study instance uids for each table, uids found in all tables, and a list of unique uids
-
-    """
-    with DVH_SQL() as cnx:
-        uids = {
-            table: cnx.get_unique_values(
-                table, "study_instance_uid", condition
-            )
-            for table, condition in kwargs.items()
-        }
-
-    complete_list = flatten_list_of_lists(
-        list(uids.values()), remove_duplicates=True
-    )
-
-    uids["common"] = [
-        uid for uid in complete_list if is_uid_in_all_keys(uid, uids)
-    ]
-    uids["unique"] = complete_list
-
-    return uids
-
-
-def is_uid_in_all_keys(uid, uids):
-    """Check if uid is found in each of the uid lists for each SQL table
-
-    Parameters
-    ----------
-    uid : str
-        study instance uid
-    uids : dict
-        lists of study instance uids organized by SQL table
 
     Returns
     -------
-    bool
-        True only if uid is found in each of the tables
-
+    list
+        sorted study instance uids found in all tables
     """
-
-    table_answer = {}
-    # Initialize a False value for each key
-    for table in list(uids):
-        table_answer[table] = False
-    # search for uid in each keyword fof uid_kwlist
-    for table, value in uids.items():
-        if uid in value:
-            table_answer[table] = True
-
-    final_answer = True
-    # Product of all answer[key] values (except 'unique')
-    for table, value in table_answer.items():
-        if table not in "unique":
-            final_answer *= value
-    return final_answer
+    with DVH_SQL(group=group) as cnx:
+        return cnx.get_common_uids(kwargs)
 
 
 def flatten_list_of_lists(some_list, remove_duplicates=False, sort=False):
@@ -850,8 +801,8 @@ def get_dose_to_volume(dvhs, volumes, roi_fraction):
 
     Parameters
     ----------
-    dvhs :
-
+    dvhs : list
+        DVHs as np.ndarray (cm^3, 1 cGy bins)
     volumes :
 
     roi_fraction :
@@ -865,7 +816,7 @@ def get_dose_to_volume(dvhs, volumes, roi_fraction):
     doses = []
     for i, dvh in enumerate(dvhs):
         abs_volume = volumes[i] * roi_fraction
-        dvh_np = np.array(dvh.split(","), dtype=np.float)
+        dvh_np = np.asarray(dvh, dtype=float)
         try:
             dose = next(x[0] for x in enumerate(dvh_np) if x[1] < abs_volume)
         except StopIteration:
@@ -1322,15 +1273,19 @@ def set_phantom_js_in_path():
 
 
 def backup_sqlite_db(options):
-    """
+    """Copy the SQLite database to BACKUP_DIR with the SQLite online backup
+    API, which is safe to call while the database is being written to
 
     Parameters
     ----------
-    options :
-
+    options : Options
+        DVHA options class object
 
     Returns
     -------
+    list
+        file paths of the database and its backup, None if no backup was
+        made
 
     """
     if options.DB_TYPE == "sqlite":
@@ -1346,14 +1301,19 @@ def backup_sqlite_db(options):
                 db_file_path = None
 
         if db_file_path is not None:
-            move_files_to_new_path(
-                [db_file_path],
-                BACKUP_DIR,
-                copy_files=True,
-                new_file_names=[new_file_name],
-            )
+            if not isdir(BACKUP_DIR):
+                mkdir(BACKUP_DIR)
+            backup_file_path = join(BACKUP_DIR, new_file_name)
+            cnx_src = sqlite3.connect(db_file_path)
+            cnx_dst = sqlite3.connect(backup_file_path)
+            try:
+                # copy in steps so writers are not blocked for long
+                cnx_src.backup(cnx_dst, pages=1024)
+            finally:
+                cnx_dst.close()
+                cnx_src.close()
 
-            return [db_file_path, join(BACKUP_DIR, new_file_name)]
+            return [db_file_path, backup_file_path]
 
 
 def main_is_frozen():
@@ -1619,14 +1579,15 @@ def get_windows_webview_backend(include_edge=False):
                 return {"id": id, "name": name}
 
 
-def merge_db(cfgs, callback=None, force=False, create_new_uids=False, append_to_uid=None, verbose=False):
+def merge_db(cfgs, callback=None, force=False, create_new_uids=False, append_to_uid=None, verbose=False, workers=1):
     """ Each argument will be passed into DVH_SQL(), all databases will
     be merged into the first connection
 
     Parameters
     ----------
     cfgs : list of dict
-        List of DVH_SQL configuration dictionaries
+        List of DVH_SQL configuration dictionaries. A source with a db_type
+        of 'columnar' is read from the db.columnar export at its 'host'
     callback : callable, optional
         optional function to be called on each row insertion. Should accept
         table (str), current row (int), total_row_count (int) as parameters
@@ -1642,6 +1603,8 @@ def merge_db(cfgs, callback=None, force=False, create_new_uids=False, append_to_
         study_instance_uids instead of dbname
     verbose : bool, optional
         print progress to console if true
+    workers : int, optional
+        number of tables to copy in parallel (pgsql destinations only)
     """
 
     if len(cfgs) < 2:
@@ -1653,18 +1616,66 @@ def merge_db(cfgs, callback=None, force=False, create_new_uids=False, append_to_
             if verbose:
                 print(f"Beginning import of database {i+1} of {len(cfgs) - 1}")
             db_type = alt_cnx.get('db_type', 'pgsql')
-            with DVH_SQL(alt_cnx, db_type=db_type) as cnx_src:
+            if db_type == 'columnar':
+                cnx_src = ColumnarDB(alt_cnx['host'])
+            else:
+                cnx_src = DVH_SQL(alt_cnx, db_type=db_type)
+            with cnx_src:
                 append_with_me = append_to_uid[i+1] if append_to_uid else None
-                cnx_src.import_db(
+                DVH_SQL.import_db(
                     cnx_src,
                     cnx_dst,
                     callback,
                     force,
                     create_new_uids,
-                    append_with_me
+                    append_with_me,
+                    workers=workers,
                 )
 
 
+def delta_sync_db(cfg_src, cfg_dst, callback=None, delete_missing=False, verbose=False, workers=1):
+    """Copy only the new or changed studies of one database into another,
+    see db.delta_sync
+
+    Parameters
+    ----------
+    cfg_src : dict
+        DVH_SQL configuration of the source database, with optional db_type
+    cfg_dst : dict
+        DVH_SQL configuration of the destination database, with optional
+        db_type
+    callback : callable, optional
+        optional function to be called as studies are hashed and rows are
+        inserted. Should accept table (str), current row (int),
+        total_row_count (int) as parameters
+    delete_missing : bool, optional
+        also delete studies from the destination that are not in the source
+    verbose : bool, optional
+        print a summary to console if true
+    workers : int, optional
+        number of tables to copy in parallel (pgsql destinations only)
+
+    Returns
+    -------
+    dict
+        number of 'new', 'changed', 'deleted', and 'unchanged' studies
+    """
+    src_type = cfg_src.get('db_type', 'pgsql')
+    dst_type = cfg_dst.get('db_type', 'pgsql')
+    with DVH_SQL(cfg_src, db_type=src_type) as cnx_src:
+        with DVH_SQL(cfg_dst, db_type=dst_type) as cnx_dst:
+            counts = DVH_SQL.delta_sync(
+                cnx_src,
+                cnx_dst,
+                callback=callback,
+                delete_missing=delete_missing,
+                workers=workers,
+            )
+    if verbose:
+        print(', '.join('%s: %s' % item for item in counts.items()))
+    return counts
+
+
 def merge_like_db(db_names, append_to_uid=None, cfg=None, db_type='pgsql', force=False, new_db_path=None, verbose=True):
     """Merge a list of databases by dbname, all of which are the same dbtype
 